@@ -0,0 +1,117 @@
+###########################################################
+#       Import time benchmark
+###########################################################
+# Measures how long 'import stoploss_monitor_standalone' takes in a fresh interpreter
+# (python -X importtime), which is the time a restarted monitor spends before it can
+# log in and run its first reconciliation. It also checks that the modules imported
+# lazily (see LazyModule in stoploss_monitor_standalone.py) stay out of the import.
+#
+# Usage:
+#   python bench_import.py                           # print results and the change against the baseline
+#   python bench_import.py --save-baseline           # store results in import_baseline.json
+#   python bench_import.py --check                   # compare with the baseline, exit 1 on regression
+#
+# The import regresses when it takes longer than the baseline by more than --tolerance
+# (relative, default 0.25 = 25%), or longer than --budget-ms. Baselines are machine
+# specific: import_baseline.json is the reference measurement committed with the code
+# (its 'python' and 'platform' say where it was taken), save your own on the machine
+# the checks run on.
+#
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+
+MODULE = 'stoploss_monitor_standalone'
+
+# Must not be imported by 'import stoploss_monitor_standalone'
+LAZY_MODULES = ('pandas', 'PySimpleGUI', 'tda')
+
+DEFAULT_BASELINE = 'import_baseline.json'
+
+
+# Returns {module: (self_us, cumulative_us)} of one 'python -X importtime' run
+def import_times(module):
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'import ' + module],
+                            capture_output=True, text=True, check=True)
+    times = {}
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        self_us, cumulative_us, name = line[len('import time:'):].split('|')
+        times[name.strip()] = (int(self_us), int(cumulative_us))
+    return times
+
+
+def run_benchmark(repeat):
+    best = None
+    for i in range(0, repeat):
+        times = import_times(MODULE)
+        if best is None or times[MODULE][1] < best[MODULE][1]:
+            best = times
+
+    lazy_loaded = sorted(name for name in best if name.split('.')[0] in LAZY_MODULES)
+    slowest = sorted(((cumulative, name) for name, (self_us, cumulative) in best.items() if name != MODULE), reverse=True)[:15]
+
+    print("%-45s %10.1f ms" % ('import ' + MODULE, best[MODULE][1] / 1000))
+    for cumulative, name in slowest:
+        print("  %-43s %10.1f ms" % (name, cumulative / 1000))
+
+    return {'seconds': best[MODULE][1] / 1000000, 'modules': len(best), 'lazy_loaded': lazy_loaded,
+            'python': platform.python_version(), 'platform': platform.platform()}
+
+
+def report_delta(result, baseline):
+    delta = result['seconds'] - baseline['seconds']
+    print("%-45s %10.1f ms  (%+.1f ms, %+.0f%%)" % ('baseline (' + baseline.get('python', '?') + ')', baseline['seconds'] * 1000,
+                                                  delta * 1000, delta / baseline['seconds'] * 100))
+    print("%-45s %10d      (%+d)" % ('modules imported', result['modules'], result['modules'] - baseline['modules']))
+
+
+def find_regressions(result, baseline, tolerance, budget_ms):
+    regressions = []
+    if baseline is not None and result['seconds'] > baseline['seconds'] * (1 + tolerance):
+        regressions.append("import took %.1f ms, baseline %.1f ms" % (result['seconds'] * 1000, baseline['seconds'] * 1000))
+    if budget_ms is not None and result['seconds'] * 1000 > budget_ms:
+        regressions.append("import took %.1f ms, budget %.1f ms" % (result['seconds'] * 1000, budget_ms))
+    if len(result['lazy_loaded']) > 0:
+        regressions.append("lazily imported modules were loaded: %s" % ', '.join(result['lazy_loaded']))
+    return regressions
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmarks the import time of the stop monitor.')
+    parser.add_argument('--repeat', type=int, default=5, help='interpreter runs, the fastest one is kept')
+    parser.add_argument('--baseline', default=DEFAULT_BASELINE, help='baseline JSON file')
+    parser.add_argument('--save-baseline', action='store_true', help='store the result as the new baseline')
+    parser.add_argument('--check', action='store_true', help='fail if the import regressed against the baseline or the budget')
+    parser.add_argument('--tolerance', type=float, default=0.25, help='allowed relative regression')
+    parser.add_argument('--budget-ms', type=float, default=None, help='absolute import time budget in milliseconds')
+    args = parser.parse_args()
+
+    result = run_benchmark(args.repeat)
+
+    baseline = None
+    if os.path.exists(args.baseline):
+        with open(args.baseline) as file:
+            baseline = json.load(file)
+        report_delta(result, baseline)
+
+    if args.save_baseline:
+        with open(args.baseline, 'w') as file:
+            json.dump(result, file, indent=2, sort_keys=True)
+        print("Baseline saved to", args.baseline)
+
+    if args.check:
+        if baseline is None:
+            print("No baseline in", args.baseline, "- run with --save-baseline first")
+            sys.exit(1)
+
+        regressions = find_regressions(result, baseline, args.tolerance, args.budget_ms)
+        for regression in regressions:
+            print("REGRESSION", regression)
+        if regressions:
+            sys.exit(1)
+        print("No regressions against", args.baseline)
@@ -0,0 +1,153 @@
+###########################################################
+#       Parsing and reconciliation benchmarks
+###########################################################
+# Times the functions every monitor cycle runs on the account payload, over synthetic
+# accounts of growing size (see synthetic_account.py), and records the peak memory
+# allocated by each call (tracemalloc).
+#
+# Usage:
+#   python bench_parsing.py                          # print results and the change against the baseline
+#   python bench_parsing.py --save-baseline          # store results in bench_baseline.json
+#   python bench_parsing.py --check                  # compare with the baseline, exit 1 on regression
+#
+# A result regresses when its time or peak memory exceeds the baseline by more than
+# --tolerance (relative, default 0.25 = 25%). Baselines are machine specific:
+# bench_baseline.json is the reference measurement committed with the code (its
+# 'environment' says where it was taken), save your own on the machine the checks run on.
+#
+import argparse
+import json
+import logging
+import os
+import platform
+import sys
+import time
+import tracemalloc
+
+import stoploss_monitor_standalone as monitor
+from synthetic_account import generate_account
+
+# (short positions, order strategies)
+SIZES = [(10, 40), (50, 200), (200, 1000), (1000, 5000)]
+
+DEFAULT_BASELINE = 'bench_baseline.json'
+
+
+def bench_cases(account):
+    positions = account['positions']
+    orders = account['orderStrategies']
+
+    df_pos = monitor.create_option_position_df(positions)
+    df_filled = monitor.filter_orders_filled(orders, 'FILLED')
+    df_stop = monitor.filter_orders_working(orders, 'WORKING')
+
+    # An incremental tick merges a handful of new orders and the WORKING ones into the day's cache
+    order_cache = monitor.OrderHistoryCache()
+    order_cache.replace(orders, 0)
+    working_orders = [order_strat for order_strat in orders if order_strat['status'] == 'WORKING']
+
+    return {
+        'parse_orders_book': lambda: monitor.parse_orders_book(orders, ['FILLED', 'WORKING']),
+        'order_index_update': lambda: monitor.OrderBookIndex().update(positions, orders),
+        'order_cache_merge': lambda: order_cache.merge(orders[-5:], working_orders, order_cache.working_start()),
+        'filter_orders_filled': lambda: monitor.filter_orders_filled(orders, 'FILLED'),
+        'filter_orders_working': lambda: monitor.filter_orders_working(orders, 'WORKING'),
+        'partition_positions': lambda: monitor.partition_positions(positions),
+        'calc_symbol_quantity': lambda: monitor.calc_symbol_quantity(df_filled[['symbol', 'quantity', 'price']]),
+        'compute_stop_triggers': lambda: monitor.compute_stop_triggers(df_filled[['symbol', 'order_id', 'quantity', 'price']], df_pos, 2.0),
+        'reconcile_stops': lambda: monitor.reconcile_stops(df_pos, df_stop),
+        'find_missing_stops': lambda: monitor.find_missing_stops(df_pos, df_stop),
+    }
+
+
+# Best wall time of 'repeat' runs and the peak traced memory of one extra run, so the
+# tracing overhead does not end up in the timings
+def measure(func, repeat):
+    best = None
+    for i in range(0, repeat):
+        start = time.perf_counter()
+        func()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+
+    tracemalloc.start()
+    func()
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return {'seconds': best, 'peak_bytes': peak}
+
+
+def run_benchmarks(sizes, repeat, baseline=None):
+    results = {}
+    for num_positions, num_orders in sizes:
+        account = generate_account(num_positions, num_orders)['securitiesAccount']
+        for name, func in bench_cases(account).items():
+            key = '%s[%d/%d]' % (name, num_positions, num_orders)
+            results[key] = measure(func, repeat)
+            line = "%-45s %10.3f ms %12d bytes" % (key, results[key]['seconds'] * 1000, results[key]['peak_bytes'])
+            if baseline is not None and key in baseline:
+                line = line + "  (time %+.0f%%, memory %+.0f%%)" % (change(baseline[key]['seconds'], results[key]['seconds']),
+                                                                     change(baseline[key]['peak_bytes'], results[key]['peak_bytes']))
+            print(line)
+    return results
+
+
+# Relative change in percent
+def change(before, after):
+    if before == 0:
+        return 0.0
+    return (after - before) / before * 100
+
+
+def environment():
+    return {'python': platform.python_version(), 'platform': platform.platform(), 'pandas': monitor.pd.__version__}
+
+
+def find_regressions(results, baseline, tolerance):
+    regressions = []
+    for key, result in results.items():
+        if key not in baseline:
+            continue
+        for field in ('seconds', 'peak_bytes'):
+            limit = baseline[key][field] * (1 + tolerance)
+            if result[field] > limit:
+                regressions.append((key, field, baseline[key][field], result[field]))
+    return regressions
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmarks the parsing and reconciliation path on synthetic accounts.')
+    parser.add_argument('--repeat', type=int, default=5, help='timed runs per case, the best one is kept')
+    parser.add_argument('--baseline', default=DEFAULT_BASELINE, help='baseline JSON file')
+    parser.add_argument('--save-baseline', action='store_true', help='store the results as the new baseline')
+    parser.add_argument('--check', action='store_true', help='fail if any result regressed against the baseline')
+    parser.add_argument('--tolerance', type=float, default=0.25, help='allowed relative regression')
+    args = parser.parse_args()
+
+    # find_missing_stops reports every gap of the synthetic account, keep that out of the output
+    monitor.logger.setLevel(logging.CRITICAL)
+
+    baseline = None
+    if os.path.exists(args.baseline):
+        with open(args.baseline) as file:
+            baseline = json.load(file)
+
+    results = run_benchmarks(SIZES, args.repeat, baseline)
+
+    if args.save_baseline:
+        with open(args.baseline, 'w') as file:
+            json.dump(dict(results, environment=environment()), file, indent=2, sort_keys=True)
+        print("Baseline saved to", args.baseline)
+
+    if args.check:
+        if baseline is None:
+            print("No baseline in", args.baseline, "- run with --save-baseline first")
+            sys.exit(1)
+
+        regressions = find_regressions(results, baseline, args.tolerance)
+        for key, field, before, after in regressions:
+            print("REGRESSION %s %s: baseline=%s now=%s" % (key, field, before, after))
+        if regressions:
+            sys.exit(1)
+        print("No regressions against", args.baseline)
@@ -0,0 +1,82 @@
+###########################################################
+#       Fake TDA streamer
+###########################################################
+# A local websocket server that replays recorded streamer frames, so the
+# streaming mode of stoploss_monitor_standalone.py can be exercised without
+# a broker connection.
+#
+# Each line of the recording is one raw websocket frame as sent by the TDA
+# streamer, e.g.
+#   {"data": [{"service": "ACCT_ACTIVITY", "timestamp": 1684250000000, "command": "SUBS",
+#              "content": [{"seq": 1, "key": "xxx", "1": "123456789", "2": "OrderFill", "3": "<xml/>"}]}]}
+#
+# Frames are replayed with the time gaps between their timestamps divided by
+# --speed (0 replays as fast as possible).
+#
+# Usage:
+#   python fake_stream_server.py stream_sample.jsonl --port 8765 --speed 1
+# and set config.USE_STREAMING = True, config.STREAM_URL = 'ws://localhost:8765'
+#
+import argparse
+import asyncio
+import json
+
+import websockets
+
+
+def load_frames(path):
+    frames = []
+    with open(path) as file:
+        for line in file:
+            line = line.strip()
+            if line:
+                frames.append(json.loads(line))
+    return frames
+
+
+def frame_timestamp(frame):
+    for msg in frame.get('data', []):
+        if 'timestamp' in msg:
+            return msg['timestamp'] / 1000.0
+    return None
+
+
+async def replay(websocket, frames, speed, loop):
+    while True:
+        last_timestamp = None
+        for frame in frames:
+            timestamp = frame_timestamp(frame)
+            if speed > 0 and timestamp is not None and last_timestamp is not None:
+                await asyncio.sleep(max(0.0, timestamp - last_timestamp) / speed)
+            if timestamp is not None:
+                last_timestamp = timestamp
+
+            await websocket.send(json.dumps(frame))
+
+        if not loop:
+            break
+
+
+async def serve(frames, host, port, speed, loop):
+    async def handler(websocket, *args):
+        print("Client connected, replaying ", len(frames), " frames")
+        await replay(websocket, frames, speed, loop)
+
+        # Keep the connection open until the client goes away
+        await websocket.wait_closed()
+
+    async with websockets.serve(handler, host, port):
+        print("Fake streamer listening on ws://%s:%d" % (host, port))
+        await asyncio.Future()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Replays recorded TDA streamer frames over a local websocket.')
+    parser.add_argument('recording', help='JSON lines file with one raw streamer frame per line')
+    parser.add_argument('--host', default='localhost')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--speed', type=float, default=1.0, help='replay speed, 0 replays as fast as possible')
+    parser.add_argument('--loop', action='store_true', help='replay the recording forever')
+    args = parser.parse_args()
+
+    asyncio.run(serve(load_frames(args.recording), args.host, args.port, args.speed, args.loop))
@@ -0,0 +1,414 @@
+###########################################################
+#       Fake TDA REST server
+###########################################################
+# A local stand-in for the TDA account, order and quote endpoints, to load-test the
+# monitor without a broker connection. It keeps one in-memory account (seeded with
+# synthetic_account.py), accepts order placements and simulates fills:
+#   - new SELL_TO_OPEN fills arrive at --fill-rate per second, leaving shorts without a stop
+#   - MARKET orders fill right away
+#   - WORKING STOP orders fill when the option mark reaches the stop price, while the
+#     underlying follows a random walk
+#
+# Faults can be injected on every request: --latency/--jitter seconds of delay, a
+# fraction of --error-rate 500s and --timeout-rate hung requests, and 429s above
+# --rate-limit requests per minute.
+#
+# Endpoints (as used by tda-api):
+#   GET    /v1/accounts/{id}?fields=positions,orders
+#   GET    /v1/accounts/{id}/orders?fromEnteredTime=&toEnteredTime=&status=
+#   POST   /v1/accounts/{id}/orders                 201 with the order Location
+#   GET    /v1/accounts/{id}/orders/{order_id}
+#   PUT    /v1/accounts/{id}/orders/{order_id}      replace, 201 with the new order Location
+#   DELETE /v1/accounts/{id}/orders/{order_id}      cancel
+#   GET    /v1/marketdata/quotes?symbol=$SPX.X,SPXW_051623P4100
+#   POST   /webhook                                 discord webhook stand-in
+#   GET    /stats                                   request counters and fill to stop latency
+#
+# Usage:
+#   python fake_tda_server.py --port 8080 --fill-rate 0.2 --latency 0.05 --error-rate 0.01 --rate-limit 120
+# and set config.TDA_BASE_URL = 'http://localhost:8080' (and config.DISCORD_HOOK to
+# 'http://localhost:8080/webhook' to capture the notifications). --account-id must be
+# in config.ACCOUNT_IDS, as the order IDs are checked against it.
+#
+import argparse
+import json
+import random
+import re
+import threading
+import time
+from datetime import datetime, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+from synthetic_account import generate_account, option_symbol, option_leg, tda_time
+
+# Utils.extract_order_id only accepts locations on the TDA host
+LOCATION_URL = 'https://api.tdameritrade.com/v1/accounts/%s/orders/%d'
+
+ACCOUNT_PATH = re.compile(r'^/v1/accounts/(\d+)$')
+ORDERS_PATH = re.compile(r'^/v1/accounts/(\d+)/orders$')
+ORDER_PATH = re.compile(r'^/v1/accounts/(\d+)/orders/(\d+)$')
+
+
+def utc_now():
+    return datetime.now(timezone.utc)
+
+# Strike and put/call of an option symbol such as SPXW_051623P4100
+def parse_option(symbol):
+    body = symbol.split('_')[1]
+    return body[6], float(body[7:])
+
+
+class FakeAccount:
+    def __init__(self, account_id, num_positions, num_orders, seed, spx=4100.0):
+        self.random = random.Random(seed)
+        self.account_id = str(account_id)
+        self.spx = spx
+        self.lock = threading.Lock()
+
+        account = generate_account(num_positions, num_orders, seed)['securitiesAccount']
+        self.positions = {pos['instrument']['symbol']: pos for pos in account['positions']}
+        self.orders = {order['orderId']: order for order in account['orderStrategies']}
+        self.next_order_id = max(self.orders) + 1 if self.orders else 1
+
+        # symbol -> time of fills that are not protected by a stop yet
+        self.unprotected_fills = {}
+        self.fill_to_stop = []
+
+    def order_id(self):
+        order_id = self.next_order_id
+        self.next_order_id = self.next_order_id + 1
+        return order_id
+
+    def option_mark(self, symbol):
+        put_call, strike = parse_option(symbol)
+        intrinsic = strike - self.spx if put_call == 'P' else self.spx - strike
+        distance = abs(self.spx - strike)
+        return round(max(intrinsic, 0.0) + max(0.05, 5.0 - distance / 10.0), 2)
+
+    def quote(self, symbol):
+        if symbol.startswith('$'):
+            price = round(self.spx, 2)
+        elif symbol in self.positions or '_' in symbol:
+            price = self.option_mark(symbol)
+        else:
+            price = 100.0
+        return {'symbol': symbol, 'lastPrice': price, 'mark': price, 'bidPrice': round(price - 0.05, 2), 'askPrice': round(price + 0.05, 2),
+                'quoteTimeInLong': int(time.time() * 1000)}
+
+    #------------------------------------------------------------
+    # Positions
+    #------------------------------------------------------------
+    def apply_fill(self, symbol, instruction, quantity, price):
+        pos = self.positions.get(symbol)
+        if pos is None:
+            put_call, strike = parse_option(symbol)
+            pos = {'shortQuantity': 0, 'longQuantity': 0, 'averagePrice': 0.0, 'currentDayProfitLoss': 0.0,
+                   'instrument': option_leg(1, symbol, put_call, 'SELL_TO_OPEN', 0)['instrument']}
+            self.positions[symbol] = pos
+
+        if instruction == 'SELL_TO_OPEN':
+            total = pos['shortQuantity'] * pos['averagePrice'] + quantity * price
+            pos['shortQuantity'] = pos['shortQuantity'] + quantity
+            pos['averagePrice'] = round(total / pos['shortQuantity'], 4)
+            self.unprotected_fills.setdefault(symbol, time.monotonic())
+        elif instruction == 'BUY_TO_CLOSE':
+            pos['shortQuantity'] = max(0, pos['shortQuantity'] - quantity)
+        elif instruction == 'BUY_TO_OPEN':
+            pos['longQuantity'] = pos['longQuantity'] + quantity
+        elif instruction == 'SELL_TO_CLOSE':
+            pos['longQuantity'] = max(0, pos['longQuantity'] - quantity)
+
+        if pos['shortQuantity'] == 0 and pos['longQuantity'] == 0:
+            del self.positions[symbol]
+
+    def fill_order(self, order, price):
+        now = tda_time(utc_now())
+        order['status'] = 'FILLED'
+        order['filledQuantity'] = order['quantity']
+        order['remainingQuantity'] = 0
+        order['closeTime'] = now
+        order['price'] = price
+        execution_legs = []
+        for leg in order['orderLegCollection']:
+            self.apply_fill(leg['instrument']['symbol'], leg['instruction'], leg['quantity'], price)
+            execution_legs.append({'legId': leg['legId'], 'quantity': leg['quantity'], 'mismarkedQuantity': 0, 'price': price, 'time': now})
+        order['orderActivityCollection'] = [{'activityType': 'EXECUTION', 'executionType': 'FILL', 'quantity': order['quantity'],
+                                             'orderRemainingQuantity': 0, 'executionLegs': execution_legs}]
+
+    #------------------------------------------------------------
+    # Orders
+    #------------------------------------------------------------
+    def normalize_order(self, spec):
+        order = dict(spec)
+        legs = []
+        for leg_id, leg in enumerate(spec.get('orderLegCollection', []), start=1):
+            symbol = leg['instrument']['symbol']
+            put_call, strike = parse_option(symbol)
+            legs.append(option_leg(leg_id, symbol, put_call, leg['instruction'], int(leg['quantity'])))
+        order['orderLegCollection'] = legs
+        order['quantity'] = sum(leg['quantity'] for leg in legs) // max(1, len(legs))
+        order['filledQuantity'] = 0
+        order['remainingQuantity'] = order['quantity']
+        if 'stopPrice' in order:
+            order['stopPrice'] = float(order['stopPrice'])
+        if 'price' in order:
+            order['price'] = float(order['price'])
+        order['orderId'] = self.order_id()
+        order['accountId'] = int(self.account_id)
+        order['status'] = 'WORKING'
+        order['cancelable'] = True
+        order['editable'] = True
+        order['enteredTime'] = tda_time(utc_now())
+        return order
+
+    def place(self, spec):
+        order = self.normalize_order(spec)
+        self.orders[order['orderId']] = order
+
+        for leg in order['orderLegCollection']:
+            symbol = leg['instrument']['symbol']
+            if leg['instruction'] == 'BUY_TO_CLOSE' and symbol in self.unprotected_fills:
+                self.fill_to_stop.append(time.monotonic() - self.unprotected_fills.pop(symbol))
+
+        if order.get('orderType') == 'MARKET':
+            self.fill_order(order, self.option_mark(order['orderLegCollection'][0]['instrument']['symbol']))
+        return order
+
+    def cancel(self, order_id, status='CANCELED'):
+        order = self.orders.get(order_id)
+        if order is None or order['status'] not in ('WORKING', 'QUEUED', 'ACCEPTED', 'PENDING_ACTIVATION'):
+            return False
+        order['status'] = status
+        order['cancelable'] = False
+        order['editable'] = False
+        order['closeTime'] = tda_time(utc_now())
+        return True
+
+    def replace(self, order_id, spec):
+        if not self.cancel(order_id, status='REPLACED'):
+            return None
+        return self.place(spec)
+
+    def orders_between(self, start, end, status):
+        result = []
+        for order in self.orders.values():
+            if status and order['status'] != status:
+                continue
+            entered = order.get('enteredTime', '')
+            if (start and entered[:len(start)] < start) or (end and entered[:len(end)] > end):
+                continue
+            result.append(order)
+        return result
+
+    def snapshot(self, fields):
+        account = {'type': 'MARGIN', 'accountId': self.account_id, 'roundTrips': 0, 'isDayTrader': False}
+        if 'positions' in fields:
+            account['positions'] = list(self.positions.values())
+        if 'orders' in fields:
+            account['orderStrategies'] = list(self.orders.values())
+        return {'securitiesAccount': account}
+
+    #------------------------------------------------------------
+    # Market simulation
+    #------------------------------------------------------------
+    def step(self, fill_probability):
+        self.spx = self.spx + self.random.gauss(0, 1.0)
+
+        # Working stops fill when the option mark reaches the stop price
+        for order in list(self.orders.values()):
+            if order['status'] == 'WORKING' and order.get('orderType') == 'STOP':
+                symbol = order['orderLegCollection'][0]['instrument']['symbol']
+                if self.option_mark(symbol) >= order['stopPrice']:
+                    self.fill_order(order, order['stopPrice'])
+
+        # A new short fill
+        if self.random.random() < fill_probability:
+            put_call = self.random.choice(['P', 'C'])
+            distance = 5 * self.random.randint(4, 20)
+            strike = int(round(self.spx / 5) * 5) + (-distance if put_call == 'P' else distance)
+            symbol = option_symbol(utc_now(), put_call, strike)
+            quantity = self.random.randint(1, 3)
+            order = self.normalize_order({'orderType': 'LIMIT', 'session': 'NORMAL', 'duration': 'DAY', 'orderStrategyType': 'SINGLE',
+                                          'complexOrderStrategyType': 'NONE',
+                                          'orderLegCollection': [{'instruction': 'SELL_TO_OPEN', 'quantity': quantity, 'instrument': {'symbol': symbol}}]})
+            self.orders[order['orderId']] = order
+            self.fill_order(order, self.option_mark(symbol))
+
+    def run_market(self, fill_rate, tick=0.1):
+        while True:
+            with self.lock:
+                self.step(fill_rate * tick)
+            time.sleep(tick)
+
+
+class FaultInjector:
+    def __init__(self, latency, jitter, error_rate, timeout_rate, timeout_seconds, rate_limit):
+        self.random = random.Random()
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.timeout_rate = timeout_rate
+        self.timeout_seconds = timeout_seconds
+        self.rate_limit = rate_limit
+        self.request_times = []
+        self.lock = threading.Lock()
+        self.counters = {'requests': 0, 'rate_limited': 0, 'errors': 0, 'timeouts': 0}
+
+    # Returns the status code to fail the request with, or None
+    def inject(self):
+        with self.lock:
+            now = time.monotonic()
+            self.counters['requests'] = self.counters['requests'] + 1
+            self.request_times = [t for t in self.request_times if now - t < 60] + [now]
+            if self.rate_limit and len(self.request_times) > self.rate_limit:
+                self.counters['rate_limited'] = self.counters['rate_limited'] + 1
+                return 429
+            hang = self.random.random() < self.timeout_rate
+            fail = self.random.random() < self.error_rate
+            if hang:
+                self.counters['timeouts'] = self.counters['timeouts'] + 1
+            elif fail:
+                self.counters['errors'] = self.counters['errors'] + 1
+
+        time.sleep(self.latency + self.random.uniform(0, self.jitter))
+        if hang:
+            time.sleep(self.timeout_seconds)
+        return 500 if fail and not hang else None
+
+
+class FakeTDAHandler(BaseHTTPRequestHandler):
+    account = None
+    faults = None
+    webhook_messages = []
+
+    def send_json(self, status, body=None, headers=None):
+        content = b'' if body is None else json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(content)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(content)
+
+    def read_json(self):
+        length = int(self.headers.get('Content-Length', 0))
+        return json.loads(self.rfile.read(length)) if length else {}
+
+    def handle_api(self, method):
+        url = urlparse(self.path)
+        query = parse_qs(url.query)
+
+        if url.path == '/stats':
+            return self.send_json(200, self.stats())
+        if url.path == '/webhook' and method == 'POST':
+            self.webhook_messages.append(self.read_json())
+            return self.send_json(204)
+
+        status = self.faults.inject()
+        if status is not None:
+            return self.send_json(status, {'error': 'Injected fault'})
+
+        account = self.account
+        match = ACCOUNT_PATH.match(url.path) or ORDERS_PATH.match(url.path) or ORDER_PATH.match(url.path)
+        if match and match.group(1) != account.account_id:
+            return self.send_json(404, {'error': 'Unknown account'})
+
+        with account.lock:
+            if method == 'GET' and url.path == '/v1/marketdata/quotes':
+                symbols = ','.join(query.get('symbol', [])).split(',')
+                return self.send_json(200, {symbol: account.quote(symbol) for symbol in symbols if symbol})
+
+            if method == 'GET' and ACCOUNT_PATH.match(url.path):
+                fields = ','.join(query.get('fields', [])).split(',')
+                return self.send_json(200, account.snapshot(fields))
+
+            if ORDERS_PATH.match(url.path):
+                if method == 'GET':
+                    orders = account.orders_between(query.get('fromEnteredTime', [None])[0], query.get('toEnteredTime', [None])[0],
+                                                    query.get('status', [None])[0])
+                    return self.send_json(200, orders)
+                if method == 'POST':
+                    order = account.place(self.read_json())
+                    return self.send_json(201, headers={'Location': LOCATION_URL % (account.account_id, order['orderId'])})
+
+            match = ORDER_PATH.match(url.path)
+            if match:
+                order_id = int(match.group(2))
+                if order_id not in account.orders:
+                    return self.send_json(404, {'error': 'Order not found'})
+                if method == 'GET':
+                    return self.send_json(200, account.orders[order_id])
+                if method == 'DELETE':
+                    return self.send_json(200 if account.cancel(order_id) else 400)
+                if method == 'PUT':
+                    order = account.replace(order_id, self.read_json())
+                    if order is None:
+                        return self.send_json(400, {'error': 'Order cannot be replaced'})
+                    return self.send_json(201, headers={'Location': LOCATION_URL % (account.account_id, order['orderId'])})
+
+        return self.send_json(404, {'error': 'Not found'})
+
+    @classmethod
+    def stats(cls):
+        with cls.account.lock:
+            latencies = sorted(cls.account.fill_to_stop)
+            return {'spx': round(cls.account.spx, 2), 'positions': len(cls.account.positions), 'orders': len(cls.account.orders),
+                    'unprotected_fills': len(cls.account.unprotected_fills), 'webhook_messages': len(cls.webhook_messages),
+                    'fill_to_stop_count': len(latencies),
+                    'fill_to_stop_mean': round(sum(latencies) / len(latencies), 3) if latencies else None,
+                    'fill_to_stop_p50': round(latencies[len(latencies) // 2], 3) if latencies else None,
+                    'fill_to_stop_max': round(latencies[-1], 3) if latencies else None,
+                    **cls.faults.counters}
+
+    def do_GET(self):
+        self.handle_api('GET')
+
+    def do_POST(self):
+        self.handle_api('POST')
+
+    def do_PUT(self):
+        self.handle_api('PUT')
+
+    def do_DELETE(self):
+        self.handle_api('DELETE')
+
+    # Keep the console for the stats
+    def log_message(self, format, *args):
+        return
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Local stand-in for the TDA account and order endpoints.')
+    parser.add_argument('--host', default='localhost')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--account-id', default='123456789')
+    parser.add_argument('--positions', type=int, default=10, help='short option positions in the seeded account')
+    parser.add_argument('--orders', type=int, default=40, help='order strategies in the seeded account')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--fill-rate', type=float, default=0.1, help='new short fills per second')
+    parser.add_argument('--latency', type=float, default=0.0, help='seconds added to every response')
+    parser.add_argument('--jitter', type=float, default=0.0, help='random seconds added on top of --latency')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='fraction of requests answered with a 500')
+    parser.add_argument('--timeout-rate', type=float, default=0.0, help='fraction of requests that hang for --timeout-seconds')
+    parser.add_argument('--timeout-seconds', type=float, default=30.0)
+    parser.add_argument('--rate-limit', type=int, default=120, help='requests per minute before answering 429, 0 disables it')
+    parser.add_argument('--stats-interval', type=float, default=10.0, help='seconds between stats printouts')
+    args = parser.parse_args()
+
+    FakeTDAHandler.account = FakeAccount(args.account_id, args.positions, args.orders, args.seed)
+    FakeTDAHandler.faults = FaultInjector(args.latency, args.jitter, args.error_rate, args.timeout_rate, args.timeout_seconds, args.rate_limit)
+
+    threading.Thread(target=FakeTDAHandler.account.run_market, args=(args.fill_rate,), daemon=True).start()
+
+    server = ThreadingHTTPServer((args.host, args.port), FakeTDAHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    print("Fake TDA server listening on http://%s:%d account %s" % (args.host, args.port, args.account_id))
+
+    try:
+        while True:
+            time.sleep(args.stats_interval)
+            print(json.dumps(FakeTDAHandler.stats()))
+    except KeyboardInterrupt:
+        server.shutdown()
@@ -0,0 +1,270 @@
+###########################################################
+#       Record and replay of TD API exchanges
+###########################################################
+# RecordingClient wraps a TD client and appends every get_account, place_order and
+# replace_order exchange (time, account, status, Location header, JSON body, order
+# spec) to a JSON lines log, gzip compressed when the file name ends in .gz. Enable it
+# with config.RECORD_LOG, it applies to the threaded monitor, which then fetches the
+# orders book in full (config.ORDER_FETCH_MODE 'incremental' is ignored).
+#
+# ReplayClient serves a recorded log back through the same calls, so the monitor
+# code runs unchanged. At speed 1 each get_account returns the account as it was at
+# the same time into the recorded session, at speed N the session runs N times
+# faster, and at speed 0 every recorded snapshot is returned once, back to back.
+# place_order and replace_order return the recorded responses in order (so rejected
+# orders and 429s are reproduced) and keep the orders the replayed monitor submitted.
+#
+# Usage:
+#   python record_replay.py session.jsonl.gz --speed 0 --stop-type Fix --stop-trigger 5 --submit
+#
+import argparse
+import gzip
+import json
+import threading
+import time
+
+import httpx
+from tda.client import Client
+
+from submission_journal import SubmissionJournal
+
+LOG_URL = 'https://api.tdameritrade.com/v1/accounts/'
+
+
+def open_log(path, mode):
+    if path.endswith('.gz'):
+        return gzip.open(path, mode + 't', encoding='utf-8')
+    return open(path, mode, encoding='utf-8')
+
+def load_log(path):
+    entries = []
+    with open_log(path, 'r') as file:
+        for line in file:
+            line = line.strip()
+            if line:
+                entries.append(json.loads(line))
+    return entries
+
+def response_body(response):
+    try:
+        return response.json()
+    except ValueError:
+        return None
+
+
+class RecordingClient:
+    def __init__(self, client, path):
+        self.client = client
+        self.path = path
+        self._file = open_log(path, 'a')
+        self._lock = threading.Lock()
+
+    # Everything that is not recorded goes straight to the wrapped client
+    def __getattr__(self, name):
+        return getattr(self.client, name)
+
+    def write(self, call, account_id, response=None, error=None, request=None):
+        entry = {'t': round(time.time(), 3), 'call': call, 'account': str(account_id)}
+        if response is not None:
+            entry['status'] = response.status_code
+            if 'Location' in response.headers:
+                entry['location'] = response.headers['Location']
+            entry['body'] = response_body(response)
+        if error is not None:
+            entry['error'] = repr(error)
+        if request is not None:
+            entry['request'] = request
+
+        line = json.dumps(entry, separators=(',', ':'))
+        with self._lock:
+            self._file.write(line + '\n')
+            self._file.flush()
+
+    def get_account(self, account_id, *, fields=None):
+        try:
+            response = self.client.get_account(account_id, fields=fields)
+        except (httpx.ConnectError, httpx.TimeoutException) as e:
+            self.write('get_account', account_id, error=e)
+            raise
+        self.write('get_account', account_id, response)
+        return response
+
+    def place_order(self, account_id, order_spec):
+        request = order_spec.build() if hasattr(order_spec, 'build') else order_spec
+        try:
+            response = self.client.place_order(account_id, order_spec)
+        except (httpx.ConnectError, httpx.TimeoutException) as e:
+            self.write('place_order', account_id, error=e, request=request)
+            raise
+        self.write('place_order', account_id, response, request=request)
+        return response
+
+    def replace_order(self, account_id, order_id, order_spec):
+        request = order_spec.build() if hasattr(order_spec, 'build') else order_spec
+        request = {'replaces': order_id, 'order': request}
+        try:
+            response = self.client.replace_order(account_id, order_id, order_spec)
+        except (httpx.ConnectError, httpx.TimeoutException) as e:
+            self.write('replace_order', account_id, error=e, request=request)
+            raise
+        self.write('replace_order', account_id, response, request=request)
+        return response
+
+    def close(self):
+        with self._lock:
+            self._file.close()
+
+
+class ReplayClient:
+    # The monitor builds its Fields through client.Account
+    Account = Client.Account
+
+    def __init__(self, path, speed=1.0):
+        entries = load_log(path)
+        self.accounts = [entry for entry in entries if entry['call'] == 'get_account']
+        self.recorded_orders = [entry for entry in entries if entry['call'] in ('place_order', 'replace_order')]
+        self.speed = speed
+
+        self.placed = []            # order specs submitted by the replayed monitor
+        self.finished = threading.Event()
+        self._position = 0
+        self._next_order = 0
+        self._next_order_id = 1
+        self._start = None
+        self._lock = threading.Lock()
+
+        if len(self.accounts) == 0:
+            self.finished.set()
+
+    @staticmethod
+    def response(method, url, entry):
+        if 'error' in entry:
+            raise httpx.ConnectError(entry['error'])
+        headers = {'Location': entry['location']} if 'location' in entry else {}
+        body = entry.get('body')
+        content = b'' if body is None else json.dumps(body).encode()
+        return httpx.Response(entry['status'], content=content, headers=headers, request=httpx.Request(method, url))
+
+    # Index of the account entry to serve now
+    def next_account(self):
+        if self.speed <= 0:
+            return self._position
+
+        now = time.monotonic()
+        if self._start is None:
+            self._start = now
+        session_time = self.accounts[0]['t'] + (now - self._start) * self.speed
+
+        position = self._position
+        while position + 1 < len(self.accounts) and self.accounts[position + 1]['t'] <= session_time:
+            position = position + 1
+        return position
+
+    def get_account(self, account_id, *, fields=None):
+        with self._lock:
+            if len(self.accounts) == 0:
+                raise httpx.ConnectError('Replay log has no get_account exchanges')
+
+            position = self.next_account()
+            entry = self.accounts[position]
+            self._position = min(position + 1, len(self.accounts) - 1) if self.speed <= 0 else position
+            if position == len(self.accounts) - 1:
+                self.finished.set()
+
+        return self.response('GET', LOG_URL + str(account_id), entry)
+
+    def place_order(self, account_id, order_spec):
+        request = order_spec.build() if hasattr(order_spec, 'build') else order_spec
+        return self.submit(account_id, request, 'POST', LOG_URL + str(account_id) + '/orders')
+
+    def replace_order(self, account_id, order_id, order_spec):
+        request = order_spec.build() if hasattr(order_spec, 'build') else order_spec
+        return self.submit(account_id, {'replaces': order_id, 'order': request}, 'PUT', LOG_URL + str(account_id) + '/orders/' + str(order_id))
+
+    def submit(self, account_id, request, method, url):
+        with self._lock:
+            self.placed.append(request)
+            if self._next_order < len(self.recorded_orders):
+                entry = dict(self.recorded_orders[self._next_order])
+                self._next_order = self._next_order + 1
+            else:
+                entry = {'status': 201}
+
+            # Order IDs follow the replayed account so Utils.extract_order_id accepts them
+            if entry.get('status', 500) < 400:
+                entry['location'] = LOG_URL + str(account_id) + '/orders/' + str(self._next_order_id)
+                self._next_order_id = self._next_order_id + 1
+
+        return self.response(method, url, entry)
+
+
+###########################################################
+#       Replays a recorded session through the monitor
+###########################################################
+# Runs the stop monitor cycle (run_stop_cycle + submit_stop_batch, as stop_monitor does)
+# on every snapshot served by the ReplayClient and reports the throughput.
+#
+# Returns:
+#   stats: dictionary with the number of snapshots, cycles, stops and elapsed time
+#
+def replay_session(path, speed, stop_type, stop_trigger, submit_stop_orders, loop_timer=1.0):
+    import stoploss_monitor_standalone as monitor
+
+    client = ReplayClient(path, speed)
+
+    # Recorded calls are not rate limited
+    monitor.request_budget = monitor.RequestBudget(60 * 1000 * 1000, 1000 * 1000)
+
+    # Replayed submissions must not cover, or be covered by, the live journal
+    monitor.submission_journal = SubmissionJournal(':memory:', monitor.config.SUBMISSION_TTL_SECONDS)
+
+    # Logs hold the exchanges of one account
+    account_id = client.accounts[0]['account'] if client.accounts else None
+    # Logs only hold get_account exchanges, so the orders book is always fetched in full
+    snapshots = monitor.AccountSnapshotService(client, loop_timer, account_id, order_fetch_mode='full')
+    order_index = monitor.OrderBookIndex()
+    num_snapshots = 0
+    num_cycles = 0
+    num_stops = 0
+
+    start = time.perf_counter()
+    while True:
+        snapshot = snapshots.fetch()
+        if snapshot is not None:
+            num_snapshots = num_snapshots + 1
+            with monitor.stage_timer('cycle'):
+                stop_requests = monitor.run_stop_cycle(order_index, snapshot, stop_type, stop_trigger)
+            if stop_requests is not None:
+                num_cycles = num_cycles + 1
+            if stop_requests and submit_stop_orders:
+                with monitor.stage_timer('submit'):
+                    num_stops = num_stops + len(monitor.submit_stop_batch(client, account_id, stop_requests))
+
+        if client.finished.is_set():
+            break
+        if speed > 0:
+            time.sleep(loop_timer / speed)
+    elapsed = time.perf_counter() - start
+
+    return {'snapshots': num_snapshots, 'cycles': num_cycles, 'stops_submitted': num_stops,
+            'stops_recorded': len(client.recorded_orders), 'elapsed_seconds': round(elapsed, 3),
+            'snapshots_per_second': round(num_snapshots / elapsed, 1) if elapsed > 0 else None}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Replays a recorded TD API session through the stop monitor.')
+    parser.add_argument('log', help='log written with config.RECORD_LOG')
+    parser.add_argument('--speed', type=float, default=0, help='1 replays in real time, 0 as fast as possible')
+    parser.add_argument('--stop-type', default='Fix', choices=['Fix', 'Multiplier'])
+    parser.add_argument('--stop-trigger', default='5')
+    parser.add_argument('--submit', action='store_true', help='submit missing stops to the replay client')
+    parser.add_argument('--loop-timer', type=float, default=1.0, help='seconds between polls in the replayed session')
+    args = parser.parse_args()
+
+    import stoploss_monitor_standalone as monitor
+    log_listener = monitor.setup_logging()
+    stats = replay_session(args.log, args.speed, args.stop_type, args.stop_trigger, args.submit, args.loop_timer)
+    log_listener.stop()
+
+    print(json.dumps(stats, indent=2))
+    print(monitor.metrics.render())
@@ -1,52 +1,620 @@
 import os
 from os.path import exists
-import PySimpleGUI as sg
-import pandas as pd
+import importlib
+import importlib.util
+import tempfile
 
 import config
 import time
-from datetime import datetime, timedelta
+from datetime import datetime, timedelta, timezone
 import httpx
 import sys
 import json
-
-from tda import orders, utils, auth
-from tda.orders.options import bull_put_vertical_open, bull_put_vertical_close, option_buy_to_close_stop
-from tda.orders.generic import OrderBuilder
-from tda.auth import easy_client
-from tda.client import Client
-from tda.utils import Utils
+import asyncio
 
 # For threading
 import threading
 from threading import Event
+from concurrent.futures import ThreadPoolExecutor
+from collections import namedtuple, deque
+from bisect import bisect_left, bisect_right
+from zoneinfo import ZoneInfo
+from contextlib import contextmanager
+
+# For the metrics endpoint
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# For logging
+import logging
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
 
 # For discord notifications
-from discordwebhook import Discord      # for sending messages to discord
-# For discord notifications
-from discordwebhook import Discord
+import queue
+
+# For journaling the STOP order submissions
+from submission_journal import SubmissionJournal
 
 # GLobal Variables
-# Important: Change the following link to your own discord webhook
-discord = Discord(url=config.DISCORD_HOOK)
+logger = logging.getLogger('theWatcher')
+
+########################################################### 
+#           Lazily imported modules
+########################################################### 
+# pandas and PySimpleGUI take most of the import time of this module, and the GUI is
+# not needed at all by the tools that import it (benchmarks, replay, headless runs).
+# They are imported on first use. main imports pandas in the background while it
+# logs in and fetches the first snapshots (see preload_modules). The tda package is
+# imported by the functions that use it.
+#
+# Measure with: python bench_import.py
+#
+class LazyModule:
+    def __init__(self, name):
+        self.name = name
+        self.module = None
+
+    def __getattr__(self, attr):
+        if self.module is None:
+            self.module = importlib.import_module(self.name)
+        return getattr(self.module, attr)
+
+pd = LazyModule('pandas')
+sg = LazyModule('PySimpleGUI')
+
+def preload_modules(names=('pandas', 'tda.client', 'tda.orders.options')):
+    for name in names:
+        importlib.import_module(name)
 
  # 0: No notifications will be sent to discord, 1: will only send important notifications, 2: will send notifications for all actions
 discord_notification_level = 0                  
 
+########################################################### 
+#           Logging
+########################################################### 
+# Log records are handed to a queue and written by a QueueListener thread, so the
+# monitors never wait on the console or the disk. The listener writes to the
+# console and to a rotating config.TRADE_LOG file.
+#
+# Use lazy formatting (logger.info("x = %s", x)) so messages below the configured
+# level cost nothing. DataFrames are only dumped at DEBUG level, or at INFO level
+# when the account state changed (see log_table).
+#
+LOG_FORMAT = '%(asctime)s %(levelname)s [%(threadName)s] %(message)s'
+
+def setup_logging(level=None):
+    if level is None:
+        level = config.LOG_LEVEL
+
+    formatter = logging.Formatter(LOG_FORMAT)
+    file_handler = RotatingFileHandler(config.TRADE_LOG, maxBytes=config.LOG_MAX_BYTES, backupCount=config.LOG_BACKUP_COUNT)
+    file_handler.setFormatter(formatter)
+    console_handler = logging.StreamHandler(sys.stdout)
+    console_handler.setFormatter(formatter)
+
+    log_queue = queue.SimpleQueue()
+    listener = QueueListener(log_queue, file_handler, console_handler)
+    listener.start()
+
+    logger.addHandler(QueueHandler(log_queue))
+    logger.setLevel(level)
+    logger.propagate = False
+
+    return listener
+
+def table_logging_enabled(changed):
+    return logger.isEnabledFor(logging.INFO if changed else logging.DEBUG)
+
+def log_table(title, df, changed=False):
+    if table_logging_enabled(changed):
+        logger.log(logging.INFO if changed else logging.DEBUG, "%s\n%s", title, df)
+
+
+########################################################### 
+#           Metrics
+########################################################### 
+# In-process counters, gauges and latency histograms, exposed in Prometheus text
+# format on http://127.0.0.1:<config.METRICS_PORT>/metrics by start_metrics_server().
+#
+# stage_timer('<stage>') records how long each stage of a monitor cycle takes
+# into the watcher_stage_seconds histogram.
+#
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+class Histogram:
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.count = self.count + 1
+        self.sum = self.sum + value
+        for i in range(0, len(self.buckets)):
+            if value <= self.buckets[i]:
+                self.counts[i] = self.counts[i] + 1
+
+class MetricsRegistry:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.help = {}
+        self.counters = {}          # (name, labels) -> value
+        self.histograms = {}        # (name, labels) -> Histogram
+        self.gauges = {}            # (name, labels) -> value
+        self.collectors = []        # callables returning a list of (name, labels, value) gauges
+
+    def describe(self, name, text):
+        self.help[name] = text
+
+    def inc(self, name, amount=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + amount
+
+    def set(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.gauges[key] = value
+
+    def observe(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            if key not in self.histograms:
+                self.histograms[key] = Histogram()
+            self.histograms[key].observe(value)
+
+    def render(self):
+        lines = []
+
+        def label_text(labels, extra=()):
+            items = list(labels) + list(extra)
+            if len(items) == 0:
+                return ''
+            return '{' + ','.join('%s="%s"' % (key, value) for key, value in items) + '}'
+
+        def header(name, metric_type, written):
+            if (name, metric_type) not in written:
+                written.add((name, metric_type))
+                if name in self.help:
+                    lines.append('# HELP %s %s' % (name, self.help[name]))
+                lines.append('# TYPE %s %s' % (name, metric_type))
+
+        # Collectors can take locks of their own, they are called outside of self.lock
+        collected = {}
+        for collector in list(self.collectors):
+            for name, labels, value in collector():
+                collected[(name, tuple(sorted(labels.items())))] = value
+
+        with self.lock:
+            gauges = dict(self.gauges)
+            gauges.update(collected)
+            written = set()
+            for (name, labels), value in sorted(self.counters.items()):
+                header(name, 'counter', written)
+                lines.append('%s%s %s' % (name, label_text(labels), value))
+
+            for (name, labels), value in sorted(gauges.items()):
+                header(name, 'gauge', written)
+                lines.append('%s%s %s' % (name, label_text(labels), value))
+
+            for (name, labels), histogram in sorted(self.histograms.items()):
+                header(name, 'histogram', written)
+                for bucket, count in zip(histogram.buckets, histogram.counts):
+                    lines.append('%s_bucket%s %d' % (name, label_text(labels, [('le', bucket)]), count))
+                lines.append('%s_bucket%s %d' % (name, label_text(labels, [('le', '+Inf')]), histogram.count))
+                lines.append('%s_sum%s %f' % (name, label_text(labels), histogram.sum))
+                lines.append('%s_count%s %d' % (name, label_text(labels), histogram.count))
+
+        return '\n'.join(lines) + '\n'
+
+metrics = MetricsRegistry()
+metrics.describe('watcher_stage_seconds', 'Duration of each stage of a monitor cycle')
+metrics.describe('watcher_fill_to_stop_seconds', 'Time from a short being filled to its STOP order being placed')
+metrics.describe('watcher_cycles_total', 'Monitor cycles that ran a reconciliation')
+metrics.describe('watcher_api_errors_total', 'TD API calls that failed or returned an error status')
+metrics.describe('watcher_stops_placed_total', 'STOP orders placed')
+metrics.describe('watcher_stops_replaced_total', 'STOP orders replaced to fix their quantity')
+metrics.describe('watcher_stop_mismatches_total', 'Symbols whose STOP quantity did not match the short quantity')
+metrics.describe('watcher_stops_missing_total', 'Short positions found without a STOP')
+metrics.describe('watcher_fetch_bytes_total', 'Bytes of account and order responses received')
+metrics.describe('watcher_fetch_bytes_last', 'Bytes of account and order responses received by the last fetch of the account')
+metrics.describe('watcher_worker_restarts_total', 'Supervised workers restarted after failing or returning')
+metrics.describe('watcher_stops_in_flight_total', 'Missing STOPs not placed again because a submission is still in flight')
+
+@contextmanager
+def stage_timer(stage):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        metrics.observe('watcher_stage_seconds', time.perf_counter() - start, stage=stage)
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split('?')[0] != '/metrics':
+            self.send_error(404)
+            return
+
+        body = metrics.render().encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logger.debug("metrics: " + format, *args)
+
+# Serves the metrics on 127.0.0.1 from a daemon thread. Returns the server, or None if disabled
+# or if the port is taken (e.g. by another instance monitoring other accounts).
+def start_metrics_server(port=None):
+    if port is None:
+        port = config.METRICS_PORT
+    if not port:
+        return None
+
+    try:
+        server = ThreadingHTTPServer(('127.0.0.1', port), MetricsHandler)
+    except OSError as e:
+        logger.warning("Metrics not available, port %d cannot be used: %r", port, e)
+        return None
+    threading.Thread(target=server.serve_forever, name='metrics', daemon=True).start()
+    logger.info("Metrics available at http://127.0.0.1:%d/metrics", port)
+    return server
+
+
+########################################################### 
+#           Discord notification pipeline
+########################################################### 
+# notify() only puts the message on a bounded queue and returns right away, so the
+# trading path never waits on discord. One background thread per process (run(),
+# also used by the asyncio engine, so the queue has a single consumer) collects
+# messages for config.NOTIFY_WINDOW_SECONDS and posts them to the webhook as one batch:
+#   - identical messages within a window are merged into one line ("... (x3)")
+#   - a message already sent less than config.NOTIFY_REPEAT_SECONDS ago is held back
+#     and counted, so "Stop is missing for option: X" is not re-sent on every tick
+#   - when the queue is full new messages are dropped and counted as overflow
+#
+# The webhook is a plain HTTP POST of {"content": ...} to config.DISCORD_HOOK, so
+# it can be pointed at any local HTTP stand-in for testing.
+#
+DISCORD_MAX_CONTENT = 1900      # discord rejects messages longer than 2000 characters
+
+class NotificationPipeline:
+    def __init__(self, url, max_queue, window_seconds, repeat_seconds):
+        self.url = url
+        self.window_seconds = window_seconds
+        self.repeat_seconds = repeat_seconds
+        self.queue = queue.Queue(maxsize=max_queue)
+
+        self.last_sent = {}         # message -> time.monotonic() it was last sent
+        self.held_back = {}         # message -> number of repeats not sent yet
+        self.thread = None
+        self.stop_event = None
+        self.lock = threading.Lock()
+
+        # Counters for monitoring
+        self.num_submitted = 0
+        self.num_sent = 0
+        self.num_merged = 0
+        self.num_overflow = 0
+        self.num_failed = 0
+
+    def submit(self, message):
+        self.num_submitted = self.num_submitted + 1
+        try:
+            self.queue.put_nowait(message)
+        except queue.Full:
+            self.num_overflow = self.num_overflow + 1
+
+    # Takes everything currently queued and returns the lines to send
+    def drain(self):
+        counts = {}
+        while True:
+            try:
+                message = self.queue.get_nowait()
+            except queue.Empty:
+                break
+            counts[message] = counts.get(message, 0) + 1
+
+        now = time.monotonic()
+        lines = []
+        for message, count in counts.items():
+            self.num_merged = self.num_merged + count - 1
+
+            if now - self.last_sent.get(message, -self.repeat_seconds) < self.repeat_seconds:
+                self.held_back[message] = self.held_back.get(message, 0) + count
+                self.num_merged = self.num_merged + 1
+                continue
+
+            count = count + self.held_back.pop(message, 0)
+            self.last_sent[message] = now
+            lines.append(message if count == 1 else message + " (x" + str(count) + ")")
+
+        # Repeats that were held back and did not come up again
+        for message in [message for message in self.held_back if now - self.last_sent[message] >= self.repeat_seconds]:
+            count = self.held_back.pop(message)
+            self.last_sent[message] = now
+            lines.append(message + " (repeated x" + str(count) + ")")
+
+        return lines
+
+    # Splits the lines into discord sized messages
+    def batches(self, lines):
+        batch = ""
+        for line in lines:
+            if len(batch) > 0 and len(batch) + len(line) + 1 > DISCORD_MAX_CONTENT:
+                yield batch
+                batch = ""
+            batch = line[:DISCORD_MAX_CONTENT] if len(batch) == 0 else batch + "\n" + line
+        if len(batch) > 0:
+            yield batch
+
+    def deliver(self, http, lines):
+        for content in self.batches(lines):
+            num_lines = content.count("\n") + 1
+            try:
+                r = http.post(self.url, json={'content': content})
+                if r.status_code == 429:
+                    # Rate limited by discord, wait as requested and retry once
+                    time.sleep(float(r.json().get('retry_after', 1.0)))
+                    r = http.post(self.url, json={'content': content})
+            except httpx.HTTPError as e:
+                logger.warning("Failed to send notification: %r", e)
+                self.num_failed = self.num_failed + num_lines
+                continue
+
+            if r.status_code < 400:
+                self.num_sent = self.num_sent + num_lines
+            else:
+                logger.warning("Failed to send notification, status code: %s", r.status_code)
+                self.num_failed = self.num_failed + num_lines
+
+    # Messages still queued when the event is set are sent before the thread ends
+    def run(self, event):
+        with httpx.Client(timeout=10.0) as http:
+            while True:
+                stopping = event.wait(self.window_seconds)
+                lines = self.drain()
+                if len(lines) > 0:
+                    self.deliver(http, lines)
+                if stopping:
+                    break
+
+    # Starts the delivery thread, unless it is already running
+    def start(self):
+        with self.lock:
+            if self.thread is None or not self.thread.is_alive():
+                self.stop_event = Event()
+                self.thread = threading.Thread(target=self.run, args=(self.stop_event,), name='notifications', daemon=True)
+                self.thread.start()
+
+    def stop(self, timeout=None):
+        with self.lock:
+            thread = self.thread
+            if thread is None:
+                return
+            self.stop_event.set()
+            self.thread = None
+        thread.join(timeout)
+
+    def stats(self):
+        return {'submitted': self.num_submitted, 'sent': self.num_sent, 'merged': self.num_merged,
+                'overflow': self.num_overflow, 'failed': self.num_failed, 'queued': self.queue.qsize()}
+
+# Important: Change config.DISCORD_HOOK to your own discord webhook
+notifications = NotificationPipeline(config.DISCORD_HOOK, config.NOTIFY_MAX_QUEUE, config.NOTIFY_WINDOW_SECONDS, config.NOTIFY_REPEAT_SECONDS)
+metrics.collectors.append(lambda: [('watcher_notifications_' + key, {}, value) for key, value in notifications.stats().items()])
+
+########################################################### 
+#           Sends a notification to discord
+########################################################### 
+# Needs:
+#   message: text to send
+#   level: 1 for important notifications, 2 for notifications of all actions
+#
+def notify(message, level=1):
+    if discord_notification_level < level:
+        return
+
+    notifications.submit(message)
+
 ########################################################### 
 #           Returns TD Client 
 ########################################################### 
 # Setup TD Client. It will use the token and if token is expired the login window will pop up.
 # Requirements: a config file with user credentials
-def create_td_client() :
-    try:
-        client = easy_client(api_key=config.API_KEY, redirect_uri=config.REDIRECT_URI, token_path=config.TOKEN_PATH)
-    except FileNotFoundError:
-        from selenium import webdriver
-        with webdriver.Chrome() as driver:
-            client = client_from_login_flow(driver, api_key=config.API_KEY, redirect_uri=config.REDIRECT_URI, token_path=config.TOKEN_PATH)  
-
-    return client
+#
+# The clients come from one process-wide ClientFactory (client_factory):
+#   - the token is read, and the login window can only pop up, the first time the sync
+#     client is created, which main does at startup. Later calls return the same client.
+#   - the sync client sends its requests through one keep-alive connection pool,
+#     HTTP/2 when the h2 package is installed, sized by config.HTTP_*
+#   - an httpx async pool is bound to the event loop it was first used on, and every
+#     start of the asyncio engine runs a new loop. async_client() therefore builds a
+#     new async client (same pool settings, the sync client's token) for each loop,
+#     and run_async_engine closes it when its loop ends.
+#   - a background thread refreshes the access token config.TOKEN_REFRESH_MARGIN_SECONDS
+#     before it expires, so no monitor request waits on a refresh, and hands the new
+#     token to the open async clients too
+#   - watcher_token_expires_seconds and watcher_refresh_token_expires_seconds report
+#     the time left on the access and refresh tokens
+#
+# With config.TDA_BASE_URL set (e.g. fake_tda_server.py), the client sends every request
+# to that server instead of api.tdameritrade.com and no token is needed.
+#
+TDA_TOKEN_ENDPOINT = 'https://api.tdameritrade.com/v1/oauth2/token'
+REFRESH_TOKEN_DAYS = 90
+
+class BaseURLTransport(httpx.HTTPTransport):
+    def __init__(self, base_url, **kwargs):
+        super().__init__(**kwargs)
+        self.base_url = httpx.URL(base_url)
+
+    def handle_request(self, request):
+        request.url = request.url.copy_with(scheme=self.base_url.scheme, host=self.base_url.host, port=self.base_url.port)
+        return super().handle_request(request)
+
+class AsyncBaseURLTransport(httpx.AsyncHTTPTransport):
+    def __init__(self, base_url, **kwargs):
+        super().__init__(**kwargs)
+        self.base_url = httpx.URL(base_url)
+
+    async def handle_async_request(self, request):
+        request.url = request.url.copy_with(scheme=self.base_url.scheme, host=self.base_url.host, port=self.base_url.port)
+        return await super().handle_async_request(request)
+
+# HTTP/2 needs the optional h2 package, HTTP/1.1 keep-alive is used without it
+def http2_available():
+    return importlib.util.find_spec('h2') is not None
+
+def http_pool_options():
+    limits = httpx.Limits(max_connections=config.HTTP_MAX_CONNECTIONS, max_keepalive_connections=config.HTTP_MAX_KEEPALIVE_CONNECTIONS,
+                          keepalive_expiry=config.HTTP_KEEPALIVE_SECONDS)
+    return {'limits': limits, 'http2': http2_available()}
+
+class ClientFactory:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.sync_client = None
+        self.async_clients = []     # async clients of the event loops still running
+        self.refresh_thread = None
+
+    def client(self):
+        with self.lock:
+            if self.sync_client is None:
+                self.sync_client = self.create()
+            return self.sync_client
+
+    def create(self):
+        from tda.client import Client
+
+        if config.TDA_BASE_URL:
+            return Client(config.API_KEY, httpx.Client(transport=BaseURLTransport(config.TDA_BASE_URL, **http_pool_options()),
+                                                       timeout=httpx.Timeout(config.HTTP_TIMEOUT_SECONDS)))
+        return self.login()
+
+    # A new async client for the event loop about to run. Release it with close_async_client()
+    # from that loop before the loop ends.
+    def async_client(self):
+        from tda.client import AsyncClient
+
+        timeout = httpx.Timeout(config.HTTP_TIMEOUT_SECONDS)
+        if config.TDA_BASE_URL:
+            return AsyncClient(config.API_KEY, httpx.AsyncClient(transport=AsyncBaseURLTransport(config.TDA_BASE_URL, **http_pool_options()), timeout=timeout))
+
+        # The token is only read (or the login flow run) for the sync client. The async
+        # client starts from the sync client's token and writes refreshed tokens the same way.
+        client = self.client()
+
+        from authlib.integrations.httpx_client import AsyncOAuth2Client
+        update_token = client.session.update_token
+
+        async def async_update_token(token, *args, **kwargs):
+            update_token(token, *args, **kwargs)
+
+        session = AsyncOAuth2Client(config.API_KEY, token=dict(client.session.token), token_endpoint=TDA_TOKEN_ENDPOINT,
+                                    update_token=async_update_token, timeout=timeout, **http_pool_options())
+        async_client = AsyncClient(config.API_KEY, session, token_metadata=getattr(client, 'token_metadata', None))
+        with self.lock:
+            self.async_clients.append(async_client)
+        return async_client
+
+    async def close_async_client(self, async_client):
+        with self.lock:
+            if async_client in self.async_clients:
+                self.async_clients.remove(async_client)
+        await async_client.session.aclose()
+
+    def login(self):
+        from tda import auth
+
+        try:
+            client = auth.easy_client(api_key=config.API_KEY, redirect_uri=config.REDIRECT_URI, token_path=config.TOKEN_PATH)
+        except FileNotFoundError:
+            from selenium import webdriver
+            with webdriver.Chrome() as driver:
+                client = auth.client_from_login_flow(driver, api_key=config.API_KEY, redirect_uri=config.REDIRECT_URI, token_path=config.TOKEN_PATH)
+
+        # tda-api builds its session with the httpx defaults, move the token to the tuned pool
+        from authlib.integrations.httpx_client import OAuth2Client
+        session = client.session
+        client.session = OAuth2Client(config.API_KEY, token=dict(session.token), token_endpoint=TDA_TOKEN_ENDPOINT,
+                                      update_token=session.update_token, timeout=httpx.Timeout(config.HTTP_TIMEOUT_SECONDS), **http_pool_options())
+        session.close()
+        return client
+
+    # Seconds left on the access token, None without a token (e.g. config.TDA_BASE_URL)
+    def token_expires_in(self, now=None):
+        client = self.sync_client
+        token = getattr(getattr(client, 'session', None), 'token', None)
+        if not token or 'expires_at' not in token:
+            return None
+        return token['expires_at'] - (time.time() if now is None else now)
+
+    def refresh_token_expires_in(self, now=None):
+        creation_timestamp = getattr(getattr(self.sync_client, 'token_metadata', None), 'creation_timestamp', None)
+        if creation_timestamp is None:
+            return None
+        return creation_timestamp + REFRESH_TOKEN_DAYS * 24 * 3600 - (time.time() if now is None else now)
+
+    # Refreshes the access token of the sync client and hands it to the async clients
+    def refresh(self):
+        client = self.sync_client
+        try:
+            with stage_timer('token_refresh'):
+                client.session.refresh_token(TDA_TOKEN_ENDPOINT)
+        except Exception as e:
+            logger.error("FAILED - refreshing the access token: %r", e)
+            metrics.inc('watcher_api_errors_total', call='refresh_token')
+            return False
+
+        with self.lock:
+            async_clients = list(self.async_clients)
+        for async_client in async_clients:
+            async_client.session.token = dict(client.session.token)
+        logger.info("Access token refreshed, expires in %.0f seconds", self.token_expires_in())
+        return True
+
+    def run(self, event):
+        while not event.is_set():
+            expires_in = self.token_expires_in()
+            if expires_in is None:
+                event.wait(60)
+                continue
+
+            wait = expires_in - config.TOKEN_REFRESH_MARGIN_SECONDS
+            if wait > 0:
+                event.wait(min(wait, 60))
+            elif not self.refresh():
+                event.wait(10)
+
+    # Starts the refresh thread once, it runs for the life of the process
+    def start(self, event):
+        with self.lock:
+            if self.refresh_thread is None and not config.TDA_BASE_URL:
+                self.refresh_thread = threading.Thread(target=self.run, args=(event,), name='token_refresh', daemon=True)
+                self.refresh_thread.start()
+
+    def stats(self):
+        gauges = []
+        expires_in = self.token_expires_in()
+        if expires_in is not None:
+            gauges.append(('watcher_token_expires_seconds', {}, round(expires_in, 1)))
+        refresh_expires_in = self.refresh_token_expires_in()
+        if refresh_expires_in is not None:
+            gauges.append(('watcher_refresh_token_expires_seconds', {}, round(refresh_expires_in, 1)))
+        return gauges
+
+client_factory = ClientFactory()
+metrics.collectors.append(client_factory.stats)
+
+# The sync client is shared by the whole process. An async client is new on every call,
+# see ClientFactory.async_client().
+def create_td_client(use_asyncio=False) :
+    if use_asyncio:
+        return client_factory.async_client()
+    return client_factory.client()
 
 
 ###########################################################
@@ -59,135 +627,407 @@ def check_auth_token():
 
     # print(json.dumps(data, indent=4))
 
-    token_created = pd.to_datetime(data['creation_timestamp'], unit='s')
-    token_expires = token_created + timedelta(days=90)
-    print(" Authentication Token Created: ",  str(token_created), " Will Expire: ", str(token_expires))
+    token_created = datetime.fromtimestamp(data['creation_timestamp'])
+    token_expires = token_created + timedelta(days=REFRESH_TOKEN_DAYS)
+    logger.info("Authentication Token Created: %s Will Expire: %s", token_created, token_expires)
 
     # add warning when nearing expiration
-    if (token_expires < datetime.now() - timedelta(days=7)):
-        print("  --**-- Authorization token expiring soon. Run token_renew.py to renew.")
+    if (token_expires - timedelta(days=7) < datetime.now()):
+        logger.warning("--**-- Authorization token expiring soon. Run token_renew.py to renew.")
     
     return
 
 
 ###########################################################
-#   Converts SPX price to 5 cent units
+#   Parses option symbols
+###########################################################
+# TDA option symbols look like SPXW_051623P4100: root, underscore, expiry as MMDDYY,
+# P or C, and the strike (with decimals when needed, e.g. SPY_051623C410.5).
+# Each symbol is parsed once per process: the contract records are interned in
+# option_contract_cache and shared by every caller.
+#
+# Returns:
+#   contract: an OptionContract (symbol, root, expiry, put_call, strike), or None if
+#             the symbol is not an option symbol
+#
+OptionContract = namedtuple('OptionContract', ['symbol', 'root', 'expiry', 'put_call', 'strike'])
+
+option_contract_cache = {}
+
+def parse_option_symbol(symbol):
+    try:
+        return option_contract_cache[symbol]
+    except KeyError:
+        pass
+
+    contract = None
+    root, _, body = symbol.partition('_')
+    if root and len(body) > 7 and body[6] in ('P', 'C'):
+        try:
+            expiry = datetime.strptime(body[:6], '%m%d%y').date()
+            contract = OptionContract(symbol, root, expiry, 'PUT' if body[6] == 'P' else 'CALL', float(body[7:]))
+        except ValueError:
+            contract = None
+
+    option_contract_cache[symbol] = contract
+    return contract
+
+# Contract fields for a whole pandas column of symbols. Every distinct symbol is looked
+# up once and the results are mapped back on the column.
+#
+# Returns:
+#   df_contracts: a dataframe with keys "root", "expiry", "put_call", "strike", same index as symbols
+#                 (NaN/None for symbols that are not options)
+#
+def option_contracts(symbols):
+    records = {}
+    for symbol in pd.unique(symbols):
+        contract = parse_option_symbol(symbol)
+        records[symbol] = contract[1:] if contract is not None else (None, None, None, float('nan'))
+
+    df_contracts = pd.DataFrame([records[symbol] for symbol in symbols], columns=["root", "expiry", "put_call", "strike"], index=symbols.index)
+    return df_contracts
+
+# Returns the strike of an option symbol such as SPXW_051623P4100, or None
+def option_strike(symbol):
+    contract = parse_option_symbol(symbol)
+    return contract.strike if contract is not None else None
+
+
+###########################################################
+#   Rounds option prices to the tick size
 ###########################################################
-# SPX opotions are priced at 5 cent incrememts, therefore we need to convert
-# prices in nickles. The following function converts a price to the nearest nickle.
+# SPX opotions are priced at 5 cent incrememts below $3.00 and 10 cent increments from
+# $3.00, therefore we need to convert prices in ticks. Other roots default to nickels.
+#
+# OPTION_TICK_SIZES: root -> (price from which the large tick applies, small tick, large tick), in dollars
+#
+OPTION_TICK_SIZES = {
+    'SPX':  (3.0, 0.05, 0.10),
+    'SPXW': (3.0, 0.05, 0.10),
+}
+DEFAULT_TICK_SIZE = (3.0, 0.05, 0.05)
+
+def option_tick_size(symbol, price):
+    contract = parse_option_symbol(symbol) if symbol else None
+    threshold, small_tick, large_tick = OPTION_TICK_SIZES.get(contract.root if contract is not None else None, DEFAULT_TICK_SIZE)
+    return large_tick if price >= threshold else small_tick
+
+###########################################################
+#   Converts SPX price to tick units
+###########################################################
+# The following function converts a price to the nearest tick of the option (a nickle
+# when no symbol is given).
 #
 # Needs
 #     org_price: original price
+#     symbol: option symbol, selects the tick size of its root
 # Returns
-#     new_price: price in 5C units
+#     new_price: price in tick units
 #
-def nicklefy(org_price):
-    new_price = org_price * 100                    # bring up to whole
-    new_price = round(new_price/5, 0) * 5 / 100    # convert to a 5 cent mark
+def nicklefy(org_price, symbol=None):
+    tick = int(round(option_tick_size(symbol, org_price) * 100))
+    new_price = org_price * 100                          # bring up to whole
+    new_price = round(new_price/tick, 0) * tick / 100    # convert to a tick mark
     new_price = round(new_price, 2)
 
     return new_price
 
+# Same as nicklefy() for a whole pandas column, with an optional column of symbols
+def nicklefy_column(prices, symbols=None):
+    if symbols is None:
+        ticks = pd.Series(5, index=prices.index)
+    else:
+        roots = option_contracts(symbols)['root']
+        thresholds = roots.map(lambda root: OPTION_TICK_SIZES.get(root, DEFAULT_TICK_SIZE)[0])
+        small_ticks = roots.map(lambda root: OPTION_TICK_SIZES.get(root, DEFAULT_TICK_SIZE)[1])
+        large_ticks = roots.map(lambda root: OPTION_TICK_SIZES.get(root, DEFAULT_TICK_SIZE)[2])
+        ticks = (large_ticks.where(prices >= thresholds, small_ticks) * 100).round().astype(int)
+
+    return ((prices * 100 / ticks).round(0) * ticks / 100).round(2)
+
+
+########################################################### 
+#           Stop reconciliation
+########################################################### 
+# Builds symbol keyed maps of open shorts and open (not in TERMINAL_ORDER_STATUSES)
+# BUY_TO_CLOSE stop orders once, then classifies every symbol in a single pass:
+#   missing: open short position without any working STOP
+#   mismatched: open short position whose working STOP quantity is lower than the short quantity
+#   over_hedged: open short position whose working STOP quantity is higher than the short quantity
+#   orphaned: working STOP without an open short position
+# Each entry is a StopGap (symbol, short_quantity, stop_quantity, avg_price, stop_orders), where
+# stop_orders lists the (order_id, quantity, stop_price) of the symbol's working STOP orders.
+#
+# Needs:
+#   df_pos: dataframe of open short option positions (see create_option_position_df)
+#   df_stop: dataframe of open orders (see OrderBookIndex.open_frame)
+# Returns:
+#   reconciliation: a StopReconciliation with the lists described above
+#
+StopGap = namedtuple('StopGap', ['symbol', 'short_quantity', 'stop_quantity', 'avg_price', 'stop_orders'], defaults=[()])
+StopReconciliation = namedtuple('StopReconciliation', ['missing', 'mismatched', 'over_hedged', 'orphaned'])
+
+STOP_ORDER_TYPES = ('STOP', 'STOP_LIMIT', 'TRAILING_STOP', 'TRAILING_STOP_LIMIT')
+
+# Statuses an order never leaves. A stop in any other status (WORKING, but also QUEUED, ACCEPTED,
+# PENDING_ACTIVATION, ... while the broker processes it) covers its short.
+TERMINAL_ORDER_STATUSES = ('FILLED', 'CANCELED', 'REJECTED', 'EXPIRED', 'REPLACED')
+
+def reconcile_stops(df_pos, df_stop) :
+    shorts = {}
+    for symbol, quantity, avg_price in zip(df_pos['symbol'], df_pos['shortQuantity'], df_pos['averagePrice']):
+        shorts[symbol] = (int(quantity), float(avg_price))
+
+    stops = {}
+    stop_orders = {}
+    for order_id, symbol, quantity, buy_sell, order_type, stop_price in zip(df_stop['order_id'], df_stop['symbol'], df_stop['quantity'],
+                                                                          df_stop['buy_sell'], df_stop['order_type'], df_stop['stop_price']):
+        if buy_sell == 'BUY_TO_CLOSE' and order_type in STOP_ORDER_TYPES:
+            stops[symbol] = stops.get(symbol, 0) + int(quantity)
+            if order_type == 'STOP':
+                stop_orders.setdefault(symbol, []).append((order_id, int(quantity), stop_price))
+
+    missing = []
+    mismatched = []
+    over_hedged = []
+    for symbol, (short_quantity, avg_price) in shorts.items():
+        stop_quantity = stops.get(symbol, 0)
+        gap = StopGap(symbol, short_quantity, stop_quantity, avg_price, tuple(stop_orders.get(symbol, ())))
+
+        if stop_quantity == 0:
+            missing.append(gap)
+        elif stop_quantity < short_quantity:
+            mismatched.append(gap)
+        elif stop_quantity > short_quantity:
+            over_hedged.append(gap)
+
+    orphaned = [StopGap(symbol, 0, stop_quantity, None, tuple(stop_orders.get(symbol, ()))) for symbol, stop_quantity in stops.items() if symbol not in shorts]
+
+    return StopReconciliation(missing, mismatched, over_hedged, orphaned)
+
+
 ########################################################### 
 #           Finds missing Stops
 ########################################################### 
+# Runs the reconciliation and reports its findings (console and discord).
+#
 # Needs:
-#   open_shorts: list of option symbols for open positions
-#   working_stops: list of option symbols that have WORKING STOP orders in place
+#   df_pos: dataframe of open short option positions
+#   df_stop: dataframe of open orders
 # Returns:
-#   num_missing: number of open positions that have missing Stops
-#   missing_symbols: a list of option symbols that have missing stops
+#   reconciliation: a StopReconciliation, see reconcile_stops()
 #
-def find_missing_stops(qty_open_short_df, qty_work_stop_df, open_shorts, quantity_open_shorts, avg_price_open_shorts, working_stops, quantity_working_stops) :
-    num_missing = 0
-    missing_symbols = []
-    missing_quantity = []
-    missing_avg_price = []
+def find_missing_stops(df_pos, df_stop) :
+    reconciliation = reconcile_stops(df_pos, df_stop)
 
-    num_shorts = len(open_shorts)
-    num_stops = len(working_stops)
-    print("Num Shorts = ", num_shorts)
-    print("Num Stops = ", num_stops)
+    logger.info("Num Shorts = %d Num Stops = %d", len(df_pos), len(df_stop))
 
-    for i in range(0, num_shorts) :
-        
-        if open_shorts[i] in working_stops :
-            print("Stop exists for option: ", open_shorts[i])
+    for gap in reconciliation.missing:
+        logger.warning("Stop is missing for option: %s", gap.symbol)
 
-            if open_shorts[i] in qty_open_short_df['symbol'].values :   
+        # Send notification to discord
+        notify("Stop is missing for option: " + str(gap.symbol))
 
-                # Make sure that the quantity in the working STOP order matches the quantity in the open short positions.
-                # If not, cancel existing SHORT order and resubmit it with the correct quantity.
-                qty_open_short = int(qty_open_short_df.loc[qty_open_short_df['symbol'] == open_shorts[i], 'quantity'].iloc[0])
-                qty_work_stop = int(qty_work_stop_df.loc[qty_work_stop_df['symbol'] == open_shorts[i], 'quantity'].iloc[0])
-                avg_price = float(qty_open_short_df.loc[qty_open_short_df['symbol'] == open_shorts[i], 'price'].iloc[0])
+    for gap in reconciliation.mismatched + reconciliation.over_hedged:
+        logger.warning("Missmatch in quantity between working STOP order and Open Short position for: %s short=%s stop=%s",
+                       gap.symbol, gap.short_quantity, gap.stop_quantity)
 
-                if qty_open_short != qty_work_stop:
-                    print("Missmatch in quantity between working STOP order and Open Short position for: " + str(open_shorts[i]))
+        # Send notification to discord
+        notify("Missmatch in quantity between working STOP order and Open Short position for: " + str(gap.symbol))
 
-                    # Send notification to discord
-                    if discord_notification_level != 0:
-                        discord_message = "Missmatch in quantity between working STOP order and Open Short position for: " + str(open_shorts[i])
-                        discord.post(content=discord_message)
+    for gap in reconciliation.orphaned:
+        logger.warning("Working STOP order without an open short position for: %s stop=%s", gap.symbol, gap.stop_quantity)
 
-                    num_missing = num_missing + 1
-                    missing_symbols.append(open_shorts[i]) 
-                    missing_quantity.append(qty_open_short)
-                    missing_avg_price.append(avg_price)
-            else:
-                print("No order ID found for: ", open_shorts[i], ", will skip this position . . .")
+        # Send notification to discord
+        notify("Working STOP order without an open short position for: " + str(gap.symbol))
 
-        else : 
-            print("Stop is missing for option: ", open_shorts[i])
+    return reconciliation
 
-            # Send notification to discord
-            if discord_notification_level != 0:
-                discord_message = "Stop is missing for option: " + str(open_shorts[i])
-                discord.post(content=discord_message)
 
-            num_missing = num_missing + 1
-            missing_symbols.append(open_shorts[i]) 
-            missing_quantity.append(quantity_open_shorts[i])
-            missing_avg_price.append(avg_price_open_shorts[i])
+########################################################### 
+#           Plans STOP quantity fixes
+########################################################### 
+# A short whose working STOP quantity does not match the open quantity is fixed by
+# replacing one of its STOP orders (the newest one) with the same order at the quantity
+# that closes the gap, so the fix is a single replace_order round trip and no extra stop
+# is stacked on the position. The stop price of the replaced order is kept.
+#
+# Needs:
+#   gaps: mismatched and over-hedged StopGap entries (see reconcile_stops)
+#   fill_times: optional dictionary of the last fill time of each symbol
+# Returns:
+#   replace_requests: list of StopReplaceRequest. Gaps that a single replace cannot fix
+#                     (e.g. several stops must shrink, or only STOP_LIMIT/trailing stops) are
+#                     only reported.
+#
+StopReplaceRequest = namedtuple('StopReplaceRequest', ['symbol', 'quantity', 'trigger', 'order_id', 'old_quantity', 'fill_time'], defaults=[None])
 
-    return num_missing, missing_symbols, missing_quantity, missing_avg_price
+def plan_stop_replacements(gaps, fill_times=None) :
+    fill_times = fill_times or {}
+    replace_requests = []
+    for gap in gaps:
+        stop_orders = [stop_order for stop_order in gap.stop_orders if stop_order[2] is not None]
+        if len(stop_orders) == 0:
+            logger.warning("No STOP order of %s can be replaced to fix its quantity", gap.symbol)
+            continue
 
+        order_id, quantity, stop_price = max(stop_orders)
+        new_quantity = quantity + gap.short_quantity - gap.stop_quantity
+        if new_quantity <= 0:
+            logger.warning("The STOP quantity of %s cannot be fixed with a single replace: short=%s stops=%s",
+                           gap.symbol, gap.short_quantity, gap.stop_orders)
+            continue
 
-def find_itm_short_positions(itm_offset, open_shorts, quantity_open_shorts, working_stops):
-    num_itm = 0
-    itm_symbols = []
-    itm_quantity = []
-    itm_stop_order_id = []
+        replace_requests.append(StopReplaceRequest(gap.symbol, new_quantity, float(stop_price), order_id, quantity, fill_times.get(gap.symbol)))
 
-    num_shorts = len(open_shorts)
-    num_stops = len(working_stops)
-    for i in range(0, num_shorts) :
+    return replace_requests
 
-        strike_short = float(open_shorts[i])
-        SPX_value = float(SPXValue)
-        
-        if abs(SPX_value - strike_short) <= itm_offset:
-            print("ITM protection activated for: ", open_shorts[i])
-            num_itm = num_itm + 1
-            itm_symbols.append(open_shorts[i]) 
-            itm_quantity.append(quantity_open_shorts[i])
-            stop_order_id = find_stop_order_id(open_shorts[i], working_stops)
-            itm_stop_order_id.append(stop_order_id)
 
-    return  num_itm_positions, itm_symbols, itm_quantity, itm_stop_order_id 
+###########################################################
+#   Strike index of the open shorts
+###########################################################
+# Sorts the short option positions by strike, separately for the puts and the calls
+# of each underlying, so the shorts near the underlying price are found with two
+# binary searches: O(log n + k) instead of a scan of every short on each ITM check.
+#
+# Needs:
+#   df_pos: dataframe of open short option positions (see partition_positions)
+#
+class StrikeIndex:
+    def __init__(self, df_pos):
+        sides = {}
+        strikes = option_contracts(df_pos['symbol'])['strike']
+        for symbol, put_call, underlying, quantity, strike in zip(df_pos['symbol'], df_pos['putCall'], df_pos['underlying'], df_pos['shortQuantity'], strikes):
+            if strike != strike:        # NaN, not an option symbol
+                continue
+            sides.setdefault((underlying, put_call), []).append((strike, symbol, int(quantity)))
+
+        # (underlying, putCall) -> (sorted strikes, sorted (strike, symbol, quantity) entries)
+        self.sides = {}
+        for key, entries in sides.items():
+            entries.sort()
+            self.sides[key] = ([entry[0] for entry in entries], entries)
+
+    def underlyings(self):
+        return sorted(set(underlying for underlying, put_call in self.sides))
+
+    # Returns the (strike, symbol, quantity) entries with a strike within offset of price
+    def near(self, underlying, price, offset):
+        result = []
+        for put_call in ('PUT', 'CALL'):
+            side = self.sides.get((underlying, put_call))
+            if side is None:
+                continue
+            strikes, entries = side
+            result.extend(entries[bisect_left(strikes, price - offset):bisect_right(strikes, price + offset)])
+        return result
+
+# The index only changes with the positions, keep the last one of each account together
+# with its snapshot (versions restart at 1 with every AccountSnapshotService)
+strike_index_cache = {}
+
+def snapshot_strike_index(snapshot) :
+    cached = strike_index_cache.get(snapshot.account_id)
+    if cached is not None and cached[0] is snapshot:
+        return cached[1]
+
+    strike_index = StrikeIndex(snapshot_position_tables(snapshot).options)
+    strike_index_cache[snapshot.account_id] = (snapshot, strike_index)
+    return strike_index
+
+
+###########################################################
+#   Finds short positions near the money
+###########################################################
+# Needs:
+#   itm_offset: distance (in points of the underlying) that activates the protection
+#   strike_index: StrikeIndex of the open shorts
+#   orders_list: r['securitiesAccount']['orderStrategies'], to find the working STOP orders to replace
+# Returns:
+#   itm_positions: list of ItmPosition (symbol, quantity, strike, underlying_price, stop_order_ids).
+#                  Underlyings without a fresh quote (config.QUOTE_MAX_AGE_SECONDS) are skipped.
+#
+ItmPosition = namedtuple('ItmPosition', ['symbol', 'quantity', 'strike', 'underlying_price', 'stop_order_ids'])
+
+def find_itm_short_positions(itm_offset, strike_index, orders_list):
+    itm_positions = []
+    for underlying in strike_index.underlyings():
+        price = quote_cache.get(underlying, config.QUOTE_MAX_AGE_SECONDS)
+        if price is None:
+            logger.debug("No fresh quote for %s, ITM check skipped", underlying)
+            continue
+
+        for strike, symbol, quantity in strike_index.near(underlying, price, itm_offset):
+            itm_positions.append(ItmPosition(symbol, quantity, strike, price, []))
+
+    if len(itm_positions) > 0:
+        stop_order_ids = find_stop_order_ids(orders_list)
+        itm_positions = [position._replace(stop_order_ids=stop_order_ids.get(position.symbol, [])) for position in itm_positions]
+
+    return itm_positions
+
+# Returns symbol -> order IDs of the WORKING BUY_TO_CLOSE STOP orders
+def find_stop_order_ids(orders_list):
+    stop_order_ids = {}
+    for order_strat in orders_list:
+        if order_strat['status'] == 'WORKING' and order_strat.get('orderType') in STOP_ORDER_TYPES:
+            for legs in order_strat.get('orderLegCollection', []):
+                if legs['instruction'] == 'BUY_TO_CLOSE':
+                    stop_order_ids.setdefault(legs['instrument']['symbol'], []).append(order_strat['orderId'])
+    return stop_order_ids
 
+###########################################################
+#   Computes STOP triggers for Multiplier mode
+###########################################################
 # Finds STOP trigger based on the average FILL price of a particular order. We may have positions at the same
-# SHORT strike but at different FILL prices.
-def find_num_stops_required(missed_symbol, df_orders):
-    grouped = df_orders.groupby('symbol')
-    num_orders = grouped.get_group(missed_symbol)
-    return len(num_orders)
-
-def find_stop_trigger(multiplier, missed_symbol, df_orders):
-    grouped = df_orders.groupby('symbol')
-    stop_trigger_df = grouped.get_group(missed_symbol).copy()
-    stop_trigger_df['trigger'] = multiplier * stop_trigger_df['price']  # add trigger column to the dataframe
-    return stop_trigger_df
+# SHORT strike but at different FILL prices. All symbols are computed in one grouped pass:
+#   - a symbol filled by a single order (or without a fill today) gets one STOP for the whole
+#     short quantity at multiplier * position average price
+#   - a symbol filled by several orders gets one STOP per order at multiplier * fill price of that order
+#
+# Needs:
+#   df_order_tracker: dataframe of FILLED orders with keys "symbol", "order_id", "quantity", "price"
+#   df_pos: dataframe of open short option positions (see create_option_position_df)
+#   multiplier: STOP trigger as a multiple of the fill price
+# Returns:
+#   df_triggers: one row per STOP order, with keys "symbol", "order_id", "quantity", "price", "num_orders",
+#                "avg_price" (quantity weighted average fill price of the symbol), "trigger", "stop_price" (in nickels)
+#
+def compute_stop_triggers(df_order_tracker, df_pos, multiplier):
+    df = df_order_tracker[['symbol', 'order_id', 'quantity', 'price']].copy()
+    df['quantity'] = df['quantity'].astype(int)
+    df['price'] = df['price'].astype(float)
+
+    grouped = df.groupby('symbol', sort=False)
+    df['num_orders'] = grouped['order_id'].transform('count')
+    df['avg_price'] = (df['quantity'] * df['price']).groupby(df['symbol']).transform('sum') / grouped['quantity'].transform('sum')
+
+    # Open shorts without a fill today
+    unfilled = df_pos[~df_pos['symbol'].isin(df['symbol'])]
+    if len(unfilled) > 0:
+        df = pd.concat([df, pd.DataFrame({'symbol': unfilled['symbol'], 'order_id': None, 'quantity': unfilled['shortQuantity'].astype(int),
+                                          'price': unfilled['averagePrice'].astype(float), 'num_orders': 0,
+                                          'avg_price': unfilled['averagePrice'].astype(float)})], ignore_index=True)
+
+    # Single fills are protected as a whole at the position average price
+    positions = df_pos.drop_duplicates('symbol').set_index('symbol')
+    position_quantity = df['symbol'].map(positions['shortQuantity'])
+    position_price = df['symbol'].map(positions['averagePrice']).astype(float)
+    single = (df['num_orders'] <= 1) & position_quantity.notna()
+    df.loc[single, 'quantity'] = position_quantity[single].astype(int)
+
+    df['trigger'] = multiplier * df['price'].where(~single, position_price)
+    df['stop_price'] = nicklefy_column(df['trigger'], df['symbol'])
+    return df
+
+# Total quantity and quantity weighted average fill price per symbol
+def summarize_fills(df_orders):
+    df = df_orders[['symbol', 'quantity', 'price']].astype({'quantity': int, 'price': float})
+    df['notional'] = df['quantity'] * df['price']
+    df_summary = df.groupby('symbol', as_index=False)[['quantity', 'notional']].sum()
+    df_summary['price'] = df_summary['notional'] / df_summary['quantity']
+    return df_summary[['symbol', 'quantity', 'price']]
 
 def calc_symbol_quantity(df_order_tracker):
     # Calculate the sum of columns based on the 'symbol' column
@@ -195,16 +1035,190 @@ def calc_symbol_quantity(df_order_tracker):
     quantity_df = temp_df.copy()
     return quantity_df
 
+########################################################### 
+#   Global API request budget
+########################################################### 
+# TDA enforces a per-minute request limit for the whole app. Every worker takes a
+# token from this bucket before calling the API. Tokens refill at
+# requests_per_minute / 60 per second up to 'burst'. When the bucket is empty the
+# caller waits for its turn (a throttle event) instead of getting a 429.
+#
+class RequestBudget:
+    def __init__(self, requests_per_minute, burst):
+        self.rate = requests_per_minute / 60.0
+        self.capacity = float(burst)
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+        # Stats for monitoring
+        self.num_requests = 0
+        self.num_throttled = 0
+        self.throttled_seconds = 0.0
+        self.recent = deque()           # monotonic time of the requests made in the last minute
+
+    # Takes a token and returns the number of seconds to wait before using it
+    def reserve(self):
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens = self.tokens - 1
+
+            wait = 0.0
+            if self.tokens < 0:
+                wait = -self.tokens / self.rate
+                self.num_throttled = self.num_throttled + 1
+                self.throttled_seconds = self.throttled_seconds + wait
+
+            self.num_requests = self.num_requests + 1
+            self.recent.append(now + wait)
+            while self.recent[0] < now - 60:
+                self.recent.popleft()
+
+            return wait
+
+    def acquire(self):
+        wait = self.reserve()
+        if wait > 0:
+            time.sleep(wait)
+
+    async def acquire_async(self):
+        wait = self.reserve()
+        if wait > 0:
+            await asyncio.sleep(wait)
+
+    def stats(self):
+        with self.lock:
+            now = time.monotonic()
+            effective_rate = len([t for t in self.recent if now - 60 <= t <= now])
+            return {'requests': self.num_requests, 'requests_last_minute': effective_rate,
+                    'throttle_events': self.num_throttled, 'throttled_seconds': round(self.throttled_seconds, 3)}
+
+request_budget = RequestBudget(config.API_REQUESTS_PER_MINUTE, config.API_REQUESTS_BURST)
+metrics.collectors.append(lambda: [('watcher_api_budget_' + key, {}, value) for key, value in request_budget.stats().items()])
+
+
+########################################################### 
+#   Underlying quote cache
+########################################################### 
+# Last price of the underlyings, e.g. '$SPX.X' -> 4123.5, with the time it was received.
+# It is filled by the streaming level one feed, or by one batched get_quotes call for all
+# the symbols every config.QUOTE_REFRESH_SECONDS when streaming is off.
+#
+class QuoteCache:
+    def __init__(self):
+        self.prices = {}
+        self.lock = threading.Lock()
+
+    def update(self, symbol, price):
+        with self.lock:
+            self.prices[symbol] = (price, time.monotonic())
+
+    # Updates the cache from a get_quotes response body ({symbol: {'lastPrice': ..., 'mark': ...}})
+    def update_quotes(self, quotes):
+        for symbol, quote in quotes.items():
+            price = quote.get('lastPrice', quote.get('mark'))
+            if price is not None:
+                self.update(symbol, float(price))
+
+    # Returns the last price of symbol, or None if there is none or it is older than max_age seconds
+    def get(self, symbol, max_age=None):
+        with self.lock:
+            quote = self.prices.get(symbol)
+        if quote is None or (max_age is not None and time.monotonic() - quote[1] > max_age):
+            return None
+        return quote[0]
+
+    def refresh(self, client, symbols):
+        request_budget.acquire()
+        try:
+            response = client.get_quotes(symbols)
+        except (httpx.ConnectError, httpx.TimeoutException):
+            response = None
+
+        if response is None or response.status_code >= 400:
+            logger.error("Failed to retrieve quotes: %s", "no response" if response is None else response.status_code)
+            metrics.inc('watcher_api_errors_total', call='get_quotes')
+            return
+        self.update_quotes(response.json())
+
+    def run(self, event, client, symbols, interval):
+        while not event.is_set():
+            self.refresh(client, symbols)
+            event.wait(interval)
+
+        logger.info("Stopped quote refresh")
+        return
+
+quote_cache = QuoteCache()
+
+
+########################################################### 
+#   Adaptive poll scheduler
+########################################################### 
+# Decides how long the snapshot fetcher waits before the next poll:
+#   - market closed: config.POLL_INTERVAL_CLOSED
+#   - no open short options: config.POLL_INTERVAL_FLAT
+#   - a short without a working stop, or the underlying within
+#     config.NEAR_STRIKE_DISTANCE of a short strike: config.POLL_INTERVAL_FAST
+#   - otherwise: the loop timer entered by the user
+#
+MARKET_TIMEZONE = ZoneInfo('America/New_York')
+
+def market_is_open(now=None):
+    if now is None:
+        now = datetime.now(MARKET_TIMEZONE)
+    if now.weekday() >= 5:
+        return False
+    minutes = now.hour * 60 + now.minute
+    return 9 * 60 + 30 <= minutes < 16 * 60 + 15      # SPX options trade until 16:15 ET
+
+def next_poll_interval(snapshot, loop_timer):
+    if not market_is_open():
+        return max(loop_timer, config.POLL_INTERVAL_CLOSED)
+    if snapshot is None:
+        return loop_timer
+
+    shorts = {}
+    for pos in snapshot.positions:
+        if pos['instrument']['assetType'] == 'OPTION' and pos['shortQuantity'] > 0:
+            shorts[pos['instrument']['symbol']] = pos['instrument'].get('underlyingSymbol')
+
+    if len(shorts) == 0:
+        return max(loop_timer, config.POLL_INTERVAL_FLAT)
+
+    # Shorts without an open BUY_TO_CLOSE stop
+    protected = set()
+    for order_strat in snapshot.orders:
+        if order_strat['status'] not in TERMINAL_ORDER_STATUSES and order_strat.get('orderType') in STOP_ORDER_TYPES:
+            for legs in order_strat.get('orderLegCollection', []):
+                if legs['instruction'] == 'BUY_TO_CLOSE':
+                    protected.add(legs['instrument']['symbol'])
+    if any(symbol not in protected for symbol in shorts):
+        return min(loop_timer, config.POLL_INTERVAL_FAST)
+
+    # Underlying near a short strike (needs quotes from the quote cache)
+    for symbol, underlying in shorts.items():
+        price = quote_cache.get(underlying, config.QUOTE_MAX_AGE_SECONDS)
+        strike = option_strike(symbol)
+        if price is not None and strike is not None and abs(price - strike) <= config.NEAR_STRIKE_DISTANCE:
+            return min(loop_timer, config.POLL_INTERVAL_FAST)
+
+    return loop_timer
+
+
 ########################################################### 
 #   Retrieves open positions using a call to TD Client
 ########################################################### 
 #   fields = client.Account.Fields('orders')            # Returns all orders, including filled, cancelled, working, etc. If we use status=FILLED, it will return same infor as with positions call
 #   fields = client.Account.Fields('positions')         # Returns orders that were FILLED
 #
-def get_open_positions(client):
+def get_open_positions(client, account_id):
     fields = client.Account.Fields('positions')
+    request_budget.acquire()
     try:
-        response = client.get_account(account_id=config.ACCOUNT_ID_REGULAR, fields=fields)
+        response = client.get_account(account_id=account_id, fields=fields)
     except (httpx.ConnectError, httpx.TimeoutException):
         response = None
 
@@ -217,10 +1231,11 @@ def get_open_positions(client):
 #   fields = client.Account.Fields('orders')            # Returns all orders, including filled, cancelled, working, etc. If we use status=FILLED, it will return same infor as with positions call
 #   fields = client.Account.Fields('positions')         # Returns orders that were FILLED
 #
-def get_orders_book(client):
+def get_orders_book(client, account_id):
     fields = client.Account.Fields('orders')
+    request_budget.acquire()
     try:
-        response = client.get_account(account_id=config.ACCOUNT_ID_REGULAR, fields=fields)
+        response = client.get_account(account_id=account_id, fields=fields)
     except (httpx.ConnectError, httpx.TimeoutException):
         response = None
 
@@ -228,386 +1243,833 @@ def get_orders_book(client):
 
 
 ########################################################### 
-# Returns a dataframe of all orders that match the filter
+#   Retrieves positions and orders book in a single call
 ########################################################### 
-# Needs:
-#   orders_list: a list of type r['securitiesAccount']['orderStrategies'] extracted from JSON respinse from TD API
-#   filter: the status filter to apply on the list, e.g. 'WORKING', 'FILLED', 'EXPIRED, etc.
-# Returns:
-#   df_all: a dataframe with keys "order_id", "leg_id", "datetime", "underlying", "buy_sell", "symbol", "quantity", "status"
+# Same as get_open_positions() + get_orders_book() but asks for both Fields at once,
+# which halves the number of get_account calls per account.
 #
-def filter_orders_working(orders_list, filter):
-    print("Filtering orders of type: ", filter)
-
-    # Convert JSON orders_list to dictionary with the order_id, leg_id, datetime, underlying, buy_sell, symbol, quantity, status
-    order_dict = {}
-    keys = ["order_id", "leg_id", "datetime", "underlying", "buy_sell", "symbol", "quantity", "status"]
-    order_index = 1
-    leg_index = 1
-    df_all = pd.DataFrame(order_dict)
-    data = []  
-    
-    # print("=====> num orders = ", len(orders_list))
-    num_orders_in_filter = 0
-    
-    # FUTURE WORK: get this to work with OCO and 1st trigger , etc. orders. For now we will skip those
-    for order_strat in orders_list:  
-        # print("Processing order: ", order_index)  
+def get_account_snapshot(client, account_id):
+    fields = [client.Account.Fields('positions'), client.Account.Fields('orders')]
+    request_budget.acquire()
+    try:
+        response = client.get_account(account_id=account_id, fields=fields)
+    except (httpx.ConnectError, httpx.TimeoutException):
+        response = None
 
-        if "childOrderStrategies" in order_strat :
-            print("Advanced order is being skipped for now")
+    return response
 
-        else :
-            status = order_strat['status']
-
-            # Apply status filter
-            if status == filter :
-                num_orders_in_filter = num_orders_in_filter + 1
-                order_id = order_strat['orderId']
-                time_value = order_strat['enteredTime']
-                quantity = order_strat["quantity"]
-                
-                # For multi-leg strats, get values of each leg from orderLegCollection
-                for legs in order_strat['orderLegCollection']:
-                    # The variable names used here will become columns of the dataframe
-                    leg_id = legs['legId']
-                    #effect_value = legs['positionEffect']
-                    buy_sell = legs['instruction']
-                    inst = legs['instrument']
-                    opt_symbol = inst['symbol']
-                    usymbol_value = inst['underlyingSymbol']
-                    
-                    #print("Leg: ", str(leg_index) + " effect_value: ", buy_sell, " inst: ", inst, " opt_symbol: ", opt_symbol)
-                    # Add to dictionar
-                    # keys = ["order_id", "leg_id", "datetime", "underlying", "buy_sell", "symbol", "quantity", "status"]
-                    order_dict[keys[0]] = order_id
-                    order_dict[keys[1]] = leg_id
-                    order_dict[keys[2]] = time_value
-                    order_dict[keys[3]] = usymbol_value
-                    order_dict[keys[4]] = buy_sell
-                    order_dict[keys[5]] = opt_symbol
-                    order_dict[keys[6]] = quantity
-                    order_dict[keys[7]] = status
-
-                    # # Print dict
-                    # print("Printing Dictionary . . .")
-                    # print(order_dict)
-
-                    new_df = pd.DataFrame(order_dict, index=[0])
-                    data.append(new_df)
-
-                    leg_index = leg_index + 1
-
-            order_index = order_index + 1
 
-    
-    if num_orders_in_filter > 0 :
-        # print("Number of orders that matched the filter = ", num_orders_in_filter)
+########################################################### 
+#   Incremental orders history
+########################################################### 
+# With config.ORDER_FETCH_MODE = 'incremental' the orders book is not downloaded on every
+# tick (get_account with Fields('orders') returns every order of the day, and the day's
+# book only grows). OrderHistoryCache keeps the orders of the account by order ID and each
+# tick only asks for what can have changed:
+#   - get_account with Fields('positions') only
+#   - get_orders_by_path for the orders entered since the high-water mark (latest
+#     enteredTime in the cache) minus config.ORDER_WINDOW_OVERLAP_SECONDS, any status
+#   - get_orders_by_path for the WORKING orders of the last config.ORDER_LOOKBACK_DAYS
+#     (GTC stops can be days old), which is about one order per open short
+#   - get_order for a cached open order (any status but TERMINAL_ORDER_STATUSES, e.g.
+#     WORKING, QUEUED, PENDING_ACTIVATION), entered before the window, that neither query
+#     returned, i.e. it was filled, canceled, replaced or activated since. Above
+#     config.ORDER_REFETCH_LIMIT of them, the next tick is a full resync instead.
+#     An open order entered before the WORKING query (a GTC stop older than
+#     config.ORDER_LOOKBACK_DAYS, TDA does not search further back) cannot be returned
+#     by either query: it keeps its cached status until the next full resync.
+# Both queries stay small however many orders the day had. The whole book is downloaded
+# again (full resync) on the first tick, every config.ORDER_RESYNC_SECONDS, and after a
+# failed incremental tick, so the cache cannot drift for long.
+#
+# Bytes received and decode/merge time of every tick are recorded as
+# watcher_fetch_bytes_total{account,mode}, watcher_fetch_bytes_last{account} and the
+# 'decode'/'merge' stages of watcher_stage_seconds.
+#
+class OrderHistoryCache:
+    def __init__(self):
+        self.orders = {}                # orderId -> order strategy, in arrival order
+        self.open_orders = set()        # orderId of the cached orders whose status can still change
+        self.high_water_mark = None     # latest enteredTime of the cached orders
+        self.last_resync = None         # time.monotonic() of the last full resync
+        self.resync_requested = True
+
+    def needs_resync(self, now):
+        return self.resync_requested or self.last_resync is None or now - self.last_resync >= config.ORDER_RESYNC_SECONDS
+
+    # Start of the WORKING orders query
+    def working_start(self, now=None):
+        return (now or datetime.now(timezone.utc)) - timedelta(days=config.ORDER_LOOKBACK_DAYS)
+
+    # Start of the incremental window
+    def window_start(self):
+        return self.high_water_mark - timedelta(seconds=config.ORDER_WINDOW_OVERLAP_SECONDS)
+
+    def update_high_water_mark(self, orders_list):
+        for order_strat in orders_list:
+            entered = parse_tda_time(order_strat['enteredTime'])
+            if self.high_water_mark is None or entered > self.high_water_mark:
+                self.high_water_mark = entered
+
+    # Full resync: the given book replaces the cache
+    def replace(self, orders_list, now):
+        self.orders = {}
+        self.open_orders = set()
+        for order_strat in orders_list:
+            self.update_order(order_strat)
+        self.high_water_mark = None
+        self.update_high_water_mark(orders_list)
+        if self.high_water_mark is None:
+            self.high_water_mark = datetime.now(timezone.utc)
+        self.last_resync = now
+        self.resync_requested = False
+
+    # Merges the orders of the window and the WORKING orders (entered since working_start).
+    # Returns the IDs of the cached open orders that are in neither although the WORKING
+    # query covers them, i.e. whose status changed outside of the window. Older open orders
+    # stay tracked as they are.
+    def merge(self, window_orders, working_orders, working_start):
+        seen = set()
+        for order_strat in list(window_orders) + list(working_orders):
+            self.update_order(order_strat)
+            seen.add(order_strat['orderId'])
+        self.update_high_water_mark(window_orders)
+
+        return [order_id for order_id in self.open_orders
+                if order_id not in seen and parse_tda_time(self.orders[order_id]['enteredTime']) >= working_start]
+
+    def update_order(self, order_strat):
+        order_id = order_strat['orderId']
+        self.orders[order_id] = order_strat
+        if order_strat['status'] in TERMINAL_ORDER_STATUSES:
+            self.open_orders.discard(order_id)
+        else:
+            self.open_orders.add(order_id)
+
+    def book(self):
+        return list(self.orders.values())
+
+
+# Returns the orders entered since 'from_entered' (optionally with the given status), or None
+def get_orders_window(client, account_id, from_entered, status=None):
+    request_budget.acquire()
+    try:
+        response = client.get_orders_by_path(account_id, from_entered_datetime=from_entered, to_entered_datetime=datetime.now(timezone.utc) + timedelta(days=1),
+                                             status=status)
+    except (httpx.ConnectError, httpx.TimeoutException):
+        response = None
 
-        df_all = pd.concat(data, ignore_index=True)
+    return response
 
-        # # Print Dataframe
-        # print("")
-        # print("Dataframe of orders:")
-        # print(df_all)
-        # print("")
+def get_order_by_id(client, account_id, order_id):
+    request_budget.acquire()
+    try:
+        response = client.get_order(order_id, account_id)
+    except (httpx.ConnectError, httpx.TimeoutException):
+        response = None
 
-        # # save the dataframe to a CSV file
-        # # The index=False parameter is used to exclude the index column from the output CSV file.
-        # df_all.to_csv('logs/sample.csv', index=False)
+    return response
 
-    else :
-        print("No orders were found that matched the status filter within the date range!")
+def response_failed(response):
+    return response is None or response.status_code >= 400
 
-    return df_all
+def record_fetch_bytes(account_id, mode, num_bytes):
+    metrics.inc('watcher_fetch_bytes_total', num_bytes, account=str(account_id), mode=mode)
+    metrics.set('watcher_fetch_bytes_last', num_bytes, account=str(account_id))
 
 
-def get_leg_price(legID, orderActivityCollection):
-    # print(json.dumps(orderActivityCollection, indent=4))
-    
-    orderDict = orderActivityCollection[0]
-    orderExecList = orderDict['executionLegs']
+########################################################### 
+#   Shared account snapshot
+########################################################### 
+# One fetcher thread reads positions and orders for the account every loop_timer seconds
+# and publishes them as a versioned snapshot. stop_monitor and in_the_money_protector
+# both read the same snapshot, so they see the same account state in a given tick and
+# do not make their own get_account calls.
+#
+# A snapshot is immutable: positions and orders are tuples, and workers must treat
+# the dictionaries inside them as read-only.
+#
+# With several accounts (config.ACCOUNT_IDS) there is one service per account and a
+# single AccountScheduler thread polls them in turn, instead of one fetcher each.
+#
+AccountSnapshot = namedtuple('AccountSnapshot', ['version', 'timestamp', 'positions', 'orders', 'account_id'])
+
+# Per account counters, exported as watcher_account_<name>{account="..."}. They are kept
+# for the life of the process, across Stop/Start of the monitors.
+ACCOUNT_STATS = ('fetches', 'fetch_errors', 'cycles', 'stops_placed', 'stop_errors')
+account_stats = {}
+
+def get_account_stats(account_id):
+    return account_stats.setdefault(str(account_id), dict.fromkeys(ACCOUNT_STATS, 0))
+
+metrics.collectors.append(lambda: [('watcher_account_' + name, {'account': account_id}, stats[name])
+                                   for account_id, stats in list(account_stats.items()) for name in ACCOUNT_STATS])
+
+class AccountSnapshotService:
+    def __init__(self, client, loop_timer, account_id, refresh_event=None, order_fetch_mode=None):
+        self.client = client
+        self.loop_timer = loop_timer
+        self.account_id = account_id
+        self.order_fetch_mode = order_fetch_mode or config.ORDER_FETCH_MODE
+        # A recorded session is replayed from its get_account exchanges, which only hold the
+        # orders book when it is fetched in full
+        if config.RECORD_LOG and self.order_fetch_mode == 'incremental':
+            logger.warning("RECORD_LOG is set, account %s fetches its orders book in full instead of incrementally", account_id)
+            self.order_fetch_mode = 'full'
+        self.order_cache = OrderHistoryCache()
+
+        self._snapshot = None
+        self._condition = threading.Condition()
+        self._refresh = refresh_event if refresh_event is not None else Event()
+        self.refresh_requested = False
+        self.throttle_events = 0
+        self.stats = get_account_stats(account_id)
+
+    # Fetches the account once and publishes a new snapshot. Returns the snapshot or None on failure.
+    def fetch(self):
+        self.stats['fetches'] = self.stats['fetches'] + 1
+        if self.order_fetch_mode == 'incremental' and not self.order_cache.needs_resync(time.monotonic()):
+            result = self.fetch_incremental()
+        else:
+            result = self.fetch_full()
+        if result is None:
+            self.stats['fetch_errors'] = self.stats['fetch_errors'] + 1
+            return None
+        positions, orders_list = result
+
+        budget_stats = request_budget.stats()
+        if budget_stats['throttle_events'] > self.throttle_events:
+            self.throttle_events = budget_stats['throttle_events']
+            logger.warning("API request budget throttled: %s", budget_stats)
+
+        return self.publish(positions, orders_list)
+
+    # Positions and the whole orders book in one get_account call
+    def fetch_full(self):
+        with stage_timer('get_account'):
+            response = get_account_snapshot(self.client, self.account_id)
+        if response_failed(response):
+            logger.error("Failed to retrieve account %s snapshot: %s", self.account_id, "no response" if response is None else response.status_code)
+            metrics.inc('watcher_api_errors_total', call='get_account')
+            return None
+        record_fetch_bytes(self.account_id, 'full', len(response.content))
+
+        with stage_timer('decode'):
+            r = json.load(response)  # Convert to JSON
+        account = r['securitiesAccount']
+        orders_list = account.get('orderStrategies', [])
+
+        if self.order_fetch_mode == 'incremental':
+            with stage_timer('merge'):
+                self.order_cache.replace(orders_list, time.monotonic())
+            logger.info("Orders of account %s resynchronized: %d orders", self.account_id, len(orders_list))
+        return account.get('positions', []), orders_list
+
+    # Positions plus the orders that changed since the last tick (see OrderHistoryCache)
+    def fetch_incremental(self):
+        cache = self.order_cache
+        with stage_timer('get_account'):
+            positions_response = get_open_positions(self.client, self.account_id)
+        working_start = cache.working_start()
+        with stage_timer('get_orders'):
+            window_response = get_orders_window(self.client, self.account_id, cache.window_start())
+            working_response = get_orders_window(self.client, self.account_id, working_start, self.client.Order.Status.WORKING)
+
+        responses = [('get_account', positions_response), ('get_orders', window_response), ('get_orders', working_response)]
+        for call, response in responses:
+            if response_failed(response):
+                logger.error("Failed to retrieve account %s %s: %s", self.account_id, call, "no response" if response is None else response.status_code)
+                metrics.inc('watcher_api_errors_total', call=call)
+                cache.resync_requested = True
+                return None
+        num_bytes = sum(len(response.content) for call, response in responses)
+
+        with stage_timer('decode'):
+            positions = positions_response.json()['securitiesAccount'].get('positions', [])
+            window_orders = window_response.json()
+            working_orders = working_response.json()
+
+        with stage_timer('merge'):
+            changed_ids = cache.merge(window_orders, working_orders, working_start)
+
+        # Old open orders that were filled, canceled, replaced or activated since the last tick
+        if len(changed_ids) > config.ORDER_REFETCH_LIMIT:
+            logger.info("%d orders of account %s changed outside of the window, resynchronizing", len(changed_ids), self.account_id)
+            cache.resync_requested = True
+        for order_id in changed_ids[:config.ORDER_REFETCH_LIMIT]:
+            response = get_order_by_id(self.client, self.account_id, order_id)
+            if response_failed(response):
+                metrics.inc('watcher_api_errors_total', call='get_order')
+                cache.resync_requested = True
+                continue
+            num_bytes = num_bytes + len(response.content)
+            cache.update_order(response.json())
+
+        record_fetch_bytes(self.account_id, 'incremental', num_bytes)
+        return positions, cache.book()
+
+    def publish(self, positions, orders):
+        with self._condition:
+            version = 1 if self._snapshot is None else self._snapshot.version + 1
+            self._snapshot = AccountSnapshot(version, datetime.now(), tuple(positions), tuple(orders), self.account_id)
+            self._condition.notify_all()
+            return self._snapshot
+
+    def latest(self):
+        return self._snapshot
+
+    # Blocks until a snapshot newer than 'version' is published, or timeout expires.
+    # Returns the new snapshot or None on timeout.
+    def wait_for_update(self, version, timeout=None):
+        with self._condition:
+            self._condition.wait_for(lambda: self._snapshot is not None and self._snapshot.version > version, timeout)
+            if self._snapshot is None or self._snapshot.version <= version:
+                return None
+            return self._snapshot
+
+    # Asks the fetcher to poll right away instead of waiting for the rest of loop_timer
+    def request_refresh(self):
+        self.refresh_requested = True
+        self._refresh.set()
+
+    # Wakes up any worker that is waiting on a snapshot so it can see the stop event
+    def wake_workers(self):
+        with self._condition:
+            self._condition.notify_all()
+
+    def run(self, event):
+        while not event.is_set():
+            self.fetch()
+            self._refresh.wait(next_poll_interval(self._snapshot, self.loop_timer))
+            self._refresh.clear()
+            self.refresh_requested = False
+
+        self.wake_workers()
+        logger.info("Stopped account snapshot fetcher")
+        return
 
-    for legs in orderExecList:
-        leg_id = legs['legId']
-        price = legs['price']
 
-        if leg_id == legID:
-            return price
+########################################################### 
+#   Fair multi-account poll scheduler
+########################################################### 
+# Decides which account to poll next. Every account is due next_poll_interval() after
+# its last poll, or right away when a refresh was requested. Among the accounts that
+# are due, the one after the last served account goes first (round robin), so an
+# account that is polled fast cannot starve the others when the request budget is short.
+#
+# Works on anything with account_id, loop_timer, refresh_requested and latest(), i.e.
+# AccountSnapshotService and AsyncMonitorEngine.
+#
+class AccountScheduler:
+    def __init__(self, accounts):
+        self.accounts = list(accounts)
+        self.due = [0.0] * len(self.accounts)
+        self.turn = 0
+
+    # Returns (account, 0) for the account to poll now, or (None, seconds until the next one is due)
+    def next_account(self, now):
+        num_accounts = len(self.accounts)
+        for i in range(0, num_accounts):
+            index = (self.turn + i) % num_accounts
+            account = self.accounts[index]
+            if account.refresh_requested or self.due[index] <= now:
+                self.turn = (index + 1) % num_accounts
+                account.refresh_requested = False
+                return account, 0.0
+        return None, max(0.0, min(self.due) - now)
+
+    def polled(self, account, now):
+        index = self.accounts.index(account)
+        self.due[index] = now + next_poll_interval(account.latest(), account.loop_timer)
+
+    # Fetcher thread for AccountSnapshotService accounts sharing the 'wakeup' refresh event
+    def run(self, event, wakeup):
+        while not event.is_set():
+            account, wait = self.next_account(time.monotonic())
+            if account is None:
+                wakeup.wait(wait)
+                wakeup.clear()
+                continue
+
+            account.fetch()
+            self.polled(account, time.monotonic())
+
+        for account in self.accounts:
+            account.wake_workers()
+        logger.info("Stopped account scheduler")
+        return
 
 
-def filter_orders_filled(orders_list, filter):
-    print("Filtering orders of type: ", filter)
-
-    # Convert JSON orders_list to dictionary with the order_id, leg_id, datetime, underlying, buy_sell, symbol, quantity, status
-    order_dict = {}
-    keys = ["order_id", "leg_id", "datetime", "underlying", "buy_sell", "symbol", "quantity", "status", "price"]
-    order_index = 1
-    leg_index = 1
-    df_all = pd.DataFrame(order_dict)
-    data = []  
-    
-    # print("=====> num orders = ", len(orders_list))
-    num_orders_in_filter = 0
-    
-    # FUTURE WORK: get this to work with OCO and 1st trigger , etc. orders. For now we will skip those
-    for order_strat in orders_list:  
-        # print("Processing order: ", order_index)  
+########################################################### 
+#   Account activity streaming
+########################################################### 
+# Optional mode (config.USE_STREAMING) that subscribes to the TDA streamer account
+# activity and level one feeds. As soon as an order event arrives the snapshot
+# fetcher is asked to refresh, so the stop monitor reconciles right away instead
+# of waiting for the next poll. The REST poll then only runs every
+# config.STREAM_RESYNC_SECONDS as a consistency check.
+#
+# If config.STREAM_URL is set, the monitor connects to that websocket directly
+# instead of logging into the TDA streamer (see fake_stream_server.py, which
+# replays recorded streamer messages).
+#
 
-        if "childOrderStrategies" in order_strat :
-            print("Advanced order is being skipped for now")
+# Account activity messages that trigger an immediate reconciliation
+STREAM_TRIGGER_MESSAGES = ('OrderFill', 'OrderPartialFill', 'OrderEntryRequest', 'UROUT')
+
+# 'accounts' maps account ID -> AccountSnapshotService (or AsyncMonitorEngine)
+def on_account_activity(msg, accounts):
+    for content in msg.get('content', []):
+        # Fields '1' and '2' are ACCOUNT and MESSAGE_TYPE in the raw (not relabeled) streamer format
+        message_type = content.get('MESSAGE_TYPE', content.get('2'))
+        if message_type in STREAM_TRIGGER_MESSAGES:
+            account_id = str(content.get('ACCOUNT', content.get('1')))
+            logger.info("Account activity received: %s account %s", message_type, account_id)
+
+            # Refresh every account if the message does not say which one
+            if account_id in accounts:
+                accounts[account_id].request_refresh()
+            else:
+                for snapshots in accounts.values():
+                    snapshots.request_refresh()
 
-        else :
-            status = order_strat['status']
-
-            # Apply status filter
-            if status == filter :
-
-                #print(json.dumps(order_strat, indent=4))
-
-                num_orders_in_filter = num_orders_in_filter + 1
-                order_id = order_strat['orderId']
-                time_value = order_strat['enteredTime']
-                quantity = order_strat["quantity"]
-                order_price = order_strat["price"]
-                
-                # For multi-leg strats, get values of each leg from orderLegCollection
-                for legs in order_strat['orderLegCollection']:
-                    # The variable names used here will become columns of the dataframe
-                    leg_id = legs['legId']
-                    #effect_value = legs['positionEffect']
-                    buy_sell = legs['instruction']
-                    inst = legs['instrument']
-                    opt_symbol = inst['symbol']
-
-                    if (legs['orderLegType'] == 'OPTION'):
-                        usymbol_value = inst['underlyingSymbol']
-                    else:
-                        num_orders_in_filter = num_orders_in_filter - 1   # we are only conv=cerned about OPTIONs for now
-                        break
-
-                    
-                    #print("Leg: ", str(leg_index) + " effect_value: ", buy_sell, " inst: ", inst, " opt_symbol: ", opt_symbol)
-                    # Add to dictionar
-                    # keys = ["order_id", "leg_id", "datetime", "underlying", "buy_sell", "symbol", "quantity", "status", "price"]
-                    order_dict[keys[0]] = order_id
-                    order_dict[keys[1]] = leg_id
-                    order_dict[keys[2]] = time_value
-                    order_dict[keys[3]] = usymbol_value
-                    order_dict[keys[4]] = buy_sell
-                    order_dict[keys[5]] = opt_symbol
-                    order_dict[keys[6]] = quantity
-                    order_dict[keys[7]] = status
-                                       
-                    # Get individual leg price
-                    leg_price = get_leg_price(leg_id, order_strat['orderActivityCollection'])
-                    order_dict[keys[8]] = leg_price
-
-                    # # Print dict
-                    # print("Printing Dictionary . . .")
-                    # print(order_dict)
-
-                    new_df = pd.DataFrame(order_dict, index=[0])
-                    data.append(new_df)
-
-                    leg_index = leg_index + 1
-
-            order_index = order_index + 1
+def on_level_one_quote(msg):
+    for content in msg.get('content', []):
+        # Field '3' is LAST_PRICE in the raw (not relabeled) streamer format
+        last_price = content.get('LAST_PRICE', content.get('3'))
+        if last_price is not None:
+            quote_cache.update(content['key'], float(last_price))
 
-    
-    if num_orders_in_filter > 0 :
-        # print("Number of orders that matched the filter = ", num_orders_in_filter)
+# Dispatches one raw websocket frame, e.g. {"data": [{"service": "ACCT_ACTIVITY", "content": [...]}]}
+def dispatch_stream_frame(frame, accounts):
+    for msg in frame.get('data', []):
+        if msg.get('service') == 'ACCT_ACTIVITY':
+            on_account_activity(msg, accounts)
+        elif msg.get('service') == 'QUOTE':
+            on_level_one_quote(msg)
 
-        df_all = pd.concat(data, ignore_index=True)
 
-        # # Print Dataframe
-        # print("")
-        # print("Dataframe of orders:")
-        # print(df_all)
-        # print("")
+async def run_tda_stream(event, accounts):
+    from tda.streaming import StreamClient
 
-        # # save the dataframe to a CSV file
-        # # The index=False parameter is used to exclude the index column from the output CSV file.
-        # df_all.to_csv('logs/sample.csv', index=False)
+    # The account activity subscription reports the activity of every account of the login
+    first = next(iter(accounts.values()))
+    stream_client = StreamClient(first.client, account_id=first.account_id)
+    await stream_client.login()
+    await stream_client.quality_of_service(StreamClient.QOSLevel.EXPRESS)
 
-    else :
-        print("No orders were found that matched the status filter within the date range!")
+    stream_client.add_account_activity_handler(lambda msg: on_account_activity(msg, accounts))
+    await stream_client.account_activity_sub()
 
-    return df_all
+    if len(config.QUOTE_SYMBOLS) > 0:
+        stream_client.add_level_one_equity_handler(on_level_one_quote)
+        await stream_client.level_one_equity_subs(config.QUOTE_SYMBOLS)
+
+    while not event.is_set():
+        try:
+            await asyncio.wait_for(stream_client.handle_message(), timeout=1.0)
+        except asyncio.TimeoutError:
+            pass
+
+    await stream_client.logout()
+
+
+async def run_url_stream(event, accounts, url):
+    import websockets
+
+    async with websockets.connect(url) as socket:
+        while not event.is_set():
+            try:
+                raw = await asyncio.wait_for(socket.recv(), timeout=1.0)
+            except asyncio.TimeoutError:
+                continue
+            except websockets.ConnectionClosed:
+                logger.warning("Stream connection closed by: %s", url)
+                break
+
+            dispatch_stream_frame(json.loads(raw), accounts)
+
+
+def account_activity_stream(event, accounts):
+    logger.info("Account activity stream is starting . . .")
+
+    try:
+        if config.STREAM_URL:
+            asyncio.run(run_url_stream(event, accounts, config.STREAM_URL))
+        else:
+            asyncio.run(run_tda_stream(event, accounts))
+    except Exception as e:
+        # The REST poll keeps running as a fallback
+        logger.error("Account activity stream failed: %r", e)
+
+    logger.info("Stopped account activity stream")
+    return
 
 
 ########################################################### 
-#   Returns OPTION instruments dataframe
+#   Parses the orders book in a single pass
 ########################################################### 
+# Walks r['securitiesAccount']['orderStrategies'] once and fills plain python
+# column lists for every status found in the book. A DataFrame is only built once
+# per status at the end, instead of one single-row DataFrame per order leg.
+#
 # Needs:
-#   pos_dict: positions dictionary retrived from response of TD Client r['securitiesAccount']['positions'] 
+#   orders_list: a list of type r['securitiesAccount']['orderStrategies'] extracted from JSON respinse from TD API
+#   statuses: optional list of statuses to keep, e.g. ['WORKING', 'FILLED']. None keeps every status.
 # Returns:
-#   df_all: a dataframe with keys "symbol", "putCall", "shortQuantity", "averagePrice"
-#  
-def create_option_position_df(pos_dict) :
-    # Convert JSON response to dictionary with the order_id, leg_id, datetime, underlying, buy_sell, symbol, quantity, status
-    order_dict = {}
-    keys = ["symbol", "putCall", "shortQuantity", "averagePrice"]
+#   order_book: a dictionary of status -> dataframe with ORDER_BOOK_COLUMNS
+#
+ORDER_BOOK_COLUMNS = ["order_id", "leg_id", "datetime", "underlying", "buy_sell", "symbol", "quantity", "status", "price", "order_type", "stop_price", "close_time"]
 
-    df = pd.DataFrame(order_dict)
-    data = []
+def parse_order_legs(order_strat):
+    # Returns one row (a tuple in ORDER_BOOK_COLUMNS order) per OPTION leg of the order
+    rows = []
 
-    pos_indx = 0
-    for pos in pos_dict:
-        if pos['instrument']['assetType'] == "OPTION" and pos['shortQuantity'] > 0:
-            symbol = pos['instrument']['symbol']       
-            putCall = pos['instrument']['putCall']
-            shortQuantity = pos['shortQuantity']
-            averagePrice = pos['averagePrice']
-
-            order_dict[keys[0]] = symbol
-            order_dict[keys[1]] = putCall
-            order_dict[keys[2]] = shortQuantity
-            order_dict[keys[3]] = averagePrice
-
-            new_df = pd.DataFrame(order_dict, index=[0])
-            #new_df.insert(0, 'TimeStamp', pd.to_datetime('now').replace(microsecond=0))   # add timestamp
-            data.append(new_df)
-
-            pos_indx = pos_indx + 1
-        
-    df_all = pd.concat(data, ignore_index=True)
+    # FUTURE WORK: get this to work with OCO and 1st trigger , etc. orders. For now we will skip those
+    if "childOrderStrategies" in order_strat :
+        return rows
+
+    order_id = order_strat['orderId']
+    time_value = order_strat['enteredTime']
+    quantity = order_strat["quantity"]
+    status = order_strat['status']
+    order_type = order_strat.get('orderType')
+    stop_price = order_strat.get('stopPrice')
+    close_time = order_strat.get('closeTime')
+
+    # Individual leg prices are only known once the order had some activity (e.g. FILLED)
+    leg_prices = {}
+    if 'orderActivityCollection' in order_strat :
+        for legs in order_strat['orderActivityCollection'][0]['executionLegs']:
+            leg_prices.setdefault(legs['legId'], legs['price'])
+
+    # For multi-leg strats, get values of each leg from orderLegCollection
+    for legs in order_strat['orderLegCollection']:
+        if legs['orderLegType'] != 'OPTION':
+            break       # we are only concerned about OPTIONs for now
 
+        leg_id = legs['legId']
+        inst = legs['instrument']
+        rows.append((order_id, leg_id, time_value, inst['underlyingSymbol'], legs['instruction'], inst['symbol'],
+                     quantity, status, leg_prices.get(leg_id), order_type, stop_price, close_time))
 
-    # For debugging or record keeping, we can save dataframe to a CSV file
-    #df_all.to_csv('logs/option_positions.csv', index=False)
+    return rows
+
+
+def parse_orders_book(orders_list, statuses=None):
+    columns = {}        # status -> list of rows
+    num_advanced = 0
+
+    for order_strat in orders_list:
+        if "childOrderStrategies" in order_strat :
+            num_advanced = num_advanced + 1
+            continue
+
+        status = order_strat['status']
+        if statuses is not None and status not in statuses:
+            continue
+
+        rows = parse_order_legs(order_strat)
+        if len(rows) > 0:
+            columns.setdefault(status, []).extend(rows)
+
+    if num_advanced > 0:
+        logger.debug("Advanced orders are being skipped for now: %d", num_advanced)
+
+    order_book = {}
+    for status, rows in columns.items():
+        order_book[status] = pd.DataFrame.from_records(rows, columns=ORDER_BOOK_COLUMNS)
+
+    return order_book
 
-    return df_all
+
+# Returns the dataframe for a given status, or an empty dataframe with the same columns
+def order_book_frame(order_book, status):
+    if status in order_book:
+        return order_book[status]
+
+    return pd.DataFrame(columns=ORDER_BOOK_COLUMNS)
 
 
 ########################################################### 
-#   Returns FIXED_INCOME instruments dataframe
+#   Incremental orders book index
+########################################################### 
+# Keeps the parsed legs of every order between cycles, keyed by orderId and
+# remembered together with the order status and enteredTime. On each update:
+#   - if the fingerprint of the orders and positions did not change, nothing is
+#     parsed and update() returns None so the whole cycle can be skipped
+#   - otherwise only new or changed orders are parsed again, and the symbols they
+#     touch (plus symbols whose position changed) are returned so that
+#     reconciliation only runs for those symbols.
+#
+# Symbols that still need attention after a cycle (e.g. a stop is still missing or
+# not yet in the book) should be handed back with mark_pending() so they are
+# re-checked on the next cycle. The pending set is only replaced by mark_pending(),
+# so a cycle that ends early keeps the symbols of the previous one.
+#
+class OrderBookIndex:
+    def __init__(self):
+        self.orders = {}            # orderId -> (status, enteredTime, rows)
+        self.positions = {}         # symbol -> (shortQuantity, longQuantity, averagePrice)
+        self.fingerprint = None
+        self.pending_symbols = set()
+        self.changed = False        # True if the last update() saw a different fingerprint
+
+    def update(self, positions, orders_list):
+        order_keys = tuple((order_strat['orderId'], order_strat['status'], order_strat['enteredTime']) for order_strat in orders_list)
+        new_positions = {}
+        for pos in positions:
+            new_positions[pos['instrument']['symbol']] = (pos.get('shortQuantity'), pos.get('longQuantity'), pos.get('averagePrice'))
+
+        fingerprint = hash((order_keys, tuple(new_positions.items())))
+        self.changed = fingerprint != self.fingerprint
+        if not self.changed:
+            if len(self.pending_symbols) == 0:
+                return None
+            return set(self.pending_symbols)
+
+        self.fingerprint = fingerprint
+        touched = set(self.pending_symbols)
+
+        # Parse new or changed orders only
+        seen = set()
+        for order_strat in orders_list:
+            order_id = order_strat['orderId']
+            seen.add(order_id)
+
+            key = (order_strat['status'], order_strat['enteredTime'])
+            cached = self.orders.get(order_id)
+            if cached is not None and cached[:2] == key:
+                continue
+
+            rows = parse_order_legs(order_strat)
+            self.orders[order_id] = key + (rows,)
+            touched.update(row[5] for row in rows)
+            if cached is not None:
+                touched.update(row[5] for row in cached[2])
+
+        # Orders that are no longer in the book
+        for order_id in [order_id for order_id in self.orders if order_id not in seen]:
+            touched.update(row[5] for row in self.orders.pop(order_id)[2])
+
+        # Positions that were opened, closed or changed
+        for symbol in set(new_positions) | set(self.positions):
+            if new_positions.get(symbol) != self.positions.get(symbol):
+                touched.add(symbol)
+        self.positions = new_positions
+
+        return touched
+
+    def mark_pending(self, symbols):
+        self.pending_symbols = set(symbols)
+
+    # Returns a dataframe (ORDER_BOOK_COLUMNS) of all indexed legs with the given status,
+    # optionally limited to a set of symbols
+    def frame(self, status, symbols=None):
+        return self.legs_frame(lambda order_status: order_status == status, symbols)
+
+    # Same for the legs of the orders that are not in a terminal status (WORKING, QUEUED, ACCEPTED, ...)
+    def open_frame(self, symbols=None):
+        return self.legs_frame(lambda order_status: order_status not in TERMINAL_ORDER_STATUSES, symbols)
+
+    def legs_frame(self, keep_status, symbols):
+        rows = []
+        for order_status, entered_time, order_rows in self.orders.values():
+            if not keep_status(order_status):
+                continue
+            for row in order_rows:
+                if symbols is None or row[5] in symbols:
+                    rows.append(row)
+
+        return pd.DataFrame.from_records(rows, columns=ORDER_BOOK_COLUMNS)
+
+
+########################################################### 
+# Returns a dataframe of all orders that match the filter
 ########################################################### 
 # Needs:
-#   pos_dict: positions dictionary retrived from response of TD Client r['securitiesAccount']['positions'] 
+#   orders_list: a list of type r['securitiesAccount']['orderStrategies'] extracted from JSON respinse from TD API
+#   filter: the status filter to apply on the list, e.g. 'WORKING', 'FILLED', 'EXPIRED, etc.
 # Returns:
-#   df_all: a dataframe with keys "cusip", "description", "maturityDate", "quantity"
-#  
-def create_fixed_income_df(pos_dict) :
-    # Convert JSON response to dictionary with the order_id, leg_id, datetime, underlying, buy_sell, symbol, quantity, status
-    order_dict = {}
-    keys = ["cusip", "description", "maturityDate", "quantity"]
-
-    df = pd.DataFrame(order_dict)
-    data = []
+#   df_all: a dataframe with keys "order_id", "leg_id", "datetime", "underlying", "buy_sell", "symbol", "quantity", "status", "price", ...
+#
+# Both are kept for callers that only need one status. stop_monitor uses parse_orders_book() directly
+# so the orders book is only traversed once per cycle.
+#
+def filter_orders(orders_list, filter):
+    logger.debug("Filtering orders of type: %s", filter)
 
-    pos_indx = 0
-    for pos in pos_dict:
-        if pos['instrument']['assetType'] == "FIXED_INCOME" :
-            cusip = pos['instrument']['cusip']
-            descrip = pos['instrument']['description']
-            time_value = pos['instrument']['maturityDate']
-            quantity = pos['instrument']['factor']
+    df_all = order_book_frame(parse_orders_book(orders_list, [filter]), filter)
+    if len(df_all) == 0 :
+        logger.debug("No orders were found that matched the status filter within the date range!")
 
-            order_dict[keys[0]] = cusip
-            order_dict[keys[1]] = descrip
-            order_dict[keys[2]] = time_value
-            order_dict[keys[3]] = quantity
+    return df_all
 
-            new_df = pd.DataFrame(order_dict, index=[0])
-            data.append(new_df)
+def filter_orders_working(orders_list, filter):
+    return filter_orders(orders_list, filter)
 
-            pos_indx = pos_indx + 1
-        
-    df_all = pd.concat(data, ignore_index=True)
+def filter_orders_filled(orders_list, filter):
+    return filter_orders(orders_list, filter)
 
-    return df_all
 
 ########################################################### 
-#   Returns EQUITY instruments dataframe
+#   Partitions the positions by asset type
 ########################################################### 
+# Walks r['securitiesAccount']['positions'] once and fills plain python column lists
+# for each asset type. Each table is built once at the end, and an asset type without
+# positions gives an empty table with the same columns.
+#
 # Needs:
 #   pos_dict: positions dictionary retrived from response of TD Client r['securitiesAccount']['positions'] 
 # Returns:
-#   df_all: a dataframe with keys "symbol", "shortQuantity", "longQuantity", "averagePrice"
-#  
-def create_equities_df(pos_dict) :
-    # Convert JSON response to dictionary with the order_id, leg_id, datetime, underlying, buy_sell, symbol, quantity, status
-    order_dict = {}
-    keys = ["symbol", "shortQuantity", "longQuantity", "averagePrice"]
+#   tables: a PositionTables with
+#       options: dataframe of short OPTION positions with OPTION_POSITION_COLUMNS
+#       equities: dataframe of EQUITY positions with EQUITY_POSITION_COLUMNS
+#       fixed_income: dataframe of FIXED_INCOME positions with FIXED_INCOME_POSITION_COLUMNS
+#       counts: dictionary with the number of 'options_short', 'equities', 'fixed_income' and 'other' positions
+#
+PositionTables = namedtuple('PositionTables', ['options', 'equities', 'fixed_income', 'counts'])
 
-    df = pd.DataFrame(order_dict)
-    data = []
+OPTION_POSITION_COLUMNS = ["symbol", "putCall", "shortQuantity", "averagePrice", "underlying"]
+EQUITY_POSITION_COLUMNS = ["symbol", "shortQuantity", "longQuantity", "averagePrice"]
+FIXED_INCOME_POSITION_COLUMNS = ["cusip", "description", "maturityDate", "quantity"]
+
+def partition_positions(pos_dict) :
+    options = {key: [] for key in OPTION_POSITION_COLUMNS}
+    equities = {key: [] for key in EQUITY_POSITION_COLUMNS}
+    fixed_income = {key: [] for key in FIXED_INCOME_POSITION_COLUMNS}
+    counts = {'options_short': 0, 'equities': 0, 'fixed_income': 0, 'other': 0}
 
-    pos_indx = 0
     for pos in pos_dict:
-        if pos['instrument']['assetType'] == "EQUITY" :
-            symbol = pos['instrument']['symbol']
-            shortQuantity = pos['shortQuantity']
-            longQuantity = pos['longQuantity']
+        instrument = pos['instrument']
+        inst_type = instrument['assetType']
+
+        if inst_type == "OPTION" and pos['shortQuantity'] > 0:
+            options["symbol"].append(instrument['symbol'])
+            options["putCall"].append(instrument['putCall'])
+            options["shortQuantity"].append(pos['shortQuantity'])
+            options["averagePrice"].append(pos['averagePrice'])
+            options["underlying"].append(instrument.get('underlyingSymbol'))
+            counts['options_short'] = counts['options_short'] + 1
+        elif inst_type == "EQUITY":
+            equities["symbol"].append(instrument['symbol'])
+            equities["shortQuantity"].append(pos['shortQuantity'])
+            equities["longQuantity"].append(pos['longQuantity'])
+            equities["averagePrice"].append(pos['averagePrice'])
+            counts['equities'] = counts['equities'] + 1
+        elif inst_type == "FIXED_INCOME":
+            fixed_income["cusip"].append(instrument['cusip'])
+            fixed_income["description"].append(instrument['description'])
+            fixed_income["maturityDate"].append(instrument['maturityDate'])
+            fixed_income["quantity"].append(instrument['factor'])
+            counts['fixed_income'] = counts['fixed_income'] + 1
+        else:
+            counts['other'] = counts['other'] + 1
+
+    return PositionTables(pd.DataFrame(options, columns=OPTION_POSITION_COLUMNS),
+                          pd.DataFrame(equities, columns=EQUITY_POSITION_COLUMNS),
+                          pd.DataFrame(fixed_income, columns=FIXED_INCOME_POSITION_COLUMNS),
+                          counts)
+
+# The stop monitor and the ITM protector read the same snapshot, so the last partition
+# of each account is kept and reused for the same snapshot object. Versions are not
+# enough: every AccountSnapshotService (a restarted worker, a replay, the asyncio
+# engine) numbers its snapshots from 1 again.
+position_tables_cache = {}
+
+def snapshot_position_tables(snapshot) :
+    cached = position_tables_cache.get(snapshot.account_id)
+    if cached is not None and cached[0] is snapshot:
+        return cached[1]
+
+    tables = partition_positions(snapshot.positions)
+    position_tables_cache[snapshot.account_id] = (snapshot, tables)
+    return tables
 
-            averagePrice = pos['averagePrice']
 
-            order_dict[keys[0]] = symbol
-            order_dict[keys[1]] = shortQuantity
-            order_dict[keys[2]] = longQuantity
-            order_dict[keys[3]] = averagePrice
+########################################################### 
+#   Returns OPTION instruments dataframe
+########################################################### 
+# Needs:
+#   pos_dict: positions dictionary retrived from response of TD Client r['securitiesAccount']['positions'] 
+# Returns:
+#   df_all: a dataframe with keys "symbol", "putCall", "shortQuantity", "averagePrice", "underlying"
+#  
+def create_option_position_df(pos_dict) :
+    return partition_positions(pos_dict).options
 
-            new_df = pd.DataFrame(order_dict, index=[0])
-            data.append(new_df)
 
-            pos_indx = pos_indx + 1
-        
-    df_all = pd.concat(data, ignore_index=True)
+########################################################### 
+#   Returns FIXED_INCOME instruments dataframe
+########################################################### 
+# Needs:
+#   pos_dict: positions dictionary retrived from response of TD Client r['securitiesAccount']['positions'] 
+# Returns:
+#   df_all: a dataframe with keys "cusip", "description", "maturityDate", "quantity"
+#  
+def create_fixed_income_df(pos_dict) :
+    return partition_positions(pos_dict).fixed_income
 
-    return df_all
+########################################################### 
+#   Returns EQUITY instruments dataframe
+########################################################### 
+# Needs:
+#   pos_dict: positions dictionary retrived from response of TD Client r['securitiesAccount']['positions'] 
+# Returns:
+#   df_all: a dataframe with keys "symbol", "shortQuantity", "longQuantity", "averagePrice"
+#  
+def create_equities_df(pos_dict) :
+    return partition_positions(pos_dict).equities
 
 
 ########################################################### 
 #   Create a simple layout for the GUI
 ########################################################### 
-# Select a theme
-sg.theme('DarkGrey9')
-
-# Each row in the layout represents a column in the GUI
-layout = [
-    # Simple Text 
-    [sg.Text('Please fill out the following fields:')],
+# Built when the window is created, so importing this module does not load PySimpleGUI
+#
+def create_window(title):
+    # Select a theme
+    sg.theme('DarkGrey9')
+
+    # Each row in the layout represents a column in the GUI
+    layout = [
+        # Simple Text 
+        [sg.Text('Please fill out the following fields:')],
     
-    # Text and Input box. Text is 15 characters wide & 1 character tall. In the input field the essential thing is the key
-    # We will use the key to retrive value from the input form
-    # Timer at which to run the monitor at
-    [sg.Text('Loop Timer (seconds)', size=(20, 1)), sg.InputText(size=(10, 1), default_text='2.0', key='loop_timer')],
+        # Text and Input box. Text is 15 characters wide & 1 character tall. In the input field the essential thing is the key
+        # We will use the key to retrive value from the input form
+        # Timer at which to run the monitor at
+        [sg.Text('Loop Timer (seconds)', size=(20, 1)), sg.InputText(size=(10, 1), default_text='2.0', key='loop_timer')],
 
-     # Combo box with 2 types of STOP losses to chose from
-    [sg.Text('Stop Type', size=(20, 1)), sg.Combo(['Fix', 'Multiplier'], default_value='Fix', size=(10, 1), key='stop_type')],
+         # Combo box with 2 types of STOP losses to chose from
+        [sg.Text('Stop Type', size=(20, 1)), sg.Combo(['Fix', 'Multiplier'], default_value='Fix', size=(10, 1), key='stop_type')],
 
-    # Text and input box
-    [sg.Text('Stop Trigger', size=(20, 1)), sg.InputText(size=(10, 1), default_text='2.5', key='stop_trigger')],
+        # Text and input box
+        [sg.Text('Stop Trigger', size=(20, 1)), sg.InputText(size=(10, 1), default_text='2.5', key='stop_trigger')],
 
-    # Text and input box
-    [sg.Text('ITM Protection Offset', size=(20, 1)), sg.InputText(size=(10, 1), default_text='1.0', key='itm_protection_offset')],
+        # Text and input box
+        [sg.Text('ITM Protection Offset', size=(20, 1)), sg.InputText(size=(10, 1), default_text='1.0', key='itm_protection_offset')],
 
-    # Submit STOP order for missing stops
-    # If a user checks a checkbox, it will return True otherwise False
-    [sg.Text('Submit Orders for Missing Stops', size=(25,1)), sg.Checkbox('', default=True, key='submitStopOrders'),],
+        # Submit STOP order for missing stops
+        # If a user checks a checkbox, it will return True otherwise False
+        [sg.Text('Submit Orders for Missing Stops', size=(25,1)), sg.Checkbox('', default=True, key='submitStopOrders'),],
     
-    # Buttons
-    [sg.Submit('Start'), sg.Button('Stop'), sg.Button('Clear'), sg.Exit()]
-    #[sg.Button('Start SL Monitor', button_type=sg.Submit()), sg.Button('Stop SL Monitor'), sg.Button('Clear Form'), sg.Button('Close Form', sg.Exit())]
-]
+        # Buttons
+        [sg.Submit('Start'), sg.Button('Stop'), sg.Button('Clear'), sg.Exit()]
+        #[sg.Button('Start SL Monitor', button_type=sg.Submit()), sg.Button('Stop SL Monitor'), sg.Button('Clear Form'), sg.Button('Close Form', sg.Exit())]
+    ]
+
+    return sg.Window(title, layout, size=(300, 200))
 
 ########################################################### 
 #       GUI Functions
 ########################################################### 
 # Function to clear entries from GUI form
-def clear_input():
+def clear_input(window, values):
     for key in values:
         window[key]('')
     return None
 
-# Function to stop the thread running stop loss monitor function
-def stop_thread(event):
-    # Stop the task thread first
-    print('Stopping thread . . . ')
-    event.set()
-    return None
-
 ########################################################### 
 #       Submits STOP orders
 ########################################################### 
@@ -618,258 +2080,475 @@ def stop_thread(event):
 # Returns:
 #   order_id: order ID os the stop order placed
 #
-def sumbit_stop_orders(client, symbol, quantity, trigger) :
-    trigger = nicklefy(float(trigger))
-    print(" Preparing STOP order for = ", symbol, " quantity = ", quantity, " with STOP at = ", trigger)
+StopOrderRequest = namedtuple('StopOrderRequest', ['symbol', 'quantity', 'trigger', 'fill_time'], defaults=[None])
+
+# TDA time stamps look like 2023-05-16T14:31:02+0000
+def parse_tda_time(value):
+    return datetime.strptime(value, '%Y-%m-%dT%H:%M:%S%z')
+
+# Records the placed order in the metrics, and the time since the short was filled
+def record_stop_placed(request, order_id):
+    replace = isinstance(request, StopReplaceRequest)
+    if order_id is None:
+        metrics.inc('watcher_api_errors_total', call='replace_order' if replace else 'place_order')
+        return
+
+    metrics.inc('watcher_stops_replaced_total' if replace else 'watcher_stops_placed_total')
+    if request.fill_time:
+        fill_to_stop = (datetime.now(timezone.utc) - parse_tda_time(request.fill_time)).total_seconds()
+        metrics.observe('watcher_fill_to_stop_seconds', fill_to_stop)
+
+def build_stop_order(symbol, quantity, trigger) :
+    from tda.orders.common import Duration
+    from tda.orders.options import option_buy_to_close_stop
+
+    trigger = nicklefy(float(trigger), symbol)
+    logger.info("Preparing STOP order for = %s quantity = %s with STOP at = %s", symbol, quantity, trigger)
     stop_order = option_buy_to_close_stop(symbol, quantity, trigger)
-    stop_order.set_duration(orders.common.Duration.GOOD_TILL_CANCEL) 
+    stop_order.set_duration(Duration.GOOD_TILL_CANCEL)
+    return stop_order
 
-    # Place the Stop order
-    r = client.place_order(config.ACCOUNT_ID_REGULAR, stop_order)  
-    
-    print("Order status code - ", r.status_code)
+# Order ID from the Location header of a place_order or replace_order response
+def extract_order_id(client, account_id, r) :
+    from tda.utils import Utils
+    return Utils(client, account_id).extract_order_id(r)
+
+# Checks the place_order response and returns the order ID, or None if the order failed
+def stop_order_placed(client, account_id, r) :
+    logger.debug("Order status code - %s", r.status_code)
     if r.status_code < 400:  # http codes under 400 are success. usually 200 or 201
-        order_id = Utils(client, config.ACCOUNT_ID_REGULAR).extract_order_id(r)
-        print("Order placed, order ID-", order_id)
+        order_id = extract_order_id(client, account_id, r)
+        logger.debug("Order placed, order ID-%s", order_id)
     else:
-        print("FAILED - placing the order failed.")
+        logger.error("FAILED - placing the order failed, status code: %s", r.status_code)
 
         # Send notification to discord
-        if discord_notification_level != 0:
-            discord_message = "Failed placing the STOP Order"
-            discord.post(content=discord_message)
-
-        make_closing_trade = False  # stop the closing order
-        return
+        notify("Failed placing the STOP Order")
+        return None
 
     # This order ID can then be used to monitor or modify the order
-    print("Buy to Close order placed, order ID:", order_id)
+    logger.info("Buy to Close order placed, order ID: %s", order_id)
 
     # Send notification to discord
-    if discord_notification_level != 0:  
-        discord_message = "Buy to Close order placed, order ID: " + str(order_id)
-        discord.post(content=discord_message)
+    notify("Buy to Close order placed, order ID: " + str(order_id))
 
     return order_id
 
+def sumbit_stop_orders(client, account_id, symbol, quantity, trigger) :
+    return place_stop_order(client, account_id, StopOrderRequest(symbol, quantity, trigger)).order_id
+
+
+###########################################################
+#       Submission journal
+###########################################################
+# STOP orders are journaled (see submission_journal.py) so that a stop the orders book
+# does not show yet is not placed a second time. config.SUBMISSION_JOURNAL = None
+# disables the journal.
+#
+# Opened on first use and kept for the life of the process
+submission_journal = None
+submission_journal_lock = threading.Lock()
+
+def get_submission_journal():
+    global submission_journal
+
+    with submission_journal_lock:
+        if submission_journal is None and config.SUBMISSION_JOURNAL:
+            submission_journal = SubmissionJournal(config.SUBMISSION_JOURNAL, config.SUBMISSION_TTL_SECONDS)
+    return submission_journal
+
+def journal_begin(account_id, request):
+    journal = get_submission_journal()
+    if journal is None:
+        return None
+    return journal.begin(account_id, request.symbol, request.quantity, request.trigger)
+
+def journal_placed(entry_id, order_id):
+    if entry_id is None:
+        return
+    if order_id is None:
+        get_submission_journal().failed(entry_id)
+    else:
+        get_submission_journal().placed(entry_id, order_id)
+
+# A request that timed out or lost its response (e.g. ReadError, RemoteProtocolError) may
+# still have reached TDA, so it stays in flight until it shows up in the orders book or
+# expires. Without a connection it was never sent.
+def journal_error(entry_id, error):
+    if entry_id is not None and isinstance(error, (httpx.ConnectError, httpx.ConnectTimeout, httpx.PoolTimeout)):
+        get_submission_journal().failed(entry_id)
+
+# Returns the quantity still in flight per symbol for the account of the snapshot
+def journal_in_flight(account_id, order_index):
+    journal = get_submission_journal()
+    if journal is None:
+        return {}
+
+    in_flight = {}
+    for entry in journal.in_flight(account_id, order_index.orders):
+        in_flight[entry.symbol] = in_flight.get(entry.symbol, 0) + entry.quantity
+    return in_flight
+
+
+########################################################### 
+#       Submits a batch of STOP orders concurrently
+########################################################### 
+# All the missing stops of a cycle are placed at the same time, with at most
+# config.MAX_IN_FLIGHT_ORDERS place_order calls in flight, so the last position
+# of a burst is protected within one round trip instead of N.
+#
+# Needs:
+#   account_id: TD account where the orders are placed
+#   stop_requests: list of StopOrderRequest (new stops) and StopReplaceRequest (quantity fixes)
+# Returns:
+#   results: list of StopOrderResult (same order as stop_requests). status_code is None
+#            when the request did not reach the server, latency is in seconds.
+#
+StopOrderResult = namedtuple('StopOrderResult', ['symbol', 'quantity', 'trigger', 'order_id', 'status_code', 'latency'])
+
+# Created on first use (under order_executor_lock, several accounts can submit at the
+# same time) and kept for the life of the process
+order_executor = None
+order_executor_lock = threading.Lock()
+
+def place_stop_order(client, account_id, request) :
+    stop_order = build_stop_order(request.symbol, request.quantity, request.trigger)
+    entry_id = journal_begin(account_id, request)
+
+    # Place the Stop order, or replace the existing one (StopReplaceRequest)
+    request_budget.acquire()
+    start = time.perf_counter()
+    try:
+        if isinstance(request, StopReplaceRequest):
+            logger.info("Replacing STOP order %s of %s, quantity %s -> %s", request.order_id, request.symbol, request.old_quantity, request.quantity)
+            r = client.replace_order(account_id, request.order_id, stop_order)
+        else:
+            r = client.place_order(account_id, stop_order)
+    except httpx.HTTPError as e:
+        logger.error("FAILED - placing the order failed: %r", e)
+        notify("Failed placing the STOP Order")
+        record_stop_placed(request, None)
+        journal_error(entry_id, e)
+        return StopOrderResult(request.symbol, request.quantity, request.trigger, None, None, time.perf_counter() - start)
+
+    latency = time.perf_counter() - start
+    order_id = stop_order_placed(client, account_id, r)
+    record_stop_placed(request, order_id)
+    journal_placed(entry_id, order_id)
+    return StopOrderResult(request.symbol, request.quantity, request.trigger, order_id, r.status_code, latency)
+
+def submit_stop_batch(client, account_id, stop_requests) :
+    global order_executor
+
+    if len(stop_requests) == 0:
+        return []
+
+    if len(stop_requests) == 1:
+        results = [place_stop_order(client, account_id, stop_requests[0])]
+    else:
+        with order_executor_lock:
+            if order_executor is None:
+                order_executor = ThreadPoolExecutor(max_workers=config.MAX_IN_FLIGHT_ORDERS, thread_name_prefix='stop_orders')
+        results = list(order_executor.map(lambda request: place_stop_order(client, account_id, request), stop_requests))
+
+    log_stop_batch_results(account_id, results)
+    return results
+
+def log_stop_batch_results(account_id, results) :
+    stats = get_account_stats(account_id)
+    num_placed = len([result for result in results if result.order_id is not None])
+    stats['stops_placed'] = stats['stops_placed'] + num_placed
+    stats['stop_errors'] = stats['stop_errors'] + len(results) - num_placed
+
+    logger.info("STOP orders submitted for account %s: %d", account_id, len(results))
+    for result in results:
+        logger.info("  %s quantity=%s order_id=%s status=%s latency=%.3fs",
+                    result.symbol, result.quantity, result.order_id, result.status_code, result.latency)
+
+
+########################################################### 
+#       Stop orders monitor cycle
+########################################################### 
+# Runs one reconciliation cycle on an account snapshot. It does not call the TD API,
+# so it is shared by the threaded stop_monitor and the asyncio engine.
+#
+# Needs:
+#   order_index: OrderBookIndex kept by the caller between cycles
+#   snapshot: AccountSnapshot to reconcile
+#   stop_type: type of STOP, either 'Fix' or 'Multiplier'
+#   stop_trigger: trigger price (Fix) or multiplier of the fill price (Multiplier) for the STOP
+# Returns:
+#   stop_requests: list of StopOrderRequest and StopReplaceRequest to submit, or None if nothing changed since the last cycle
+#
+def run_stop_cycle(order_index, snapshot, stop_type, stop_trigger):
+    # Skip the whole cycle when neither orders nor positions changed since the last one
+    positions_dict = snapshot.positions
+    with stage_timer('diff'):
+        touched_symbols = order_index.update(positions_dict, snapshot.orders)
+    if touched_symbols is None:
+        return None
+    metrics.inc('watcher_cycles_total')
+
+    stats = get_account_stats(snapshot.account_id)
+    stats['cycles'] = stats['cycles'] + 1
+
+    logger.info("The Watcher is monitoring Short positions of account %s, snapshot %d, symbols changed since last cycle: %s",
+                snapshot.account_id, snapshot.version, sorted(touched_symbols))
+
+    #----------------------------------------------------------------------------------------
+    # Step 1: Get open positions for a given account_ID (we will need to read positions)
+    #----------------------------------------------------------------------------------------
+    logger.debug("Number of open positions = %d", len(positions_dict))
+
+    # calculate number of positions for various instruments
+    with stage_timer('parse'):
+        position_tables = snapshot_position_tables(snapshot)
+    num_options_short = position_tables.counts['options_short']
+
+    logger.debug("Number of FIXED INCOME positions = %d", position_tables.counts['fixed_income'])
+    logger.debug("Number of EQUITY positions = %d", position_tables.counts['equities'])
+    logger.info("Number of open SHORT OPTION positions = %d", num_options_short)
+
+    # Send notification to discord
+    notify("Number of open SHORT OPTION positions = " + str(num_options_short), level=2)
+
+    #----------------------------------------------------------------------------------------
+    # Step 2: Get orders book for today (we will need to read orders not positions)
+    #----------------------------------------------------------------------------------------
+    # Only the legs of the symbols touched since the last cycle are reconciled: symbols with a new
+    # or changed order (a fill, or a stop that was cancelled, expired or rejected), a changed
+    # position, or still pending from an earlier cycle
+    with stage_timer('parse'):
+        df_filled_orders = order_index.frame('FILLED', touched_symbols)
+
+    # Print orders Dataframe
+    log_table("Filled Orders:", df_filled_orders, order_index.changed)
+
+    stop_requests = []
+
+    # Every open short must stay protected, also one opened before today (no fill in today's
+    # book) whose stop was cancelled. Without open shorts there is nothing left to re-check.
+    if num_options_short == 0:
+        order_index.mark_pending([])
+    else:
+        df_pos = position_tables.options
+        df_pos = df_pos[df_pos['symbol'].isin(touched_symbols)].reset_index(drop=True)
+
+        # Print positions Dataframe
+        log_table("Open Positions:", df_pos, order_index.changed)
+
+        # Following dataframe keeps track of order ID and short strikes. This information is used to calculate
+        # multiplier loss for scenarios when there are orders for the same strike but different entry price. This
+        # may lead to multiple STOP orders because we might have STO 1 lot at price x and the other lot at price y.
+        # For the fix STOP this information is not useful because we will always use a fix STOP.
+        df_order_tracker = df_filled_orders[['symbol', 'order_id', 'quantity', 'price']]
+
+        # Total quantity and average fill price per symbol from all the orders (only needed for the log)
+        if table_logging_enabled(order_index.changed):
+            log_table("Quantity in positions dataframe:", summarize_fills(df_order_tracker), order_index.changed)
+
+        # Extract open orders. A stop the broker has accepted but not yet activated (e.g. QUEUED
+        # outside market hours) covers its short as much as a WORKING one.
+        with stage_timer('parse'):
+            df_stop = order_index.open_frame(touched_symbols)
+
+        # Print orders Dataframe
+        log_table("Open Stops:", df_stop, order_index.changed)
+
+        # Calculate total quantity per symbol from all the working stop orders (only needed for the log)
+        if table_logging_enabled(order_index.changed):
+            df_symbol_qty2 = df_stop[['symbol', 'quantity']]
+            quantity_stop_df = calc_symbol_quantity(df_symbol_qty2)
+        
+            log_table("Quantity in Stops dataframe:", quantity_stop_df, order_index.changed)
+
+        # Orphaned stops are only reported. Shorts without a stop get a new STOP order, and shorts
+        # whose stop quantity does not match the open quantity get their stop replaced.
+        with stage_timer('reconcile'):
+            reconciliation = find_missing_stops(df_pos, df_stop)
+        metrics.inc('watcher_stops_missing_total', len(reconciliation.missing))
+        metrics.inc('watcher_stop_mismatches_total', len(reconciliation.mismatched) + len(reconciliation.over_hedged))
+
+        # Stops submitted or replaced in earlier cycles that the orders book does not show yet
+        # cover their short, until they are confirmed or expire
+        in_flight = journal_in_flight(snapshot.account_id, order_index)
+        mismatch_gaps = reconciliation.mismatched + reconciliation.over_hedged
+        covered_symbols = [gap.symbol for gap in reconciliation.missing + mismatch_gaps if gap.symbol in in_flight]
+        if len(covered_symbols) > 0:
+            logger.info("STOP orders still in flight for: %s", covered_symbols)
+            metrics.inc('watcher_stops_in_flight_total', len(covered_symbols))
+        stop_gaps = [gap for gap in reconciliation.missing if gap.symbol not in in_flight]
+        mismatch_gaps = [gap for gap in mismatch_gaps if gap.symbol not in in_flight]
+
+        # Time of the last fill of each symbol, to measure how long it takes to protect it
+        fill_times = {}
+        for symbol, close_time in zip(df_filled_orders['symbol'], df_filled_orders['close_time']):
+            if close_time and close_time > fill_times.get(symbol, ''):
+                fill_times[symbol] = close_time
+
+        num_missing_stops = len(stop_gaps)
+        missing_symbols = [gap.symbol for gap in stop_gaps]
+        missing_quantity = [gap.short_quantity for gap in stop_gaps]
+
+        # Quantity mismatches are fixed by replacing an existing stop, not by adding one
+        replace_requests = plan_stop_replacements(mismatch_gaps, fill_times)
+
+        # Symbols that are still missing a stop, or whose stop is in flight, are checked again on the next
+        # cycle. They stay pending until the orders book shows their stop.
+        order_index.mark_pending(missing_symbols + [request.symbol for request in replace_requests] + list(in_flight))
+
+        #------------------------------------------------------
+        # Step 3: Prepare STOP orders for missing positions
+        #------------------------------------------------------
+        if num_missing_stops > 0 :
+            logger.warning("Found missing stops in the following positions: %s", missing_symbols)
+            
+            # Send notification to discord
+            notify("Found missing stops in the following positions:" + str(missing_symbols), level=2)
+
+        # stop_type, stop_trigger
+        if stop_type == 'Fix' :
+            for i in range(0, num_missing_stops) :
+                trigger = stop_trigger
+                stop_requests.append(StopOrderRequest(missing_symbols[i], int(missing_quantity[i]), trigger, fill_times.get(missing_symbols[i])))
+        elif num_missing_stops > 0 :
+            # Single STOP order at average fill price, or one STOP for each order (see compute_stop_triggers)
+            df_missing_pos = df_pos[df_pos['symbol'].isin(missing_symbols)]
+            df_triggers = compute_stop_triggers(df_order_tracker[df_order_tracker['symbol'].isin(missing_symbols)], df_missing_pos, float(stop_trigger))
+            for symbol, quantity, stop_price in zip(df_triggers['symbol'], df_triggers['quantity'], df_triggers['stop_price']) :
+                stop_requests.append(StopOrderRequest(symbol, int(quantity), float(stop_price), fill_times.get(symbol)))
+
+        # Replacements go out in the same batch as the new stops
+        stop_requests.extend(replace_requests)
+
+    return stop_requests
+
 
 ########################################################### 
 #       Stop orders monitor
 ########################################################### 
+# Runs in one thread per account.
+#
 # Needs:
+#   snapshots: AccountSnapshotService publishing the account positions and orders
 #   stop_type: type of STOP, either 'Fix' or 'Multiplier'
 #   stop_trigger: trigger price for the STOP
 #   submit_stop_orders: a flag, either 'TRUE' or 'FALSE'
 #       If 'TRUE' stop order will be placed for an open
 #       short option position that does not have a 
-#       corresponding stop order in WORKING status.
+#       corresponding open (e.g. WORKING) stop order.
 #
-def stop_monitor(event, loop_timer, stop_type, stop_trigger, submit_stop_orders):
-    # Create a TD API client
-    client = create_td_client()
+def stop_monitor(event, snapshots, loop_timer, stop_type, stop_trigger, submit_stop_orders):
+    # The TD API client is shared with the snapshot fetcher
+    client = snapshots.client
+    version = 0
+
+    # Orders parsed in previous cycles, so that only new or changed orders are parsed again
+    order_index = OrderBookIndex()
     
     while True:
-        print("The Watcher is monitoring Short positions: ", datetime.now())
-
         # If "Stop" button is pressed on the GUI, end Stop Loss Monitor thread
         if event.is_set():
-            print("Stopped The Watcher task at: ", datetime.now())
+            logger.info("Stopped The Watcher task")
             break
 
-        #----------------------------------------------------------------------------------------
-        # Step 1: Get open positions for a given account_ID (we will need to read positions)
-        #----------------------------------------------------------------------------------------
-        response = get_open_positions(client)
-        r = json.load(response)  # Convert to JSON
-        num_open_pos = len(r)
-        print("Number of open positions = ", num_open_pos)
-
-        # calculate number of positions for various instruments
-        num_fixed_income = 0
-        num_equities = 0
-        num_options_short = 0
-        num_other = 0
-
-        pos_indx = 0
-        positions_dict = r['securitiesAccount']['positions']           # extract positions list from response
-        for current_pos in positions_dict:  
-            #print(json.dumps(current_pos, indent=4))
-            #print("Processing position: ", pos_indx)  
-
-            inst_type = current_pos['instrument']['assetType']
-            if inst_type == "FIXED_INCOME":
-                num_fixed_income = num_fixed_income + 1
-            elif inst_type == 'EQUITY':
-                num_equities = num_equities + 1
-            elif inst_type == 'OPTION' and current_pos['shortQuantity'] > 0:
-                num_options_short = num_options_short + 1
-            else:
-                num_other = num_other + 1
+        # Wait for the next account snapshot published by the fetcher
+        snapshot = snapshots.wait_for_update(version, timeout=loop_timer)
+        if snapshot is None:
+            continue
+        version = snapshot.version
+
+        with stage_timer('cycle'):
+            stop_requests = run_stop_cycle(order_index, snapshot, stop_type, stop_trigger)
+        if not stop_requests:
+            continue
+
+        # Submit STOP orders for missing positions, all at once
+        if submit_stop_orders :
+            with stage_timer('submit'):
+                submit_stop_batch(client, snapshots.account_id, stop_requests)
+        else :
+            logger.info("User selected not to submit missing stops . . . ")
+  
+    return
 
-            pos_indx = pos_indx + 1
 
-        # print("Number of FIXED INCOME positions = ", num_fixed_income)
-        # print("Number of EQUITY positions = ", num_equities)
-        print("Number of open SHORT OPTION positions = ", num_options_short)
+########################################################### 
+#       In-The-Money Protector cycle
+########################################################### 
+# Finds the short positions that need ITM protection in an account snapshot, using the
+# latest underlying quotes. Like run_stop_cycle() it does not call the TD API, and it is
+# cheap enough to run between snapshots, every config.ITM_CHECK_SECONDS.
+#
+# Returns:
+#   itm_positions: list of ItmPosition describing the positions to protect
+#
+def run_itm_cycle(snapshot, itm_offset):
+    #----------------------------------------------------------------------------------------
+    # Step 1: Get open positions for a given account_ID (we will need to read positions)
+    #----------------------------------------------------------------------------------------
+    position_tables = snapshot_position_tables(snapshot)
+    num_options_short = position_tables.counts['options_short']
+    if num_options_short == 0:
+        return []
+
+    #----------------------------------------------------------------------------------------
+    # Step 2: Shorts within itm_offset of the underlying, with their working STOP orders
+    #----------------------------------------------------------------------------------------
+    strike_index = snapshot_strike_index(snapshot)
+    itm_positions = find_itm_short_positions(float(itm_offset), strike_index, snapshot.orders)
+    if len(itm_positions) > 0:
+        logger.debug("Shorts near the money in account %s: %s", snapshot.account_id, [position.symbol for position in itm_positions])
+
+    return itm_positions
 
-        # Send notification to discord
-        if discord_notification_level == 2:
-            discord_message = "Number of open SHORT OPTION positions = " + str(num_options_short)
-            discord.post(content=discord_message)
-
-        #----------------------------------------------------------------------------------------
-        # Step 2: Get orders book for today (we will need to read orders not positions)
-        #----------------------------------------------------------------------------------------
-        response = get_orders_book(client)
-        r = json.load(response)  # Convert to JSON
-        # num_orders = len(r)
-        # print("Number of orders = ", num_orders)
-
-        # Extract FILLED orders list
-        orders_filled_list = r['securitiesAccount']['orderStrategies']
-        filter_order_type = 'FILLED'
-        df_filled_orders = filter_orders_filled(orders_filled_list, filter_order_type)
-        num_filled_orders = len(df_filled_orders)
-
-        # # Simulated Scenario
-        # f1 = 'kirk_filled_orders_df.csv'
-        # df_filled_orders = pd.read_csv(f1)
-        # num_filled_orders = len(df_filled_orders)
 
-        # Print orders Dataframe
-        print("")
-        print("Filled Orders:")
-        print(df_filled_orders)
-        print("")
-
-        # Stop Monitor is intended to be used for "Today's" trades.
-        # Therefore, if there are no open short positions and no FILLED orders (for today), it will 
-        # idle until an order is FILLED
-        if ((num_options_short > 0) and (num_filled_orders > 0)):
-            df_pos = create_option_position_df(positions_dict)
-
-            # # Simulated Scenario
-            # f2 = 'kirk_open_pos_df.csv'
-            # df_pos = pd.read_csv(f2)
-
-            # Print positions Dataframe
-            print("")
-            print("Open Positions:")
-            print(df_pos)
-            print("")
-
-            # Following dataframe keeps track of order ID and short strikes. This information is used to calculate
-            # multiplier loss for scenarios when there are orders for the same strike but different entry price. This
-            # may lead to multiple STOP orders because we might have STO 1 lot at price x and the other lot at price y.
-            # For the fix STOP this information is not useful because we will always use a fix STOP.
-            df_order_tracker = df_filled_orders[['symbol', 'order_id', 'quantity', 'price']]
-            # print(df_order_tracker)
-
-            # Calculate total quantity per symbol from all the orders
-            df_symbol_qty = df_filled_orders[['symbol', 'quantity', 'price']]
-            quantity_pos_df = calc_symbol_quantity(df_symbol_qty)
-
-            # Calculate average price
-            for i in range(0, len(quantity_pos_df)) :
-                x = quantity_pos_df.iloc[i]['price'] /quantity_pos_df.iloc[i]['quantity'] 
-                quantity_pos_df.loc[i, 'price'] = x
-
-            # # Simulated Scenario
-            # f3 = 'kirk_qty_pos_df.csv'
-            # quantity_pos_df = pd.read_csv(f3)
-
-            print("")
-            print("Quantity in positions dataframe:")
-            print(quantity_pos_df)
-            print("")  
-
-            # Extract working orders list
-            orders_working_list = r['securitiesAccount']['orderStrategies']
-            filter_order_type = 'WORKING'
-            df_stop = filter_orders_working(orders_working_list, filter_order_type)
-            
-            # # Simulated Scenario
-            # f4 = 'kirk_working_stops.csv'
-            # df_stop = pd.read_csv(f4)
+########################################################### 
+#       Replaces BTC STOP orders with a BTC MARKET order
+########################################################### 
+# The working STOP orders of the position are cancelled first, so the position cannot
+# be closed twice. If a cancel fails (e.g. the STOP just triggered) no MARKET order is sent.
+#
+# Returns:
+#   order_id: ID of the MARKET order, or None if the replacement failed
+#
+def sumbit_btc_market_order(client, account_id, position) :
+    from tda.orders.options import option_buy_to_close_market
+
+    for stop_order_id in position.stop_order_ids:
+        request_budget.acquire()
+        try:
+            r = client.cancel_order(stop_order_id, account_id)
+        except (httpx.ConnectError, httpx.TimeoutException):
+            r = None
+
+        if r is None or r.status_code >= 400:
+            logger.error("FAILED - cancelling STOP order %s of %s: %s", stop_order_id, position.symbol, "no response" if r is None else r.status_code)
+            metrics.inc('watcher_api_errors_total', call='cancel_order')
+            notify("Failed cancelling the STOP Order of: " + str(position.symbol))
+            return None
+
+    market_order = option_buy_to_close_market(position.symbol, position.quantity)
+    request_budget.acquire()
+    try:
+        r = client.place_order(account_id, market_order)
+    except (httpx.ConnectError, httpx.TimeoutException):
+        r = None
 
-            # Print orders Dataframe
-            print("")
-            print("Working Stops:")
-            print(df_stop)
-            print("")
+    if r is None or r.status_code >= 400:
+        logger.error("FAILED - placing the MARKET order for %s: %s", position.symbol, "no response" if r is None else r.status_code)
+        metrics.inc('watcher_api_errors_total', call='place_order')
+        notify("Failed placing the MARKET Order for: " + str(position.symbol))
+        return None
 
-            # Calculate total quantity per symbol from all the working stop orders
-            df_symbol_qty2 = df_stop[['symbol', 'quantity']]
-            quantity_stop_df = calc_symbol_quantity(df_symbol_qty2)
-            
-            # # Simulated Scenario
-            # f5 = 'kirk_qty_stops_df.csv'
-            # quantity_stop_df = pd.read_csv(f5)
-            
-            print("")
-            print("Quantity in Stops dataframe:")
-            print(quantity_stop_df)
-            print("")  
-
-            open_shorts = []
-            quantity_open_shorts = 0
-            avg_price_open_shorts = 0
-            if len(df_pos.index > 0):
-                open_shorts = df_pos["symbol"].values.tolist()
-                quantity_open_shorts = df_pos["shortQuantity"].values.tolist()
-                avg_price_open_shorts = df_pos["averagePrice"].values.tolist()
-            
-            working_stops = []
-            quantity_working_stops = 0
-            if len(df_stop.index > 0):
-                working_stops = df_stop["symbol"].values.tolist()
-                quantity_working_stops = df_stop["quantity"].values.tolist()
-
-            num_missing_stops, missing_symbols, missing_quantity, missing_avg_price = find_missing_stops(quantity_pos_df, quantity_stop_df,
-                        open_shorts, quantity_open_shorts, avg_price_open_shorts, working_stops, quantity_working_stops)
-
-            #------------------------------------------------------
-            # Step 3: Submit STOP orders for missing positions
-            #------------------------------------------------------
-            if submit_stop_orders :
-                if num_missing_stops > 0 :
-                    print("Found missing stops in the following positions:")
-                    print(missing_symbols)
-                    
-                    # Send notification to discord
-                    if discord_notification_level == 2:
-                        discord_message = "Found missing stops in the following positions:" + str(missing_symbols)
-                        discord.post(content=discord_message)
-
-                    # Submit Stop orders for the missing
-                    # stop_type, stop_trigger
-                    for i in range(0, num_missing_stops) :
-                        if stop_type == 'Fix' :
-                            trigger = stop_trigger                    
-                            sumbit_stop_orders(client, missing_symbols[i], int(missing_quantity[i]), trigger)
-                        else :
-                            num_stops_required = find_num_stops_required(missing_symbols[i], df_order_tracker)
-                            if num_stops_required == 1:
-                                # Submit single STOP order at average fill price
-                                trigger = float(stop_trigger) * float(missing_avg_price[i])                  
-                                sumbit_stop_orders(client, missing_symbols[i], int(missing_quantity[i]), trigger)
-                            else:
-                                # Submit multiple STOP orders, one for wach order                  
-                                trigger_df = find_stop_trigger(stop_trigger, missing_symbols[i], df_order_tracker)
-
-                                for j in range(0, num_stops_required) :
-                                    missing_quantity = int(trigger_df.iloc[j]['quantity'])
-                                    trigger =  float(trigger_df.iloc[j]['trigger'])                  
-                                    sumbit_stop_orders(client, missing_symbols[i], missing_quantity, trigger)
-
-            else :
-                print("User selected not to submit missing stops . . . ")
-
-            time.sleep(loop_timer)
-
-        time.sleep(loop_timer)
-  
-    return
+    order_id = extract_order_id(client, account_id, r)
+    logger.warning("ITM protection: %s quantity=%s strike=%s underlying=%s, STOP orders %s replaced by MARKET order %s",
+                   position.symbol, position.quantity, position.strike, position.underlying_price, position.stop_order_ids, order_id)
+
+    # Send notification to discord
+    notify("ITM protection: Buy to Close MARKET order placed for " + str(position.symbol) + ", order ID: " + str(order_id))
+
+    return order_id
 
 
 ########################################################### 
@@ -878,138 +2557,653 @@ def stop_monitor(event, loop_timer, stop_type, stop_trigger, submit_stop_orders)
 # If SPX is within distance (defined by the user) to a short position, 
 # it will replace the STOP order with "MARKET" order and done.
 #
-def in_the_money_protector(event, loop_timer, itm_offset):
-    # Create a TD API client
-    client = create_td_client()
+# Positions are checked on every new snapshot and every config.ITM_CHECK_SECONDS in
+# between, against the latest underlying quotes.
+#
+def in_the_money_protector(event, snapshots, loop_timer, itm_offset):
+    # The TD API client is shared with the snapshot fetcher
+    client = snapshots.client
+    version = 0
+    snapshot = None
+
+    # Symbols already closed with a MARKET order, until they leave the positions
+    protected = set()
     
     while True:
-        print("In The Money Protector is running . . .: ", datetime.now())
-
         # If "Stop" button is pressed on the GUI, end ITM Protector thread
         if event.is_set():
-            print("Stopped In-The-Money Protector task at: ", datetime.now())
+            logger.info("Stopped In-The-Money Protector task")
             break
 
-        #----------------------------------------------------------------------------------------
-        # Step 1: Get open positions for a given account_ID (we will need to read positions)
-        #----------------------------------------------------------------------------------------
-        response = get_open_positions(client)
-        r = json.load(response)  # Convert to JSON
-        num_open_pos = len(r)
-
-        # calculate number of positions for various instruments
-        num_options_short = 0
-        pos_indx = 0
-        positions_dict = r['securitiesAccount']['positions']           # extract positions list from response
-        for current_pos in positions_dict:  
-            inst_type = current_pos['instrument']['assetType']
-            if inst_type == 'OPTION' and current_pos['shortQuantity'] > 0:
-                num_options_short = num_options_short + 1
-
-            pos_indx = pos_indx + 1
-
-        print("Number of open SHORT OPTION positions = ", num_options_short)
-
-        #----------------------------------------------------------------------------------------
-        # Step 2: Get orders book for today (we will need to read orders not positions)
-        #----------------------------------------------------------------------------------------
-        response = get_orders_book(client)
-        r = json.load(response)  # Convert to JSON
-
-        # Extract working orders list
-        orders_working_list = r['securitiesAccount']['orderStrategies']
-        filter_order_type = 'WORKING'
-        df_stop = filter_orders_working(orders_working_list, filter_order_type)
-        num_working_stops = len(df_stop)
-        print("Number of WORKING STOP orders = ", num_working_stops)
-
-        if (num_options_short > 0):
-            df_pos = create_option_position_df(positions_dict)
-
-            open_shorts = []
-            quantity_open_shorts = 0
-            avg_price_open_shorts = 0
-            if len(df_pos.index > 0):
-                open_shorts = df_pos["symbol"].values.tolist()
-                quantity_open_shorts = df_pos["shortQuantity"].values.tolist()
-                avg_price_open_shorts = df_pos["averagePrice"].values.tolist()
-            
-            working_stops = []
-            quantity_working_stops = 0
-            if len(df_stop.index > 0):
-                working_stops = df_stop["symbol"].values.tolist()
-                quantity_working_stops = df_stop["quantity"].values.tolist()
-
-            num_itm_positions, itm_symbols, itm_quantity, stop_order_id = find_itm_short_positions(itm_offset, open_shorts, quantity_open_shorts, working_stops)
-
-            #------------------------------------------------------
-            # Step 3: Replace BTC STOP order with BTC MARKET Order
-            #------------------------------------------------------
-            if num_missing_stops > 0 :
-                print("ITM protection activated for the following positions:")
-                print(itm_symbols)
-                
-                # Send notification to discord
-                if discord_notification_level == 2:
-                    discord_message = "ITM protection activated for the following positions:" + str(missing_symbols)
-                    discord.post(content=discord_message)
-
-                for i in range(0, num_missing_stops) :
-                    sumbit_btc_market_order(client, missing_symbols[i], int(missing_quantity[i]), trigger)
-
-            time.sleep(loop_timer)
-
-        time.sleep(loop_timer)
+        # Wait for the next account snapshot, or check the last one again with fresh quotes
+        update = snapshots.wait_for_update(version, timeout=config.ITM_CHECK_SECONDS)
+        if update is not None:
+            snapshot = update
+            version = snapshot.version
+            protected = protected & set(snapshot_position_tables(snapshot).options['symbol'])
+        if snapshot is None:
+            continue
+
+        itm_positions = [position for position in run_itm_cycle(snapshot, itm_offset) if position.symbol not in protected]
+
+        #------------------------------------------------------
+        # Step 3: Replace BTC STOP order with BTC MARKET Order
+        #------------------------------------------------------
+        for position in itm_positions :
+            logger.warning("ITM protection activated for: %s", position.symbol)
+            if sumbit_btc_market_order(client, snapshots.account_id, position) is not None:
+                protected.add(position.symbol)
+                snapshots.request_refresh()
   
     return
 
 
+########################################################### 
+#       Asyncio monitor engine
+########################################################### 
+# Runs the snapshot fetcher, the stop monitor, the ITM protector and the discord
+# notification delivery as coroutines on a single event loop, using the tda async
+# client (httpx) instead of one blocking thread per worker. At most
+# config.MAX_CONCURRENT_REQUESTS API calls are in flight at a time, and every
+# coroutine is cancelled as soon as the stop event (GUI Stop button) is set.
+#
+# There is one engine per account. All engines share the client and the request
+# limits, and a single fetch coroutine polls their accounts with the AccountScheduler.
+#
+# The reconciliation itself is shared with the threaded workers (run_stop_cycle,
+# run_itm_cycle).
+#
+class AsyncMonitorEngine:
+    def __init__(self, client, account_id, loop_timer, stop_type, stop_trigger, submit_stop_orders, itm_offset, run_itm_protector=False):
+        self.client = client
+        self.account_id = account_id
+        self.loop_timer = loop_timer
+        self.stop_type = stop_type
+        self.stop_trigger = stop_trigger
+        self.submit_stop_orders = submit_stop_orders
+        self.itm_offset = itm_offset
+        self.run_itm_protector = run_itm_protector
+        self.refresh_requested = False
+        self.stats = get_account_stats(account_id)
+        self.order_cache = OrderHistoryCache()
+
+        self._snapshot = None
+        self._updated = None
+        self._refresh = None
+        self._semaphore = None
+        self._orders_in_flight = None
+        self._loop = None
+
+    # Binds the engine to the running event loop and to the limits shared by all engines
+    def start(self, semaphore, refresh):
+        self._loop = asyncio.get_running_loop()
+        self._updated = asyncio.Condition()
+        self._refresh = refresh
+        self._semaphore = semaphore
+        self._orders_in_flight = asyncio.Semaphore(config.MAX_IN_FLIGHT_ORDERS)
+
+    # Runs a TD API coroutine function with bounded concurrency
+    async def request(self, api_call, *args, **kwargs):
+        await request_budget.acquire_async()
+        async with self._semaphore:
+            return await api_call(*args, **kwargs)
+
+    async def publish(self, positions, orders):
+        async with self._updated:
+            version = 1 if self._snapshot is None else self._snapshot.version + 1
+            self._snapshot = AccountSnapshot(version, datetime.now(), tuple(positions), tuple(orders), self.account_id)
+            self._updated.notify_all()
+
+    def latest(self):
+        return self._snapshot
+
+    async def wait_for_update(self, version):
+        async with self._updated:
+            await self._updated.wait_for(lambda: self._snapshot is not None and self._snapshot.version > version)
+            return self._snapshot
+
+    # Same interface as AccountSnapshotService, used by the streaming handlers.
+    # Safe to call from any thread.
+    def request_refresh(self):
+        self.refresh_requested = True
+        self._loop.call_soon_threadsafe(self._refresh.set)
+
+    # Same as AccountSnapshotService.fetch()
+    async def fetch(self):
+        self.stats['fetches'] = self.stats['fetches'] + 1
+        if config.ORDER_FETCH_MODE == 'incremental' and not self.order_cache.needs_resync(time.monotonic()):
+            result = await self.fetch_incremental()
+        else:
+            result = await self.fetch_full()
+
+        if result is None:
+            self.stats['fetch_errors'] = self.stats['fetch_errors'] + 1
+        else:
+            await self.publish(*result)
+
+    # Runs a TD API call, returns the response or None if it failed
+    async def fetch_call(self, call, api_call, *args, **kwargs):
+        try:
+            response = await self.request(api_call, *args, **kwargs)
+        except (httpx.ConnectError, httpx.TimeoutException):
+            response = None
+
+        if response_failed(response):
+            logger.error("Failed to retrieve account %s %s: %s", self.account_id, call, "no response" if response is None else response.status_code)
+            metrics.inc('watcher_api_errors_total', call=call)
+            return None
+        return response
+
+    async def fetch_full(self):
+        fields = [self.client.Account.Fields('positions'), self.client.Account.Fields('orders')]
+        with stage_timer('get_account'):
+            response = await self.fetch_call('get_account', self.client.get_account, self.account_id, fields=fields)
+        if response is None:
+            return None
+        record_fetch_bytes(self.account_id, 'full', len(response.content))
+
+        with stage_timer('decode'):
+            account = response.json()['securitiesAccount']
+        orders_list = account.get('orderStrategies', [])
+
+        if config.ORDER_FETCH_MODE == 'incremental':
+            with stage_timer('merge'):
+                self.order_cache.replace(orders_list, time.monotonic())
+        return account.get('positions', []), orders_list
+
+    async def fetch_incremental(self):
+        cache = self.order_cache
+        now = datetime.now(timezone.utc)
+        to_entered = now + timedelta(days=1)
+        working_start = cache.working_start(now)
+        with stage_timer('get_orders'):
+            responses = await asyncio.gather(
+                self.fetch_call('get_account', self.client.get_account, self.account_id, fields=self.client.Account.Fields('positions')),
+                self.fetch_call('get_orders', self.client.get_orders_by_path, self.account_id, from_entered_datetime=cache.window_start(),
+                                to_entered_datetime=to_entered),
+                self.fetch_call('get_orders', self.client.get_orders_by_path, self.account_id, from_entered_datetime=working_start,
+                                to_entered_datetime=to_entered, status=self.client.Order.Status.WORKING))
+        if any(response is None for response in responses):
+            cache.resync_requested = True
+            return None
+        positions_response, window_response, working_response = responses
+        num_bytes = sum(len(response.content) for response in responses)
+
+        with stage_timer('decode'):
+            positions = positions_response.json()['securitiesAccount'].get('positions', [])
+            window_orders = window_response.json()
+            working_orders = working_response.json()
+
+        with stage_timer('merge'):
+            changed_ids = cache.merge(window_orders, working_orders, working_start)
+
+        if len(changed_ids) > config.ORDER_REFETCH_LIMIT:
+            cache.resync_requested = True
+        for order_id in changed_ids[:config.ORDER_REFETCH_LIMIT]:
+            response = await self.fetch_call('get_order', self.client.get_order, order_id, self.account_id)
+            if response is None:
+                cache.resync_requested = True
+                continue
+            num_bytes = num_bytes + len(response.content)
+            cache.update_order(response.json())
+
+        record_fetch_bytes(self.account_id, 'incremental', num_bytes)
+        return positions, cache.book()
+
+    async def submit_stop_order(self, request):
+        stop_order = build_stop_order(request.symbol, request.quantity, request.trigger)
+        entry_id = journal_begin(self.account_id, request)
+
+        async with self._orders_in_flight:
+            start = time.perf_counter()
+            try:
+                if isinstance(request, StopReplaceRequest):
+                    logger.info("Replacing STOP order %s of %s, quantity %s -> %s", request.order_id, request.symbol, request.old_quantity, request.quantity)
+                    r = await self.request(self.client.replace_order, self.account_id, request.order_id, stop_order)
+                else:
+                    r = await self.request(self.client.place_order, self.account_id, stop_order)
+            except httpx.HTTPError as e:
+                logger.error("FAILED - placing the order failed: %r", e)
+                notify("Failed placing the STOP Order")
+                record_stop_placed(request, None)
+                journal_error(entry_id, e)
+                return StopOrderResult(request.symbol, request.quantity, request.trigger, None, None, time.perf_counter() - start)
+            latency = time.perf_counter() - start
+
+        order_id = stop_order_placed(self.client, self.account_id, r)
+        record_stop_placed(request, order_id)
+        journal_placed(entry_id, order_id)
+        return StopOrderResult(request.symbol, request.quantity, request.trigger, order_id, r.status_code, latency)
+
+    async def submit_stop_batch(self, stop_requests):
+        results = await asyncio.gather(*[self.submit_stop_order(request) for request in stop_requests])
+        log_stop_batch_results(self.account_id, results)
+        return results
+
+    async def stop_monitor_loop(self):
+        order_index = OrderBookIndex()
+        version = 0
+        while True:
+            snapshot = await self.wait_for_update(version)
+            version = snapshot.version
+
+            with stage_timer('cycle'):
+                stop_requests = run_stop_cycle(order_index, snapshot, self.stop_type, self.stop_trigger)
+            if not stop_requests:
+                continue
+
+            if self.submit_stop_orders:
+                with stage_timer('submit'):
+                    await self.submit_stop_batch(stop_requests)
+            else:
+                logger.info("User selected not to submit missing stops . . . ")
+
+    # Same as sumbit_btc_market_order()
+    async def submit_btc_market_order(self, position):
+        from tda.orders.options import option_buy_to_close_market
+
+        for stop_order_id in position.stop_order_ids:
+            try:
+                r = await self.request(self.client.cancel_order, stop_order_id, self.account_id)
+            except (httpx.ConnectError, httpx.TimeoutException):
+                r = None
+
+            if r is None or r.status_code >= 400:
+                logger.error("FAILED - cancelling STOP order %s of %s: %s", stop_order_id, position.symbol, "no response" if r is None else r.status_code)
+                metrics.inc('watcher_api_errors_total', call='cancel_order')
+                notify("Failed cancelling the STOP Order of: " + str(position.symbol))
+                return None
+
+        try:
+            r = await self.request(self.client.place_order, self.account_id, option_buy_to_close_market(position.symbol, position.quantity))
+        except (httpx.ConnectError, httpx.TimeoutException):
+            r = None
+
+        if r is None or r.status_code >= 400:
+            logger.error("FAILED - placing the MARKET order for %s: %s", position.symbol, "no response" if r is None else r.status_code)
+            metrics.inc('watcher_api_errors_total', call='place_order')
+            notify("Failed placing the MARKET Order for: " + str(position.symbol))
+            return None
+
+        order_id = extract_order_id(self.client, self.account_id, r)
+        logger.warning("ITM protection: %s quantity=%s strike=%s underlying=%s, STOP orders %s replaced by MARKET order %s",
+                       position.symbol, position.quantity, position.strike, position.underlying_price, position.stop_order_ids, order_id)
+        notify("ITM protection: Buy to Close MARKET order placed for " + str(position.symbol) + ", order ID: " + str(order_id))
+        return order_id
+
+    async def itm_protector_loop(self):
+        version = 0
+        protected = set()
+        while True:
+            # Check the last snapshot again with fresh quotes every config.ITM_CHECK_SECONDS
+            try:
+                snapshot = await asyncio.wait_for(self.wait_for_update(version), config.ITM_CHECK_SECONDS)
+                version = snapshot.version
+                protected = protected & set(snapshot_position_tables(snapshot).options['symbol'])
+            except asyncio.TimeoutError:
+                snapshot = self._snapshot
+            if snapshot is None:
+                continue
+
+            for position in run_itm_cycle(snapshot, self.itm_offset):
+                if position.symbol in protected:
+                    continue
+                logger.warning("ITM protection activated for: %s", position.symbol)
+                if await self.submit_btc_market_order(position) is not None:
+                    protected.add(position.symbol)
+                    self.request_refresh()
+
+
+# Refreshes the quote cache with one batched get_quotes call (when streaming is off)
+async def refresh_quotes(engine, symbols):
+    while True:
+        try:
+            response = await engine.request(engine.client.get_quotes, symbols)
+        except (httpx.ConnectError, httpx.TimeoutException):
+            response = None
+
+        if response is None or response.status_code >= 400:
+            logger.error("Failed to retrieve quotes: %s", "no response" if response is None else response.status_code)
+            metrics.inc('watcher_api_errors_total', call='get_quotes')
+        else:
+            quote_cache.update_quotes(response.json())
+        await asyncio.sleep(config.QUOTE_REFRESH_SECONDS)
+
+
+# Polls the accounts of all engines in turn
+async def fetch_accounts(scheduler, refresh):
+    while True:
+        engine, wait = scheduler.next_account(time.monotonic())
+        if engine is None:
+            try:
+                await asyncio.wait_for(refresh.wait(), wait)
+            except asyncio.TimeoutError:
+                pass
+            refresh.clear()
+            continue
+
+        await engine.fetch()
+        scheduler.polled(engine, time.monotonic())
+
+
+async def run_engines(event, engines):
+    semaphore = asyncio.Semaphore(config.MAX_CONCURRENT_REQUESTS)
+    refresh = asyncio.Event()
+    for engine in engines:
+        engine.start(semaphore, refresh)
+
+    # Notifications are delivered by the notification thread of the Supervisor
+    coroutines = [fetch_accounts(AccountScheduler(engines), refresh)]
+    for engine in engines:
+        coroutines.append(engine.stop_monitor_loop())
+        if engine.run_itm_protector:
+            coroutines.append(engine.itm_protector_loop())
+    if any(engine.run_itm_protector for engine in engines) and not config.USE_STREAMING:
+        coroutines.append(refresh_quotes(engines[0], config.QUOTE_SYMBOLS))
+    if config.USE_STREAMING:
+        accounts = {str(engine.account_id): engine for engine in engines}
+        coroutines.append(run_tda_stream(event, accounts) if not config.STREAM_URL else run_url_stream(event, accounts, config.STREAM_URL))
+    tasks = [asyncio.create_task(coroutine) for coroutine in coroutines]
+
+    # Cancel everything as soon as the stop event is set, or if one of the coroutines fails
+    try:
+        while not event.is_set():
+            done = [task for task in tasks if task.done()]
+            if len(done) > 0:
+                for task in done:
+                    if not task.cancelled() and task.exception() is not None:
+                        logger.error("Monitor engine task failed: %r", task.exception())
+                break
+            await asyncio.sleep(0.1)
+    finally:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    logger.info("Stopped asyncio monitor engine")
+
+
+def run_async_engine(event, loop_timer, stop_type, stop_trigger, submit_stop_orders, itm_offset, account_ids=None):
+    client = create_td_client(use_asyncio=True)
+    engines = [AsyncMonitorEngine(client, account_id, loop_timer, stop_type, stop_trigger, submit_stop_orders, itm_offset, config.ITM_PROTECTOR)
+               for account_id in (account_ids or config.ACCOUNT_IDS)]
+
+    # The async client's pool belongs to this event loop, close it before the loop ends
+    async def run_and_close():
+        try:
+            await run_engines(event, engines)
+        finally:
+            await client_factory.close_async_client(client)
+
+    asyncio.run(run_and_close())
+    return
+
+
+###########################################################
+#       Single instance lock
+###########################################################
+# One lock file per account (config.INSTANCE_LOCK_DIR, the temp directory by default),
+# held with an OS file lock for as long as a supervisor monitors the account. A second
+# process, GUI or daemon, cannot monitor the same account and place the same orders.
+# The OS releases the lock when the process dies, so a crash leaves no stale lock.
+#
+class InstanceLock:
+    def __init__(self, account_id):
+        lock_dir = config.INSTANCE_LOCK_DIR or tempfile.gettempdir()
+        self.path = os.path.join(lock_dir, 'theWatcher-%s.lock' % account_id)
+        self.file = None
+
+    def acquire(self):
+        file = open(self.path, 'a+')
+        try:
+            if os.name == 'nt':
+                import msvcrt
+                file.seek(0)
+                msvcrt.locking(file.fileno(), msvcrt.LK_NBLCK, 1)
+            else:
+                import fcntl
+                fcntl.flock(file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            file.close()
+            return False
+
+        file.truncate(0)
+        file.write(str(os.getpid()))
+        file.flush()
+        self.file = file
+        return True
+
+    def release(self):
+        if self.file is None:
+            return
+        if os.name == 'nt':
+            import msvcrt
+            self.file.seek(0)
+            msvcrt.locking(self.file.fileno(), msvcrt.LK_UNLCK, 1)
+        else:
+            import fcntl
+            fcntl.flock(self.file.fileno(), fcntl.LOCK_UN)
+        self.file.close()
+        self.file = None
+
+
+###########################################################
+#       Worker supervisor
+###########################################################
+# Owns the workers of a monitoring session (snapshot scheduler, stop monitor and ITM
+# protector of each account, stream, quote refresher, or the asyncio engine) so there
+# is exactly one set of them per process, whatever the front end:
+#   - start() with the settings already running does nothing, with new settings it
+#     stops the running workers first. The accounts are locked (InstanceLock) first.
+#   - a worker that raises, or returns while the session is running, is restarted
+#     after config.WORKER_BACKOFF_SECONDS, doubled on every consecutive failure up to
+#     config.WORKER_BACKOFF_MAX_SECONDS. The backoff resets once the worker has run
+#     for config.WORKER_HEALTHY_SECONDS.
+#   - stop() sets the stop event, wakes the workers and waits for them up to
+#     config.SHUTDOWN_TIMEOUT_SECONDS
+#
+# Used by the GUI (__main__) and by the headless daemon (watcher_daemon.py).
+#
+MonitorSettings = namedtuple('MonitorSettings', ['loop_timer', 'stop_type', 'stop_trigger', 'itm_offset', 'submit_stop_orders'])
+
+class SupervisedWorker:
+    def __init__(self, name, target, args):
+        self.name = name
+        self.target = target
+        self.args = args
+        self.restarts = 0
+        self.thread = None
+
+    def run(self, event):
+        backoff = config.WORKER_BACKOFF_SECONDS
+        while not event.is_set():
+            started = time.monotonic()
+            try:
+                self.target(event, *self.args)
+            except Exception:
+                logger.exception("Worker %s failed", self.name)
+            if event.is_set():
+                break
+
+            if time.monotonic() - started >= config.WORKER_HEALTHY_SECONDS:
+                backoff = config.WORKER_BACKOFF_SECONDS
+            self.restarts = self.restarts + 1
+            metrics.inc('watcher_worker_restarts_total', worker=self.name)
+            logger.warning("Worker %s stopped, restarting in %.1f seconds", self.name, backoff)
+            event.wait(backoff)
+            backoff = min(backoff * 2, config.WORKER_BACKOFF_MAX_SECONDS)
+
+    def start(self, event):
+        self.thread = threading.Thread(target=self.run, args=(event,), name=self.name, daemon=True)
+        self.thread.start()
+
+class Supervisor:
+    def __init__(self, client, account_ids=None):
+        self.client = client
+        self.account_ids = list(account_ids or config.ACCOUNT_IDS)
+        self.lock = threading.Lock()
+        self.settings = None
+        self.event = None
+        self.workers = []
+        self.locks = []
+        self.accounts = {}
+        self.wakeup = None
+
+    def running(self):
+        return self.settings is not None
+
+    def start(self, settings):
+        with self.lock:
+            if self.settings == settings:
+                logger.info("The Watcher is already running with these settings")
+                return True
+            if self.settings is not None:
+                logger.info("Settings changed, restarting The Watcher")
+                self.shutdown()
+
+            if not self.lock_accounts():
+                return False
+
+            self.event = Event()
+            self.workers = self.create_workers(settings)
+
+            # Discord notifications are delivered by one thread while the workers run, whatever the engine
+            notifications.start()
+            for worker in self.workers:
+                worker.start(self.event)
+            self.settings = settings
+            logger.info("The Watcher started for accounts %s: %s", self.account_ids, settings)
+            return True
+
+    def stop(self):
+        with self.lock:
+            self.shutdown()
+
+    def lock_accounts(self):
+        for account_id in self.account_ids:
+            instance_lock = InstanceLock(account_id)
+            if not instance_lock.acquire():
+                logger.error("Account %s is already monitored by another process (%s)", account_id, instance_lock.path)
+                notify("The Watcher is already running for account " + str(account_id))
+                self.unlock_accounts()
+                return False
+            self.locks.append(instance_lock)
+        return True
+
+    def unlock_accounts(self):
+        for instance_lock in self.locks:
+            instance_lock.release()
+        self.locks = []
+
+    def create_workers(self, settings):
+        if config.USE_ASYNCIO_ENGINE:
+            return [SupervisedWorker('async_engine', run_async_engine, (settings.loop_timer, settings.stop_type, settings.stop_trigger,
+                                                                        settings.submit_stop_orders, settings.itm_offset, self.account_ids))]
+
+        # Snapshot fetcher polling the accounts in turn. With streaming enabled, the REST poll is only a slow consistency check.
+        fetch_loop = config.STREAM_RESYNC_SECONDS if config.USE_STREAMING else settings.loop_timer
+        self.wakeup = Event()
+        self.accounts = {str(account_id): AccountSnapshotService(self.client, fetch_loop, account_id, self.wakeup) for account_id in self.account_ids}
+        workers = [SupervisedWorker('scheduler', AccountScheduler(self.accounts.values()).run, (self.wakeup,))]
+
+        for account_id, snapshots in self.accounts.items():
+            workers.append(SupervisedWorker('stop_monitor-' + account_id, stop_monitor, (snapshots, settings.loop_timer, settings.stop_type,
+                                                                                          settings.stop_trigger, settings.submit_stop_orders)))
+            if config.ITM_PROTECTOR:
+                workers.append(SupervisedWorker('itm_protector-' + account_id, in_the_money_protector, (snapshots, settings.loop_timer, settings.itm_offset)))
+
+        if config.USE_STREAMING:
+            workers.append(SupervisedWorker('stream', account_activity_stream, (self.accounts,)))
+        elif config.ITM_PROTECTOR:
+            # The stream updates the quotes otherwise
+            workers.append(SupervisedWorker('quotes', quote_cache.run, (self.client, config.QUOTE_SYMBOLS, config.QUOTE_REFRESH_SECONDS)))
+        return workers
+
+    def shutdown(self):
+        if self.settings is None:
+            return
+
+        logger.info('Stopping The Watcher . . . ')
+        self.event.set()
+        if self.wakeup is not None:
+            self.wakeup.set()
+        for snapshots in self.accounts.values():
+            snapshots.wake_workers()
+
+        deadline = time.monotonic() + config.SHUTDOWN_TIMEOUT_SECONDS
+        for worker in self.workers:
+            worker.thread.join(max(0, deadline - time.monotonic()))
+            if worker.thread.is_alive():
+                logger.warning("Worker %s did not stop within %s seconds", worker.name, config.SHUTDOWN_TIMEOUT_SECONDS)
+
+        # Sends what the workers queued before they stopped
+        notifications.stop(max(0, deadline - time.monotonic()) + config.NOTIFY_WINDOW_SECONDS)
+
+        self.unlock_accounts()
+        self.workers = []
+        self.accounts = {}
+        self.wakeup = None
+        self.settings = None
+        logger.info("The Watcher stopped")
+
+    def stats(self):
+        return [('watcher_worker_running', {'worker': worker.name}, 1 if worker.thread.is_alive() else 0) for worker in list(self.workers)]
+
 
 if __name__ == '__main__':
-    # Check Authorization token to see if we are near expiration
-    check_auth_token()
+    # Log records are written to the console and TRADE_LOG by a background thread
+    log_listener = setup_logging()
+
+    # Import pandas and tda while the token is checked and the client logs in
+    threading.Thread(target=preload_modules, name='preload', daemon=True).start()
+
+    # Check Authorization token to see if we are near expiration (the fake server needs none)
+    if not config.TDA_BASE_URL:
+        check_auth_token()
 
     # Create a basic GUI window from the layout defined above
     window_title = 'Stop Loss Monitor'
-    window = sg.Window(window_title, layout, size=(300, 200))
+    window = create_window(window_title)
 
-    # Events to communicate with threads
-    stop_thread_event = Event()
-    itm_thread_event = Event()
+    # A single TD API client is shared by the snapshot fetcher and the monitors of every account.
+    # Its access token is refreshed in the background for the life of the process.
+    client = create_td_client()
+    client_factory.start(Event())
+
+    # Keep every get_account and place_order exchange for replay (see record_replay.py)
+    if config.RECORD_LOG:
+        from record_replay import RecordingClient
+        client = RecordingClient(client, config.RECORD_LOG)
+
+    # The supervisor owns the monitor threads, Start only (re)starts them when the settings changed
+    supervisor = Supervisor(client)
+    metrics.collectors.append(supervisor.stats)
+    metrics_started = False
 
     # We can use while loop to check for any gui_events that may occur when using the window.read() method
     while True:
         # The input data in values is a dictionary with keys specified as in the layout
         gui_event, values = window.read()
 
-        scheduler_loop = float(values['loop_timer'])
-        stop_type = values['stop_type']
-        stop_trigger = values['stop_trigger']
-        itm_protection_offset = values['itm_protection_offset']
-        submit_stop_orders = values['submitStopOrders']
-
-        # Create a thread to run the stop mointor
-        t1 = threading.Thread(target=stop_monitor, args=(stop_thread_event, scheduler_loop, stop_type, stop_trigger, submit_stop_orders,))
-
-        # Create a thread to run the in-the-money protector
-        t2 = threading.Thread(target=in_the_money_protector, args=(itm_thread_event, scheduler_loop, itm_protection_offset,))
-
         if gui_event == 'Stop':
-            stop_thread(stop_thread_event)
-            stop_thread(itm_thread_event)
+            supervisor.stop()
 
         elif gui_event == sg.WIN_CLOSED or gui_event == 'Exit':  
-            stop_thread(stop_thread_event)
-            stop_thread(itm_thread_event)      
+            supervisor.stop()
             break
         
         elif gui_event == 'Clear':
-            clear_input()
+            clear_input(window, values)
 
         else :      
-            #print(gui_event, values)
-            stop_thread_event.clear()
-            itm_thread_event.clear()
-            t1.start()
-            # t2.start()
-               
\ No newline at end of file
+            settings = MonitorSettings(float(values['loop_timer']), values['stop_type'], values['stop_trigger'],
+                                       values['itm_protection_offset'], values['submitStopOrders'])
+
+            # Prometheus endpoint with the monitor latency histograms and counters, once the accounts are locked
+            if supervisor.start(settings) and not metrics_started:
+                start_metrics_server()
+                metrics_started = True
+               
+    # Flush pending log records before exiting
+    window.close()
+    log_listener.stop()
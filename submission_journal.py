@@ -0,0 +1,108 @@
+###########################################################
+#       Journal of STOP order submissions
+###########################################################
+# Every STOP order is written to a SQLite journal (WAL mode) before place_order is
+# called, and updated with the order ID or the failure once the call returns. The
+# orders book can take a few seconds to show a new order as WORKING, and until it
+# does the stop monitor would see the short as unprotected and place the same stop
+# again. The entries still IN_FLIGHT cover their symbol during that time:
+#
+#   IN_FLIGHT   submitted, not yet seen in the orders book (or no answer from the server)
+#   CONFIRMED   the order ID showed up in the orders book, which is authoritative from then on:
+#               the stop covers its short while its status is not terminal (WORKING, but
+#               also QUEUED, ACCEPTED, ...), and not once it is REJECTED, CANCELED, ...
+#   FAILED      the server rejected the order, or it was never sent
+#   EXPIRED     not seen in the orders book within the time to live
+#
+# The journal is a file, so stops submitted just before a restart still count.
+#
+import sqlite3
+import threading
+import time
+from collections import namedtuple
+
+IN_FLIGHT = 'IN_FLIGHT'
+CONFIRMED = 'CONFIRMED'
+FAILED = 'FAILED'
+EXPIRED = 'EXPIRED'
+
+# Resolved entries are deleted after this many seconds
+KEEP_SECONDS = 7 * 24 * 3600
+
+JournalEntry = namedtuple('JournalEntry', ['entry_id', 'account', 'symbol', 'quantity', 'trigger', 'order_id', 'status', 'submitted'])
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS submissions (
+    entry_id INTEGER PRIMARY KEY AUTOINCREMENT,
+    account TEXT NOT NULL,
+    symbol TEXT NOT NULL,
+    quantity INTEGER NOT NULL,
+    trigger REAL,
+    order_id INTEGER,
+    status TEXT NOT NULL,
+    submitted REAL NOT NULL,
+    updated REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS submissions_status ON submissions (account, status);
+"""
+
+
+class SubmissionJournal:
+    def __init__(self, path, ttl_seconds=60.0):
+        self.path = path
+        self.ttl_seconds = ttl_seconds
+        self._lock = threading.Lock()
+
+        # One connection shared by the monitor threads, serialized by the lock
+        self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute('PRAGMA synchronous=NORMAL')
+        self._db.executescript(SCHEMA)
+        self._db.execute('DELETE FROM submissions WHERE status != ? AND updated < ?', (IN_FLIGHT, time.time() - KEEP_SECONDS))
+
+    # Records a submission before the order is sent, returns its entry ID
+    def begin(self, account_id, symbol, quantity, trigger):
+        now = time.time()
+        with self._lock:
+            cursor = self._db.execute('INSERT INTO submissions (account, symbol, quantity, trigger, order_id, status, submitted, updated) '
+                                      'VALUES (?, ?, ?, ?, NULL, ?, ?, ?)',
+                                      (str(account_id), symbol, int(quantity), float(trigger), IN_FLIGHT, now, now))
+            return cursor.lastrowid
+
+    # The server accepted the order, it stays in flight until the orders book shows it
+    def placed(self, entry_id, order_id):
+        with self._lock:
+            self._db.execute('UPDATE submissions SET order_id = ?, updated = ? WHERE entry_id = ?', (order_id, time.time(), entry_id))
+
+    def failed(self, entry_id):
+        with self._lock:
+            self._db.execute('UPDATE submissions SET status = ?, updated = ? WHERE entry_id = ?', (FAILED, time.time(), entry_id))
+
+    # Resolves the in-flight entries of an account against the order IDs of its orders book,
+    # and returns the ones still in flight
+    def in_flight(self, account_id, book_order_ids, now=None):
+        now = time.time() if now is None else now
+        with self._lock:
+            rows = self._db.execute('SELECT entry_id, account, symbol, quantity, trigger, order_id, status, submitted FROM submissions '
+                                    'WHERE account = ? AND status = ?', (str(account_id), IN_FLIGHT)).fetchall()
+
+            entries = []
+            confirmed = []
+            expired = []
+            for row in rows:
+                entry = JournalEntry(*row)
+                if entry.order_id is not None and entry.order_id in book_order_ids:
+                    confirmed.append((CONFIRMED, now, entry.entry_id))
+                elif now - entry.submitted > self.ttl_seconds:
+                    expired.append((EXPIRED, now, entry.entry_id))
+                else:
+                    entries.append(entry)
+
+            if confirmed or expired:
+                self._db.executemany('UPDATE submissions SET status = ?, updated = ? WHERE entry_id = ?', confirmed + expired)
+
+        return entries
+
+    def close(self):
+        with self._lock:
+            self._db.close()
@@ -0,0 +1,147 @@
+###########################################################
+#       Synthetic TDA account payloads
+###########################################################
+# Generates realistic r['securitiesAccount'] JSON, as returned by get_account with
+# Fields('positions') and Fields('orders'), for benchmarks and offline runs.
+#
+# The account holds 'num_positions' short SPXW options (plus a few long wings,
+# equities and fixed income) and 'num_orders' order strategies:
+#   - FILLED single-leg SELL_TO_OPEN orders, sometimes several per strike at different prices
+#   - FILLED two-leg vertical spreads
+#   - WORKING BUY_TO_CLOSE STOP orders, some for only part of the short quantity
+#   - CANCELED orders and a few advanced (OCO) orders with childOrderStrategies
+#
+# Usage:
+#   python synthetic_account.py 50 200 > account.json
+#
+import argparse
+import json
+import random
+from datetime import datetime, timedelta
+
+
+def option_symbol(expiry, put_call, strike):
+    return 'SPXW_' + expiry.strftime('%m%d%y') + put_call + str(strike)
+
+def tda_time(value):
+    return value.strftime('%Y-%m-%dT%H:%M:%S+0000')
+
+def option_instrument(symbol, put_call):
+    return {'assetType': 'OPTION', 'cusip': '0SPXW.' + symbol[5:], 'symbol': symbol, 'putCall': 'PUT' if put_call == 'P' else 'CALL',
+            'underlyingSymbol': '$SPX.X', 'description': 'SPXW ' + symbol[5:]}
+
+def option_leg(leg_id, symbol, put_call, instruction, quantity):
+    return {'orderLegType': 'OPTION', 'legId': leg_id, 'instrument': option_instrument(symbol, put_call),
+            'instruction': instruction, 'positionEffect': 'OPENING' if instruction.endswith('OPEN') else 'CLOSING', 'quantity': quantity}
+
+
+class SyntheticAccount:
+    def __init__(self, num_positions, num_orders, seed=0, account_id=123456789, spx=4100, day=None):
+        self.random = random.Random(seed)
+        self.num_positions = num_positions
+        self.num_orders = num_orders
+        self.account_id = account_id
+        self.spx = spx
+        self.day = day or datetime(2023, 5, 16, 13, 30)     # market open in UTC
+        self.next_order_id = 5000000000
+
+    def order_id(self):
+        self.next_order_id = self.next_order_id + 1
+        return self.next_order_id
+
+    def order_time(self):
+        return self.day + timedelta(seconds=self.random.randint(0, 6 * 3600))
+
+    def shorts(self):
+        # Short strikes away from the money, puts below and calls above
+        shorts = []
+        for i in range(0, self.num_positions):
+            put_call = 'P' if i % 2 == 0 else 'C'
+            distance = 5 * (i // 2 + 4)
+            strike = self.spx - distance if put_call == 'P' else self.spx + distance
+            shorts.append((option_symbol(self.day, put_call, strike), put_call, strike, self.random.randint(1, 10)))
+        return shorts
+
+    def filled_order(self, legs, prices, quantity, order_type='LIMIT'):
+        entered = self.order_time()
+        closed = entered + timedelta(seconds=self.random.randint(1, 30))
+        execution_legs = [{'legId': leg['legId'], 'quantity': quantity, 'mismarkedQuantity': 0, 'price': price, 'time': tda_time(closed)}
+                          for leg, price in zip(legs, prices)]
+        return {'session': 'NORMAL', 'duration': 'DAY', 'orderType': order_type, 'complexOrderStrategyType': 'NONE' if len(legs) == 1 else 'VERTICAL',
+                'quantity': quantity, 'filledQuantity': quantity, 'remainingQuantity': 0, 'requestedDestination': 'AUTO',
+                'price': round(sum(prices), 2), 'orderLegCollection': legs, 'orderStrategyType': 'SINGLE', 'orderId': self.order_id(),
+                'cancelable': False, 'editable': False, 'status': 'FILLED', 'enteredTime': tda_time(entered), 'closeTime': tda_time(closed),
+                'accountId': self.account_id,
+                'orderActivityCollection': [{'activityType': 'EXECUTION', 'executionType': 'FILL', 'quantity': quantity, 'orderRemainingQuantity': 0,
+                                             'executionLegs': execution_legs}]}
+
+    def stop_order(self, symbol, put_call, quantity, stop_price, status='WORKING'):
+        return {'session': 'NORMAL', 'duration': 'GOOD_TILL_CANCEL', 'orderType': 'STOP', 'complexOrderStrategyType': 'NONE',
+                'quantity': quantity, 'filledQuantity': 0, 'remainingQuantity': quantity, 'stopPrice': stop_price,
+                'orderLegCollection': [option_leg(1, symbol, put_call, 'BUY_TO_CLOSE', quantity)], 'orderStrategyType': 'SINGLE',
+                'orderId': self.order_id(), 'cancelable': status == 'WORKING', 'editable': status == 'WORKING', 'status': status,
+                'enteredTime': tda_time(self.order_time()), 'accountId': self.account_id}
+
+    def generate(self):
+        shorts = self.shorts()
+        positions = []
+        orders = []
+
+        for symbol, put_call, strike, quantity in shorts:
+            price = round(self.random.uniform(0.5, 3.0), 2)
+            positions.append({'shortQuantity': quantity, 'averagePrice': price, 'currentDayProfitLoss': 0.0, 'longQuantity': 0,
+                              'instrument': option_instrument(symbol, put_call), 'marketValue': -quantity * price * 100})
+
+        # Long wings of the spreads and a couple of other asset types
+        for symbol, put_call, strike, quantity in shorts[:max(1, len(shorts) // 4)]:
+            wing = strike - 25 if put_call == 'P' else strike + 25
+            positions.append({'shortQuantity': 0, 'averagePrice': 0.3, 'longQuantity': quantity,
+                              'instrument': option_instrument(option_symbol(self.day, put_call, wing), put_call), 'marketValue': quantity * 30})
+        positions.append({'shortQuantity': 0, 'averagePrice': 410.0, 'longQuantity': 10, 'instrument': {'assetType': 'EQUITY', 'cusip': '78462F103', 'symbol': 'SPY'}})
+        positions.append({'shortQuantity': 0, 'averagePrice': 99.5, 'longQuantity': 1000,
+                          'instrument': {'assetType': 'FIXED_INCOME', 'cusip': '912797GK7', 'symbol': '912797GK7', 'description': 'US T-BILL',
+                                         'maturityDate': '2023-08-15T00:00:00.000+0000', 'factor': 1.0}})
+
+        while len(orders) < self.num_orders:
+            symbol, put_call, strike, quantity = self.random.choice(shorts)
+            kind = self.random.random()
+
+            if kind < 0.35:
+                # Single leg, possibly one of several fills of the same strike
+                lot = self.random.randint(1, quantity)
+                orders.append(self.filled_order([option_leg(1, symbol, put_call, 'SELL_TO_OPEN', lot)], [round(self.random.uniform(0.5, 3.0), 2)], lot))
+            elif kind < 0.6:
+                # Vertical spread
+                wing = strike - 25 if put_call == 'P' else strike + 25
+                legs = [option_leg(1, symbol, put_call, 'SELL_TO_OPEN', quantity),
+                        option_leg(2, option_symbol(self.day, put_call, wing), put_call, 'BUY_TO_OPEN', quantity)]
+                orders.append(self.filled_order(legs, [round(self.random.uniform(1.0, 3.0), 2), round(self.random.uniform(0.05, 0.5), 2)], quantity, 'NET_CREDIT'))
+            elif kind < 0.85:
+                # Stop, sometimes for only part of the position
+                stop_quantity = quantity if self.random.random() < 0.7 else self.random.randint(1, quantity)
+                orders.append(self.stop_order(symbol, put_call, stop_quantity, round(self.random.uniform(2.0, 8.0), 1)))
+            elif kind < 0.95:
+                orders.append(self.stop_order(symbol, put_call, quantity, round(self.random.uniform(2.0, 8.0), 1), status='CANCELED'))
+            else:
+                # Advanced order, skipped by the monitor
+                parent = self.filled_order([option_leg(1, symbol, put_call, 'SELL_TO_OPEN', quantity)], [1.5], quantity)
+                parent['orderStrategyType'] = 'TRIGGER'
+                parent['childOrderStrategies'] = [self.stop_order(symbol, put_call, quantity, 4.0)]
+                orders.append(parent)
+
+        return {'securitiesAccount': {'type': 'MARGIN', 'accountId': str(self.account_id), 'roundTrips': 0, 'isDayTrader': False,
+                                      'positions': positions, 'orderStrategies': orders}}
+
+
+def generate_account(num_positions, num_orders, seed=0):
+    return SyntheticAccount(num_positions, num_orders, seed).generate()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Generates a synthetic TDA securitiesAccount payload.')
+    parser.add_argument('positions', type=int, help='number of short option positions')
+    parser.add_argument('orders', type=int, help='number of order strategies')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    print(json.dumps(generate_account(args.positions, args.orders, args.seed), indent=2))
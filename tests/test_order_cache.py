@@ -0,0 +1,64 @@
+###########################################################
+#       Incremental orders cache tests
+###########################################################
+# OrderHistoryCache keeps every open order until it shows a terminal status. A GTC stop
+# older than config.ORDER_LOOKBACK_DAYS cannot be returned by the incremental queries,
+# so it must stay in the book without being reported as changed on every tick.
+#
+# Usage:
+#   python -m unittest discover tests
+#
+import os
+import sys
+import unittest
+from datetime import datetime, timedelta, timezone
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import stoploss_monitor_standalone as monitor
+from synthetic_account import SyntheticAccount, option_symbol, tda_time
+
+
+class OrderHistoryCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.now = datetime.now(timezone.utc)
+        self.account = SyntheticAccount(1, 0)
+        self.symbol = option_symbol(self.account.day, 'P', 3990)
+        self.cache = monitor.OrderHistoryCache()
+
+    def stop_order(self, age, status='WORKING'):
+        order_strat = self.account.stop_order(self.symbol, 'P', 1, 2.5, status=status)
+        order_strat['enteredTime'] = tda_time(self.now - age)
+        return order_strat
+
+    def test_old_gtc_stop_stays_tracked(self):
+        old_stop = self.stop_order(timedelta(days=monitor.config.ORDER_LOOKBACK_DAYS + 30))
+        self.cache.replace([old_stop], 0)
+
+        # Neither query returns it, on any number of ticks
+        for tick in range(0, 3):
+            self.assertEqual(self.cache.merge([], [], self.cache.working_start(self.now)), [])
+        self.assertEqual(self.cache.book(), [old_stop])
+        self.assertIn(old_stop['orderId'], self.cache.open_orders)
+
+    def test_recent_open_order_missing_from_queries_is_refetched(self):
+        stop = self.stop_order(timedelta(days=2))
+        self.cache.replace([stop], 0)
+        self.assertEqual(self.cache.merge([], [], self.cache.working_start(self.now)), [stop['orderId']])
+
+    def test_terminal_status_ends_tracking(self):
+        old_stop = self.stop_order(timedelta(days=monitor.config.ORDER_LOOKBACK_DAYS + 30))
+        self.cache.replace([old_stop], 0)
+
+        self.cache.update_order(dict(old_stop, status='CANCELED'))
+        self.assertNotIn(old_stop['orderId'], self.cache.open_orders)
+        self.assertEqual(self.cache.book()[0]['status'], 'CANCELED')
+
+    def test_queued_order_is_tracked(self):
+        stop = self.stop_order(timedelta(hours=12), status='QUEUED')
+        self.cache.replace([stop], 0)
+        self.assertIn(stop['orderId'], self.cache.open_orders)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,65 @@
+###########################################################
+#       Stop coverage tests
+###########################################################
+# A STOP order the broker has accepted but not yet activated (ACCEPTED, QUEUED, ...)
+# covers its short: the monitor must not place a second stop for it, neither right
+# after submitting it (journal) nor once the orders book shows it.
+#
+# Usage:
+#   python -m unittest discover tests
+#
+import os
+import sys
+import unittest
+from datetime import datetime
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import stoploss_monitor_standalone as monitor
+from submission_journal import SubmissionJournal
+from synthetic_account import SyntheticAccount, option_instrument, option_symbol
+
+ACCOUNT_ID = '123456789'
+
+
+class StopCoverageTest(unittest.TestCase):
+    def setUp(self):
+        self.account = SyntheticAccount(1, 0)
+        self.symbol = option_symbol(self.account.day, 'P', 3990)
+        self.positions = [{'shortQuantity': 1, 'averagePrice': 1.5, 'longQuantity': 0, 'currentDayProfitLoss': 0.0,
+                           'instrument': option_instrument(self.symbol, 'P'), 'marketValue': -150}]
+        monitor.submission_journal = SubmissionJournal(':memory:', 60)
+
+    def run_cycle(self, order_index, version, orders):
+        snapshot = monitor.AccountSnapshot(version, datetime.now(), tuple(self.positions), tuple(orders), ACCOUNT_ID)
+        return monitor.run_stop_cycle(order_index, snapshot, 'Fix', '2.5')
+
+    def test_missing_stop_is_requested(self):
+        stop_requests = self.run_cycle(monitor.OrderBookIndex(), 1, [])
+        self.assertEqual([(request.symbol, request.quantity) for request in stop_requests], [(self.symbol, 1)])
+
+    def test_accepted_stop_covers_short(self):
+        stop = self.account.stop_order(self.symbol, 'P', 1, 2.5, status='ACCEPTED')
+        self.assertEqual(self.run_cycle(monitor.OrderBookIndex(), 1, [stop]), [])
+
+    def test_accepted_stop_confirmed_by_journal_is_not_duplicated(self):
+        order_index = monitor.OrderBookIndex()
+        stop = self.account.stop_order(self.symbol, 'P', 1, 2.5, status='ACCEPTED')
+
+        # The stop was submitted, the book does not show it yet
+        entry_id = monitor.submission_journal.begin(ACCOUNT_ID, self.symbol, 1, 2.5)
+        monitor.submission_journal.placed(entry_id, stop['orderId'])
+        self.assertEqual(self.run_cycle(order_index, 1, []), [])
+
+        # The book shows it ACCEPTED: the journal entry is confirmed and the stop still covers the short
+        self.assertEqual(self.run_cycle(order_index, 2, [stop]), [])
+        self.assertEqual(monitor.submission_journal.in_flight(ACCOUNT_ID, {stop['orderId']}), [])
+
+    def test_rejected_stop_does_not_cover_short(self):
+        stop = self.account.stop_order(self.symbol, 'P', 1, 2.5, status='REJECTED')
+        stop_requests = self.run_cycle(monitor.OrderBookIndex(), 1, [stop])
+        self.assertEqual([request.symbol for request in stop_requests], [self.symbol])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,114 @@
+###########################################################
+#       Headless The Watcher service
+###########################################################
+# Runs the monitors without the GUI, e.g. as a systemd service or a scheduled task on a
+# host without a display. The settings of the GUI form come from a JSON file and/or the
+# command line (the command line wins):
+#
+#   {"loop_timer": 2.0, "stop_type": "Fix", "stop_trigger": 2.5, "itm_offset": 1.0,
+#    "submit_stop_orders": true, "accounts": [123456789]}
+#
+# The workers run under the same Supervisor as the GUI: one instance per account (a
+# second daemon or GUI for the same account exits with status 2), failed workers are
+# restarted with backoff, and SIGTERM or Ctrl-C stops them gracefully.
+#
+# Usage:
+#   python watcher_daemon.py --config watcher.json
+#   python watcher_daemon.py --stop-type Multiplier --stop-trigger 2 --account 123456789
+#
+# Two daemons for different accounts on one host need different --metrics-port values,
+# otherwise the second one runs without metrics.
+#
+import argparse
+import json
+import signal
+import sys
+import threading
+from threading import Event
+
+import config
+import stoploss_monitor_standalone as monitor
+
+# Same defaults as the GUI form
+DEFAULT_SETTINGS = {'loop_timer': 2.0, 'stop_type': 'Fix', 'stop_trigger': 2.5, 'itm_offset': 1.0, 'submit_stop_orders': True, 'accounts': None}
+
+
+def load_settings(path, args):
+    settings = dict(DEFAULT_SETTINGS)
+    if path:
+        with open(path) as file:
+            settings.update(json.load(file))
+
+    for key in DEFAULT_SETTINGS:
+        value = getattr(args, key, None)
+        if value is not None:
+            settings[key] = value
+
+    # The monitors take the trigger and offset as the GUI hands them over, as text
+    monitor_settings = monitor.MonitorSettings(float(settings['loop_timer']), settings['stop_type'], str(settings['stop_trigger']),
+                                               str(settings['itm_offset']), bool(settings['submit_stop_orders']))
+    return monitor_settings, settings['accounts'] or config.ACCOUNT_IDS
+
+
+def run_daemon(settings, account_ids, metrics_port=None):
+    shutdown = Event()
+
+    def request_shutdown(signum, frame):
+        monitor.logger.info("Received signal %s, shutting down", signum)
+        shutdown.set()
+
+    signal.signal(signal.SIGTERM, request_shutdown)
+    signal.signal(signal.SIGINT, request_shutdown)
+
+    if not config.TDA_BASE_URL:
+        monitor.check_auth_token()
+
+    client = monitor.create_td_client()
+    monitor.client_factory.start(Event())
+
+    # Keep every get_account and place_order exchange for replay (see record_replay.py)
+    if config.RECORD_LOG:
+        from record_replay import RecordingClient
+        client = RecordingClient(client, config.RECORD_LOG)
+
+    supervisor = monitor.Supervisor(client, account_ids)
+    monitor.metrics.collectors.append(supervisor.stats)
+    if not supervisor.start(settings):
+        return 2
+
+    # Prometheus endpoint with the monitor latency histograms and counters, once the accounts are locked
+    monitor.start_metrics_server(metrics_port)
+
+    # Signals are handled by the main thread, wake up regularly so they are not held back
+    while not shutdown.wait(1.0):
+        pass
+
+    supervisor.stop()
+    return 0
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Runs The Watcher without the GUI.')
+    parser.add_argument('--config', help='JSON file with the monitor settings')
+    parser.add_argument('--loop-timer', dest='loop_timer', type=float, help='seconds between account polls')
+    parser.add_argument('--stop-type', dest='stop_type', choices=['Fix', 'Multiplier'])
+    parser.add_argument('--stop-trigger', dest='stop_trigger', type=float, help='STOP price (Fix) or multiplier of the fill price (Multiplier)')
+    parser.add_argument('--itm-offset', dest='itm_offset', type=float, help='ITM protection offset')
+    parser.add_argument('--no-submit', dest='submit_stop_orders', action='store_false', default=None, help='only report missing stops')
+    parser.add_argument('--account', dest='accounts', type=int, action='append', help='account to monitor, repeat for several (default config.ACCOUNT_IDS)')
+    parser.add_argument('--metrics-port', dest='metrics_port', type=int, help='Prometheus metrics port, 0 disables it (default config.METRICS_PORT)')
+    args = parser.parse_args()
+
+    settings, account_ids = load_settings(args.config, args)
+
+    # Log records are written to the console and TRADE_LOG by a background thread
+    log_listener = monitor.setup_logging()
+
+    # Import pandas and tda while the token is checked and the client logs in
+    threading.Thread(target=monitor.preload_modules, name='preload', daemon=True).start()
+
+    status = run_daemon(settings, account_ids, args.metrics_port)
+
+    # Flush pending log records before exiting
+    log_listener.stop()
+    sys.exit(status)